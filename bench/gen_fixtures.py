@@ -0,0 +1,412 @@
+#!/usr/bin/python3
+
+import argparse
+import collections
+import itertools
+import logging
+import os
+import random
+import stat
+import sys
+
+logr = logging.getLogger()
+# run_bench.py imports this module and sets up its own handler
+if __name__ == '__main__':
+    console_handler = logging.StreamHandler()
+    formatter = logging.Formatter( '%(levelname)s [%(filename)s %(lineno)d] %(message)s' )
+    console_handler.setFormatter( formatter )
+    logr.addHandler( console_handler )
+    logr.setLevel( logging.WARNING )
+
+DESCRIPTION = '''
+    Generate synthetic inputs for bench/run_bench.py, so the backup pipeline
+    can be measured without real data, dar or globus.
+      tree     - a real directory tree of sparse files, with hardlinks and
+                 empty directories (input of scandir)
+      filelist - an allfileslist, "SIZE\\0PATH" lines (input of split_filelist)
+      catalog  - a "dar -Txml -l" listing of the same entries
+                 (input of dar_parse_xml)
+      slices   - a bkup infodir: slice ini files, filelists and catalogue
+                 listings, plus a fake dar that prints them
+                 (input of verify_slice and summary)
+    Output depends only on the options, the same seed always gives the same
+    tree, sizes and names.
+'''
+
+Entry = collections.namedtuple( 'Entry', 'kind path size link' )
+# kinds of Entry; DIR and END bracket the contents of a directory
+DIR = 'dir'
+END = 'end'
+FILE = 'file'
+
+# Earlier files a hardlink may point to
+LINK_POOL = 1000
+
+FAKE_DAR = '''#!/bin/sh
+# Stand-in for "dar -Q -Txml -as -l CATALOGUE": print CATALOGUE.xml
+for last; do :; done
+exec cat "$last.xml"
+'''
+
+XML_HEAD = ( '<?xml version="1.0" ?>\n'
+             '<!DOCTYPE Catalog SYSTEM "dar-catalog.dtd">\n'
+             '<Catalog format="1.2">\n' )
+XML_TAIL = '</Catalog>\n'
+XML_DIR_ATTRS = ( '<Attributes data="saved" metadata="absent" user="root" group="root" '
+                  'permissions=" drwxr-xr-x" atime="1500000000" mtime="1500000000" '
+                  'ctime="1500000000" />\n' )
+XML_FILE = ( '<File name="{0}" size="{1}" stored="{1}" crc="00000000" dirty="no" '
+             'sparse="no" delta_sig="no">\n'
+             '<Attributes data="saved" metadata="absent" user="root" group="root" '
+             'permissions=" -rw-r--r--" atime="1500000000" mtime="1500000000" '
+             'ctime="1500000000" />\n'
+             '</File>\n' )
+
+
+def parse_count( val ):
+    ''' Int with an optional k, M or G suffix (powers of 1000)
+    '''
+    mult = { 'k': 10**3, 'K': 10**3, 'M': 10**6, 'G': 10**9 }
+    try:
+        if val and val[-1] in mult:
+            return int( float( val[:-1] ) * mult[ val[-1] ] )
+        return int( val )
+    except ValueError:
+        raise argparse.ArgumentTypeError( "invalid count '{0}'".format( val ) )
+
+
+def add_tree_args( parser ):
+    ''' Options that shape the synthetic tree, shared with run_bench.py
+    '''
+    parser.add_argument( '-n', '--entries', type=parse_count,
+        help='number of files, suffix k, M or G allowed (default: %(default)s)' )
+    parser.add_argument( '--seed', type=int, help='(default: %(default)s)' )
+    parser.add_argument( '--fanout', type=int,
+        help='subdirectories per directory (default: %(default)s)' )
+    parser.add_argument( '--files_per_dir', type=int,
+        help='mean files per directory, exponentially distributed (default: %(default)s)' )
+    parser.add_argument( '--empty_dirs', type=float,
+        help='fraction of directories with no files (default: %(default)s)' )
+    parser.add_argument( '--hardlinks', type=float,
+        help='fraction of files that are hardlinks to an earlier file (default: %(default)s)' )
+    parser.add_argument( '--sizes',
+        help=( 'file size distribution: lognormal:MU:SIGMA, pareto:ALPHA:MIN, '
+               'uniform:MAX or fixed:SIZE (default: %(default)s)' ) )
+    parser.set_defaults(
+        entries = 10000,
+        seed = 1,
+        fanout = 8,
+        files_per_dir = 50,
+        empty_dirs = 0.05,
+        hardlinks = 0.01,
+        sizes = 'lognormal:9:2.5',
+    )
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser( description=DESCRIPTION,
+        formatter_class=argparse.RawDescriptionHelpFormatter )
+    add_tree_args( parser )
+    parser.add_argument( '--fsroot',
+        help='directory prefix of paths in filelists and catalogues (default: %(default)s)' )
+    parser.add_argument( '--missing', type=float,
+        help='fraction of files left out of catalogues (default: %(default)s)' )
+    parser.add_argument( '--slice_files', type=parse_count,
+        help='files per slice, for slices (default: %(default)s)' )
+    parser.add_argument( '-v', '--verbose', action='store_true' )
+    parser.add_argument( '-d', '--debug', action='store_true' )
+    parser.add_argument( 'action', choices=( 'tree', 'filelist', 'catalog', 'slices' ) )
+    parser.add_argument( 'output', help='directory (tree, slices) or file (filelist, catalog)' )
+    parser.set_defaults(
+        fsroot = '/bench',
+        missing = 0.0,
+        slice_files = 10000,
+    )
+    args = parser.parse_args()
+    if args.verbose:
+        logr.setLevel( logging.INFO )
+    if args.debug:
+        logr.setLevel( logging.DEBUG )
+    check_args( args )
+    return args
+
+
+def check_args( args ):
+    if args.entries < 1 or args.fanout < 1 or args.files_per_dir < 1:
+        raise UserWarning( "entries, fanout and files_per_dir must be positive" )
+    for name in ( 'empty_dirs', 'hardlinks', 'missing' ):
+        val = getattr( args, name, 0.0 )
+        if not 0.0 <= val < 1.0:
+            raise UserWarning( "{0} must be a fraction in [0, 1), got {1}".format( name, val ) )
+    size_sampler( args.sizes, random.Random() )
+
+
+def size_sampler( spec, rng ):
+    ''' Return a function that draws a file size from the distribution spec
+    '''
+    kind, *params = spec.split( ':' )
+    try:
+        params = [ float( p ) for p in params ]
+        if kind == 'lognormal':
+            mu, sigma = params
+            return lambda: int( rng.lognormvariate( mu, sigma ) )
+        elif kind == 'pareto':
+            alpha, low = params
+            return lambda: int( low * rng.paretovariate( alpha ) )
+        elif kind == 'uniform':
+            high, = params
+            return lambda: rng.randint( 0, int( high ) )
+        elif kind == 'fixed':
+            size, = params
+            return lambda: int( size )
+    except ValueError:
+        pass
+    raise UserWarning( "Invalid size distribution '{0}'".format( spec ) )
+
+
+def walk( args ):
+    ''' Generate Entry for a tree of args.entries files, depth first.
+        Paths are relative. Every directory has up to args.fanout
+        subdirectories, the top one as many as it takes to hold all files.
+        A hardlink is a FILE whose link is the path of the earlier file it
+        shares an inode with (and has the same size).
+    '''
+    rng = random.Random( args.seed )
+    draw_size = size_sampler( args.sizes, rng )
+    # deep enough that the top level does not need to grow much
+    per_level = max( args.files_per_dir * ( 1.0 - args.empty_dirs ), 1.0 )
+    depth = 1
+    while per_level * args.fanout ** depth < args.entries and depth < 32:
+        depth += 1
+    remaining = [ args.entries ]
+    pool = []
+
+    def visit( path, level ):
+        yield Entry( DIR, path, 0, None )
+        if rng.random() >= args.empty_dirs:
+            num = min( remaining[0], 1 + int( rng.expovariate( 1.0 / args.files_per_dir ) ) )
+            remaining[0] -= num
+            for i in range( num ):
+                name = '{0}/f{1:06d}'.format( path, i ) if path else 'f{0:06d}'.format( i )
+                if pool and rng.random() < args.hardlinks:
+                    link, size = pool[ rng.randrange( len( pool ) ) ]
+                    yield Entry( FILE, name, size, link )
+                    continue
+                size = draw_size()
+                if len( pool ) < LINK_POOL:
+                    pool.append( ( name, size ) )
+                else:
+                    pool[ rng.randrange( LINK_POOL ) ] = ( name, size )
+                yield Entry( FILE, name, size, None )
+        if level < depth:
+            children = range( args.fanout ) if path else itertools.count()
+            for i in children:
+                if remaining[0] <= 0:
+                    break
+                sub = '{0}/d{1:02d}'.format( path, i ) if path else 'd{0:02d}'.format( i )
+                yield from visit( sub, level + 1 )
+        yield Entry( END, path, 0, None )
+
+    return visit( '', 0 )
+
+
+def files( args ):
+    return ( e for e in walk( args ) if e.kind == FILE )
+
+
+def _fspath( fsroot, path ):
+    return os.fsencode( os.path.join( fsroot, path ) )
+
+
+def write_tree( args, outdir ):
+    ''' Create the tree under outdir. Files are sparse, so only inodes cost
+        space. Return number of files.
+    '''
+    n = 0
+    for e in walk( args ):
+        p = os.path.join( outdir, e.path )
+        if e.kind == DIR:
+            os.makedirs( p, exist_ok=True )
+        elif e.kind == FILE:
+            if e.link:
+                os.link( os.path.join( outdir, e.link ), p )
+            else:
+                with open( p, 'wb' ) as f:
+                    f.truncate( e.size )
+            n += 1
+    return n
+
+
+def link_counts( args ):
+    ''' Return dict of path -> ( inode number, link count ) of every file
+        that has hardlinks. Inode numbers are made up, but unique.
+    '''
+    counts = collections.Counter( e.link for e in files( args ) if e.link )
+    return { path: ( i + 1, n + 1 ) for i, ( path, n ) in enumerate( sorted( counts.items() ) ) }
+
+
+def write_filelist( args, fn ):
+    ''' Write "SIZE\\0PATH" lines, same as scandir, with "\\0DEV:INO:NLINK"
+        for files that have hardlinks. Return number of lines.
+    '''
+    links = link_counts( args )
+    n = 0
+    tmpfn = fn + '.tmp'
+    with open( tmpfn, 'wb', buffering=1048576 ) as f:
+        for e in files( args ):
+            link = links.get( e.link or e.path )
+            if link:
+                f.write( b'%d\x00%s\x000:%d:%d\n' % (
+                    e.size, _fspath( args.fsroot, e.path ), link[0], link[1] ) )
+            else:
+                f.write( b'%d\x00%s\n' % ( e.size, _fspath( args.fsroot, e.path ) ) )
+            n += 1
+    os.rename( tmpfn, fn )
+    return n
+
+
+class CatalogWriter( object ):
+    ''' Write a dar xml listing, one entry at a time.
+        Entries must come in the order of walk(), so directories nest.
+    '''
+    def __init__( self, fn ):
+        self.fn = fn
+        self.tmpfn = fn + '.tmp'
+        self.f = open( self.tmpfn, 'w', buffering=1048576 )
+        self.f.write( XML_HEAD )
+        self.dirs = []
+
+    def add( self, path, size ):
+        parts = path.split( '/' )
+        dirs = parts[:-1]
+        common = 0
+        while ( common < len( dirs ) and common < len( self.dirs )
+                and dirs[ common ] == self.dirs[ common ] ):
+            common += 1
+        for d in self.dirs[ common: ]:
+            self.f.write( '</Directory>\n' )
+        for d in dirs[ common: ]:
+            self.f.write( '<Directory name="{0}">\n'.format( d ) )
+            self.f.write( XML_DIR_ATTRS )
+        self.dirs = dirs
+        self.f.write( XML_FILE.format( parts[-1], size ) )
+
+    def close( self ):
+        for d in self.dirs:
+            self.f.write( '</Directory>\n' )
+        self.f.write( XML_TAIL )
+        self.f.close()
+        os.rename( self.tmpfn, self.fn )
+
+
+def _dropper( args ):
+    ''' Return a function that tells whether to leave a file out of the
+        catalogue. Uses its own random stream so the tree is not changed.
+    '''
+    rng = random.Random( args.seed + 1 )
+    return lambda: args.missing and rng.random() < args.missing
+
+
+def write_catalog( args, fn ):
+    ''' Write a dar xml listing of the tree. Return number of entries.
+        Only directories that hold a file are listed, same as a dar slice.
+    '''
+    n = 0
+    drop = _dropper( args )
+    cat = CatalogWriter( fn )
+    for e in files( args ):
+        if drop():
+            continue
+        cat.add( e.path, e.size )
+        n += 1
+    cat.close()
+    return n
+
+
+def _write_slice_ini( fn, fields ):
+    tmpfn = fn + '.tmp'
+    with open( tmpfn, 'w' ) as f:
+        f.write( '[DAR]\n' )
+        f.writelines( '{0} = {1}\n'.format( k, v ) for k, v in fields )
+    os.rename( tmpfn, fn )
+
+
+def write_slices( args, infodir, key='BENCH', ts='20170101000000', bkuptype='FULL' ):
+    ''' Split the tree into slices of args.slice_files files and write, for
+        each, what verify_slice and summary read: KEY_TS_TYPE_NNNN.ini,
+        .filelist and .cat.xml. A fake dar that lists the .cat.xml files is
+        written to infodir/fake_dar. Return number of slices.
+    '''
+    os.makedirs( infodir, exist_ok=True )
+    rng = random.Random( args.seed + 2 )
+    drop = _dropper( args )
+    start = 1500000000
+    num = 0
+
+    def close_slice():
+        fnbase = '{0}_{1}_{2}_{3:04d}'.format( key, ts, bkuptype, num )
+        filelist.close()
+        os.rename( filelist.name, os.path.join( infodir, fnbase + '.filelist' ) )
+        cat.close()
+        elapsed = int( 30 + 0.004 * nfiles + 5e-9 * nbytes + rng.gauss( 0, 10 ) )
+        _write_slice_ini( os.path.join( infodir, fnbase + '.ini' ), [
+            ( 'HOSTNAME', 'bench{0}'.format( num % 8 ) ),
+            ( 'FNBASE', fnbase ),
+            ( 'CATBASE', os.path.join( infodir, fnbase + '.cat' ) ),
+            ( 'FILELIST', os.path.join( infodir, fnbase + '.filelist' ) ),
+            ( 'FSROOT', args.fsroot ),
+            ( 'FILES', nfiles ),
+            ( 'BYTES', nbytes ),
+            ( 'PREDICTED_ELAPSED', int( 30 + 0.004 * nfiles + 5e-9 * nbytes ) ),
+            ( 'START', start ),
+            ( 'END', start + max( elapsed, 1 ) ),
+            ( 'ELAPSED', max( elapsed, 1 ) ),
+            ( 'EXITCODE', 0 ),
+        ] )
+
+    filelist = cat = None
+    for e in files( args ):
+        if filelist is None:
+            num += 1
+            nfiles = nbytes = 0
+            filelist = open( os.path.join( infodir, '.slice.filelist.tmp' ), 'wb' )
+            cat = CatalogWriter( os.path.join(
+                infodir, '{0}_{1}_{2}_{3:04d}.cat.xml'.format( key, ts, bkuptype, num ) ) )
+        filelist.write( _fspath( args.fsroot, e.path ) + b'\n' )
+        if not drop():
+            cat.add( e.path, e.size )
+        nfiles += 1
+        nbytes += e.size
+        if nfiles >= args.slice_files:
+            close_slice()
+            filelist = None
+    if filelist is not None:
+        close_slice()
+    fake_dar = os.path.join( infodir, 'fake_dar' )
+    with open( fake_dar, 'w' ) as f:
+        f.write( FAKE_DAR )
+    os.chmod( fake_dar, os.stat( fake_dar ).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH )
+    return num
+
+
+def run():
+    args = process_cmdline()
+    if args.action == 'tree':
+        os.makedirs( args.output, exist_ok=True )
+        n = write_tree( args, args.output )
+    elif args.action == 'filelist':
+        n = write_filelist( args, args.output )
+    elif args.action == 'catalog':
+        n = write_catalog( args, args.output )
+    elif args.action == 'slices':
+        n = write_slices( args, args.output )
+    logr.info( "Wrote {0} {1} to '{2}'".format(
+        n, 'slices' if args.action == 'slices' else 'entries', args.output ) )
+
+
+if __name__ == '__main__':
+    try:
+        run()
+    except ( UserWarning, OSError ) as e:
+        logr.error( e )
+        sys.exit( 1 )
@@ -0,0 +1,370 @@
+#!/usr/bin/python3
+
+import argparse
+import collections
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import gen_fixtures
+
+logr = logging.getLogger()
+console_handler = logging.StreamHandler()
+formatter = logging.Formatter( '%(levelname)s [%(filename)s %(lineno)d] %(message)s' )
+console_handler.setFormatter( formatter )
+logr.addHandler( console_handler )
+logr.setLevel( logging.WARNING )
+
+DESCRIPTION = '''
+    Time the backup pipeline on synthetic inputs (see gen_fixtures.py).
+    Each benchmark runs one of the scripts in bin as its own process and
+    records wall time, peak RSS (of the largest process it ran) and items
+    per second:
+      scan           - scandir.py over a tree of sparse files
+      split          - split_filelist.py --stream on an allfileslist
+      parse          - dar_parse_xml.py on a dar xml listing
+      verify         - verify_slice.py --all, with a fake dar
+      summary        - summary.py -s without its status cache
+      summary_cached - summary.py -s again, with the cache
+    No dar, globus or real data is needed. Fixtures are kept in WORKDIR and
+    reused while the options that shape them stay the same.
+    Results are written as json. With --baseline, each result is compared
+    to the same benchmark in an earlier results file and the exit code is 2
+    if any got slower or bigger by more than THRESHOLD.
+'''
+
+BENCHMARKS = ( 'scan', 'split', 'parse', 'verify', 'summary', 'summary_cached' )
+
+# Trees are real inodes, so the scan is capped unless --tree_entries says otherwise
+TREE_ENTRIES_MAX = 100000
+
+EXIT_REGRESSION = 2
+
+Result = collections.namedtuple( 'Result', 'items wall_secs peak_rss_kb items_per_sec' )
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser( description=DESCRIPTION,
+        formatter_class=argparse.RawDescriptionHelpFormatter )
+    gen_fixtures.add_tree_args( parser )
+    parser.add_argument( '--tree_entries', type=gen_fixtures.parse_count,
+        help='files in the scanned tree (default: min( ENTRIES, {0} ))'.format( TREE_ENTRIES_MAX ) )
+    parser.add_argument( '--slice_files', type=gen_fixtures.parse_count,
+        help='files per slice for verify and summary (default: %(default)s)' )
+    parser.add_argument( '--missing', type=float,
+        help='fraction of files left out of the catalogues (default: %(default)s)' )
+    parser.add_argument( '-b', '--bench', action='append', choices=BENCHMARKS,
+        help='benchmark to run, repeatable (default: all)' )
+    parser.add_argument( '-r', '--repeat', type=int,
+        help='runs of each benchmark, the fastest is kept (default: %(default)s)' )
+    parser.add_argument( '-w', '--workdir',
+        help='where fixtures are kept (default: %(default)s)' )
+    parser.add_argument( '-o', '--outfile',
+        help='write results here (default: bench_<timestamp>.json)' )
+    parser.add_argument( '--baseline', help='results file to compare against' )
+    parser.add_argument( '--threshold', type=float,
+        help='allowed fraction of slowdown or growth over baseline (default: %(default)s)' )
+    parser.add_argument( '--pdbkup_base',
+        help='checkout whose bin is measured (default: PDBKUP_BASE or the parent of this dir)' )
+    parser.add_argument( '-v', '--verbose', action='store_true' )
+    parser.add_argument( '-d', '--debug', action='store_true' )
+    parser.set_defaults(
+        slice_files = 10000,
+        missing = 0.001,
+        repeat = 1,
+        workdir = os.path.join( tempfile.gettempdir(), 'pdbkup_bench' ),
+        threshold = 0.10,
+        pdbkup_base = os.environ.get( 'PDBKUP_BASE',
+            os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) ),
+    )
+    args = parser.parse_args()
+    if args.verbose:
+        logr.setLevel( logging.INFO )
+    if args.debug:
+        logr.setLevel( logging.DEBUG )
+    gen_fixtures.check_args( args )
+    if args.tree_entries is None:
+        args.tree_entries = min( args.entries, TREE_ENTRIES_MAX )
+    if not args.bench:
+        args.bench = list( BENCHMARKS )
+    if args.repeat < 1:
+        raise UserWarning( "repeat must be at least 1" )
+    if not os.path.isfile( os.path.join( args.pdbkup_base, 'bin', 'summary.py' ) ):
+        raise UserWarning( "No pdbkup checkout at '{0}'".format( args.pdbkup_base ) )
+    return args
+
+
+def tree_params( args, entries ):
+    ''' Options that shape a fixture, in a form that can be saved and compared
+    '''
+    return collections.OrderedDict( [
+        ( 'entries', entries ),
+        ( 'seed', args.seed ),
+        ( 'fanout', args.fanout ),
+        ( 'files_per_dir', args.files_per_dir ),
+        ( 'empty_dirs', args.empty_dirs ),
+        ( 'hardlinks', args.hardlinks ),
+        ( 'sizes', args.sizes ),
+        ( 'missing', args.missing ),
+        ( 'slice_files', args.slice_files ),
+    ] )
+
+
+class Fixtures( object ):
+    ''' Generated inputs, made on first use and reused while their params
+        match the stamp file next to them
+    '''
+    STAMP = '.params.json'
+
+    def __init__( self, args ):
+        self.args = args
+        self.workdir = args.workdir
+        os.makedirs( self.workdir, exist_ok=True )
+
+    def get( self, name, entries, make ):
+        ''' Return path of fixture name, calling make( args, path ) to create it
+        '''
+        path = os.path.join( self.workdir, name )
+        stamp = os.path.join( self.workdir, name + self.STAMP )
+        params = tree_params( self.args, entries )
+        try:
+            with open( stamp ) as f:
+                if json.load( f ) == params and os.path.exists( path ):
+                    return path
+        except ( OSError, ValueError ):
+            pass
+        logr.info( "Generating fixture '{0}' ({1} entries)".format( name, entries ) )
+        if os.path.isdir( path ):
+            shutil.rmtree( path )
+        elif os.path.exists( path ):
+            os.remove( path )
+        gen_args = argparse.Namespace( **vars( self.args ) )
+        gen_args.entries = entries
+        gen_args.fsroot = self.fsroot()
+        start = time.time()
+        make( gen_args, path )
+        logr.info( "Generated '{0}' in {1:.1f} secs".format( name, time.time() - start ) )
+        with open( stamp, 'w' ) as f:
+            json.dump( params, f )
+        return path
+
+    def fsroot( self ):
+        ''' Paths in filelists and catalogues are below this (empty) dir,
+            so verify finds none of the missing ones to be directories
+        '''
+        path = os.path.join( self.workdir, 'fsroot' )
+        os.makedirs( path, exist_ok=True )
+        return path
+
+    def tree( self ):
+        def make( gen_args, path ):
+            os.makedirs( path )
+            gen_fixtures.write_tree( gen_args, path )
+        return self.get( 'tree', self.args.tree_entries, make )
+
+    def filelist( self ):
+        return self.get( 'allfileslist', self.args.entries, gen_fixtures.write_filelist )
+
+    def catalog( self ):
+        return self.get( 'catalog.xml', self.args.entries, gen_fixtures.write_catalog )
+
+    def slices( self ):
+        return self.get( 'infodir', self.args.entries, gen_fixtures.write_slices )
+
+
+def measure( cmd, env=None, ok_codes=( 0, ) ):
+    ''' Run cmd, return tuple of ( wall secs, peak rss in KiB ).
+        The rss is the largest of cmd and the children it waited for.
+    '''
+    logr.debug( ' '.join( cmd ) )
+    start = time.perf_counter()
+    proc = subprocess.Popen( cmd, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL )
+    pid, status, rusage = os.wait4( proc.pid, 0 )
+    wall = time.perf_counter() - start
+    # keep Popen from waiting on a pid that is gone
+    proc.returncode = os.WEXITSTATUS( status ) if os.WIFEXITED( status ) else -1
+    if proc.returncode not in ok_codes:
+        raise UserWarning( "'{0}' exited with code {1}".format( ' '.join( cmd ), proc.returncode ) )
+    return ( wall, rusage.ru_maxrss )
+
+
+def count_lines( fn ):
+    with open( fn, 'rb' ) as f:
+        return sum( 1 for line in f )
+
+
+class Bench( object ):
+    ''' Builds the command line of each benchmark
+    '''
+    def __init__( self, args, fixtures ):
+        self.args = args
+        self.fixtures = fixtures
+        self.bindir = os.path.join( args.pdbkup_base, 'bin' )
+        self.env = dict( os.environ, PDBKUP_BASE=args.pdbkup_base )
+        self.scratch = os.path.join( args.workdir, 'scratch' )
+
+    def _py( self, script, *opts ):
+        return [ sys.executable, os.path.join( self.bindir, script ) ] + list( opts )
+
+    def _scratch( self ):
+        ''' Return an empty dir for output, so no run resumes an earlier one
+        '''
+        if os.path.isdir( self.scratch ):
+            shutil.rmtree( self.scratch )
+        os.makedirs( self.scratch )
+        return self.scratch
+
+    def _slices( self ):
+        infodir = self.fixtures.slices()
+        ntotal = sum( count_lines( os.path.join( infodir, fn ) )
+                      for fn in os.listdir( infodir ) if fn.endswith( '.filelist' ) )
+        nslices = len( [ fn for fn in os.listdir( infodir ) if fn.endswith( '.ini' ) ] )
+        return ( infodir, ntotal, nslices )
+
+    def scan( self ):
+        tree = self.fixtures.tree()
+        cmd = self._py( 'scandir.py', tree, self._scratch() )
+        wall, rss = measure( cmd )
+        return ( count_lines( os.path.join( self.scratch, 'scandir.out' ) ), wall, rss )
+
+    def split( self ):
+        filelist = self.fixtures.filelist()
+        cmd = self._py( 'split_filelist.py', '-0', '--stream',
+                        '--size_max', str( 10 * 1024**3 ),
+                        '--numfiles_max', str( self.args.slice_files * 10 ),
+                        '--outdir', self._scratch(), filelist )
+        wall, rss = measure( cmd )
+        return ( self.args.entries, wall, rss )
+
+    def parse( self ):
+        catalog = self.fixtures.catalog()
+        cmd = self._py( 'dar_parse_xml.py', '-f', self.fixtures.fsroot(),
+                        '-o', os.devnull, catalog )
+        wall, rss = measure( cmd )
+        return ( self.args.entries, wall, rss )
+
+    def verify( self ):
+        infodir, ntotal, nslices = self._slices()
+        cmd = self._py( 'verify_slice.py', '--all',
+                        '--dar_cmd', os.path.join( infodir, 'fake_dar' ), infodir )
+        # files were left out of the catalogues on purpose
+        wall, rss = measure( cmd, ok_codes=( 0, 1 ) )
+        return ( ntotal, wall, rss )
+
+    def summary( self ):
+        infodir, ntotal, nslices = self._slices()
+        cache = os.path.join( infodir, '.summary.cache' )
+        if os.path.exists( cache ):
+            os.remove( cache )
+        wall, rss = measure( self._py( 'summary.py', '-s', infodir ), env=self.env )
+        return ( nslices, wall, rss )
+
+    def summary_cached( self ):
+        infodir, ntotal, nslices = self._slices()
+        if not os.path.exists( os.path.join( infodir, '.summary.cache' ) ):
+            measure( self._py( 'summary.py', '-s', infodir ), env=self.env )
+        wall, rss = measure( self._py( 'summary.py', '-s', infodir ), env=self.env )
+        return ( nslices, wall, rss )
+
+    def run( self, name ):
+        ''' Return Result of the fastest of args.repeat runs
+        '''
+        best = None
+        for i in range( self.args.repeat ):
+            items, wall, rss = getattr( self, name )()
+            logr.info( "{0}: {1} items, {2:.2f} secs, {3} KiB".format( name, items, wall, rss ) )
+            if best is None or wall < best[1]:
+                best = ( items, wall, rss )
+        items, wall, rss = best
+        return Result( items, round( wall, 3 ), rss, round( items / wall, 1 ) if wall else None )
+
+
+def git_commit( base ):
+    try:
+        return subprocess.check_output( [ 'git', '-C', base, 'rev-parse', 'HEAD' ],
+            stderr=subprocess.DEVNULL, universal_newlines=True ).strip()
+    except ( OSError, subprocess.CalledProcessError ):
+        return None
+
+
+def compare( results, baseline, threshold ):
+    ''' Print each result next to the baseline. Return names of benchmarks
+        that got slower or bigger by more than threshold.
+    '''
+    if baseline[ 'params' ] != results[ 'params' ]:
+        logr.warning( "Baseline was made with other fixture params, results are not comparable" )
+    fmt = '{0:15s} {1:>10s} {2:>10s} {3:>8s} {4:>12s} {5:>12s} {6:>8s} {7}'
+    print( fmt.format( 'BENCH', 'BASE_SECS', 'SECS', 'RATIO', 'BASE_RSS_KB', 'RSS_KB', 'RATIO', '' ) )
+    regressed = []
+    for name, cur in results[ 'results' ].items():
+        base = baseline[ 'results' ].get( name )
+        if base is None:
+            print( fmt.format( name, '-', '{0:.2f}'.format( cur[ 'wall_secs' ] ), '-',
+                               '-', str( cur[ 'peak_rss_kb' ] ), '-', 'NEW' ) )
+            continue
+        t_ratio = cur[ 'wall_secs' ] / base[ 'wall_secs' ] if base[ 'wall_secs' ] else 1.0
+        m_ratio = cur[ 'peak_rss_kb' ] / base[ 'peak_rss_kb' ] if base[ 'peak_rss_kb' ] else 1.0
+        flag = ''
+        if max( t_ratio, m_ratio ) > 1.0 + threshold:
+            flag = 'REGRESSION'
+            regressed.append( name )
+        elif min( t_ratio, m_ratio ) < 1.0 - threshold:
+            flag = 'IMPROVED'
+        print( fmt.format( name,
+            '{0:.2f}'.format( base[ 'wall_secs' ] ), '{0:.2f}'.format( cur[ 'wall_secs' ] ),
+            '{0:.2f}'.format( t_ratio ),
+            str( base[ 'peak_rss_kb' ] ), str( cur[ 'peak_rss_kb' ] ),
+            '{0:.2f}'.format( m_ratio ), flag ) )
+    return regressed
+
+
+def run():
+    args = process_cmdline()
+    bench = Bench( args, Fixtures( args ) )
+    now = datetime.datetime.now()
+    results = collections.OrderedDict( [
+        ( 'date', now.isoformat( timespec='seconds' ) ),
+        ( 'host', platform.node() ),
+        ( 'cpus', os.cpu_count() ),
+        ( 'python', platform.python_version() ),
+        ( 'commit', git_commit( args.pdbkup_base ) ),
+        ( 'params', tree_params( args, args.entries ) ),
+        ( 'tree_entries', args.tree_entries ),
+        ( 'results', collections.OrderedDict() ),
+    ] )
+    for name in args.bench:
+        r = bench.run( name )
+        results[ 'results' ][ name ] = r._asdict()
+        print( '{0:15s} {1:>10d} items {2:>10.2f} secs {3:>12.1f} items/sec {4:>10d} KiB'.format(
+            name, r.items, r.wall_secs, r.items_per_sec or 0.0, r.peak_rss_kb ) )
+    outfile = args.outfile or 'bench_{0}.json'.format( now.strftime( '%Y%m%d_%H%M%S' ) )
+    tmpfn = outfile + '.tmp'
+    with open( tmpfn, 'w' ) as f:
+        json.dump( results, f, indent=2 )
+        f.write( '\n' )
+    os.rename( tmpfn, outfile )
+    print( "Results saved to '{0}'".format( outfile ) )
+    if args.baseline:
+        with open( args.baseline ) as f:
+            baseline = json.load( f )
+        # json has no OrderedDict, compare as plain values
+        results = json.loads( json.dumps( results ) )
+        regressed = compare( results, baseline, args.threshold )
+        if regressed:
+            logr.warning( "Regressions: {0}".format( ', '.join( regressed ) ) )
+            sys.exit( EXIT_REGRESSION )
+
+
+if __name__ == '__main__':
+    try:
+        run()
+    except ( UserWarning, OSError ) as e:
+        logr.error( e )
+        sys.exit( 1 )
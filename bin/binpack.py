@@ -1,24 +1,49 @@
+import collections
+import os
+import random
+
+
+STRATEGIES = ( 'first-fit', 'best-fit', 'first-fit-decreasing', 'locality' )
+
+# Summary of a closed bin, cheap to keep after the bin itself is discarded
+BinStats = collections.namedtuple( 'BinStats', 'size length maxsize key cost' )
+
+
 class Bin( object ):
-    ''' Container for File objects that tracks cumulative size and file count
+    ''' Container for File objects that tracks cumulative size and file count.
+        Optionally also tracks cost, file_cost per file plus byte_cost per byte
+        (ie: predicted dar runtime, see runtime_model.py), capped at maxcost.
     '''
-    def __init__( self, 
-                  maxsize=107374182400, 
-                  maxcount=1073741824, 
+    __slots__ = ( 'items', 'size', 'nfiles', 'maxsize', 'maxcount', 'allow_oversized',
+                  'fill_percent', 'cost', 'maxcost', 'file_cost', 'byte_cost' )
+
+    def __init__( self,
+                  maxsize=107374182400,
+                  maxcount=1073741824,
                   fill_percent=90,
-                  allow_oversized=True ):
+                  allow_oversized=True,
+                  maxcost=None,
+                  file_cost=0.0,
+                  byte_cost=0.0 ):
         self.items = []
         self.size = 0
+        # paths in the bin, more than len( items ) if it holds Hardlinks
+        self.nfiles = 0
         self.maxsize = maxsize
         self.maxcount = maxcount
-        # Allow bin to hold a single item that is larger than maxsize 
+        self.cost = 0.0
+        self.maxcost = maxcost
+        self.file_cost = file_cost
+        self.byte_cost = byte_cost
+        # Allow bin to hold a single item that is larger than maxsize
         # iff that is the only item in the bin
         self.allow_oversized = allow_oversized
         self.fill_percent = fill_percent / 100.0
 
     def __str__( self ):
         return "<{C} (len:{L} size:{S} %:{P})>".format(
-            C=self.__class__.__name__, 
-            L=len( self.items ), 
+            C=self.__class__.__name__,
+            L=len( self.items ),
             S=self.size,
             P=self.fill_percent
         )
@@ -30,8 +55,7 @@ class Bin( object ):
             Return True if item was inserted in the bin successfully, False otherwise
         '''
         can_fit = False
-        newsize = item.size + self.size
-        if newsize <= self.maxsize and len( self.items ) < self.maxcount:
+        if item.size <= self.remaining( item.nfiles ) and self.nfiles + item.nfiles <= self.maxcount:
             can_fit = True
         elif self.allow_oversized and len( self.items ) == 0:
             #enable oversize
@@ -39,30 +63,362 @@ class Bin( object ):
             can_fit = True
         if can_fit:
             self.items.append( item )
-            self.size = newsize
+            self.size += item.size
+            self.nfiles += item.nfiles
+            if self.maxcost is not None:
+                self.cost += self.file_cost * item.nfiles + self.byte_cost * item.size
         return can_fit
 
     def __iter__( self ):
         return iter( self.items )
 
+    def __len__( self ):
+        return self.nfiles
+
+    def filenames( self ):
+        ''' Generate the path of every file in the bin
+        '''
+        for item in self.items:
+            yield from item.filenames()
+
+    def remaining( self, nfiles=1 ):
+        ''' Size, in bytes, of the largest item that can still be added to this
+            bin. With a cost cap, cost is linear in size so it is just one more
+            limit on size, and the bin indexes below need no other dimension.
+            Return -1 if not even an empty file fits.
+            The bin indexes assume items of one file; an item of nfiles files
+            must also fit remaining( nfiles ), which Bin.insert checks.
+        '''
+        rv = self.maxsize - self.size
+        if self.maxcost is not None:
+            left = self.maxcost - self.cost - self.file_cost * nfiles
+            if left < 0:
+                return -1
+            if self.byte_cost > 0:
+                rv = min( rv, int( left / self.byte_cost ) )
+        return rv
+
     def is_full( self ):
         rv = False
-        if len( self.items ) >= self.maxcount:
+        if self.nfiles >= self.maxcount:
             rv = True
         elif self.size >= ( self.maxsize * self.fill_percent ):
             rv = True
+        elif self.maxcost is not None and self.cost >= ( self.maxcost * self.fill_percent ):
+            rv = True
         return rv
 
 
 class File( object ):
     ''' Representation of a file containing absolute path and size in bytes.
+        Filename may be str or bytes.
     '''
+    __slots__ = ( 'filename', 'size' )
+
+    # paths held by this item
+    nfiles = 1
+
     def __init__( self, filename, size ):
         self.filename = filename
         self.size = size
 
+    def filenames( self ):
+        return ( self.filename, )
+
     def __str__( self ):
+        if isinstance( self.filename, bytes ):
+            return os.fsdecode( self.filename )
         return self.filename
 
     def __repr__( self ):
         return "{0}.File({1}, {2})".format( __name__, self.filename, self.size )
+
+
+class Hardlinks( File ):
+    ''' All paths of one multiply-linked inode, packed as a single item so
+        they land in the same bin (dar archives the data once and restores
+        the links). Size is the size of the inode, counted once.
+    '''
+    __slots__ = ( 'links', )
+
+    def __init__( self, filename, size, links=None ):
+        super().__init__( filename, size )
+        self.links = links or []
+
+    @property
+    def nfiles( self ):
+        return 1 + len( self.links )
+
+    def filenames( self ):
+        return [ self.filename ] + self.links
+
+    def __repr__( self ):
+        return "{0}.Hardlinks({1}, {2}, {3})".format( __name__, self.filename, self.size, self.links )
+
+
+class FirstFitIndex( object ):
+    ''' Segment tree over open bins (in creation order) keyed on remaining size.
+        Finds the oldest bin that can hold an item in O(log bins).
+    '''
+    def __init__( self ):
+        self.capacity = 1
+        self.tree = [ -1, -1 ]
+        self.num_leaves = 0
+
+    def _grow( self ):
+        leaves = self.tree[ self.capacity: ]
+        self.capacity *= 2
+        self.tree = [ -1 ] * ( 2 * self.capacity )
+        self.tree[ self.capacity:self.capacity + len( leaves ) ] = leaves
+        for i in range( self.capacity - 1, 0, -1 ):
+            self.tree[ i ] = max( self.tree[ 2 * i ], self.tree[ 2 * i + 1 ] )
+
+    def append( self, remaining ):
+        ''' Add a new leaf, return its position
+        '''
+        if self.num_leaves >= self.capacity:
+            self._grow()
+        pos = self.num_leaves
+        self.num_leaves += 1
+        self.update( pos, remaining )
+        return pos
+
+    def update( self, pos, remaining ):
+        ''' Set remaining size of leaf at pos (use -1 to mark a closed bin)
+        '''
+        tree = self.tree
+        i = pos + self.capacity
+        tree[ i ] = remaining
+        i //= 2
+        while i >= 1:
+            newval = max( tree[ 2 * i ], tree[ 2 * i + 1 ] )
+            if tree[ i ] == newval:
+                break
+            tree[ i ] = newval
+            i //= 2
+
+    def find( self, size ):
+        ''' Return position of the leftmost leaf with remaining >= size,
+            or None if no such leaf exists
+        '''
+        tree = self.tree
+        if tree[ 1 ] < size:
+            return None
+        i = 1
+        while i < self.capacity:
+            i *= 2
+            if tree[ i ] < size:
+                i += 1
+        return i - self.capacity
+
+
+class _TreapNode( object ):
+    __slots__ = ( 'key', 'prio', 'left', 'right' )
+
+    def __init__( self, key, prio ):
+        self.key = key
+        self.prio = prio
+        self.left = None
+        self.right = None
+
+
+def _split( node, key ):
+    ''' Split a treap into ( keys < key, keys >= key )
+    '''
+    if node is None:
+        return ( None, None )
+    if node.key < key:
+        node.right, right = _split( node.right, key )
+        return ( node, right )
+    left, node.left = _split( node.left, key )
+    return ( left, node )
+
+
+def _merge( left, right ):
+    ''' Join two treaps, every key of left is less than every key of right
+    '''
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.prio > right.prio:
+        left.right = _merge( left.right, right )
+        return left
+    right.left = _merge( left, right.left )
+    return right
+
+
+class BestFitIndex( object ):
+    ''' Treap (randomized balanced search tree) of ( remaining size, position )
+        for open bins. Finds the open bin with the least remaining size that
+        can hold an item, ties going to the oldest, in O(log bins).
+    '''
+    def __init__( self ):
+        self.root = None
+        self.keys = {}
+        self.num_leaves = 0
+        # the tree shape depends on these, the bin found does not
+        self.rnd = random.Random( 0 )
+
+    def append( self, remaining ):
+        pos = self.num_leaves
+        self.num_leaves += 1
+        self.update( pos, remaining )
+        return pos
+
+    def update( self, pos, remaining ):
+        old = self.keys.pop( pos, None )
+        if old is not None:
+            left, right = _split( self.root, old )
+            mid, right = _split( right, ( old[0], old[1] + 1 ) )
+            self.root = _merge( left, right )
+        if remaining >= 0:
+            key = ( remaining, pos )
+            left, right = _split( self.root, key )
+            self.root = _merge( _merge( left, _TreapNode( key, self.rnd.random() ) ), right )
+            self.keys[ pos ] = key
+
+    def find( self, size ):
+        node = self.root
+        best = None
+        while node is not None:
+            if node.key[0] >= size:
+                best = node.key[1]
+                node = node.left
+            else:
+                node = node.right
+        return best
+
+
+class NextFitIndex( object ):
+    ''' Only the most recently opened bin accepts new items.
+        Given input sorted by path, this keeps directory subtrees together.
+    '''
+    def __init__( self ):
+        self.open = {}
+        self.num_leaves = 0
+
+    def append( self, remaining ):
+        pos = self.num_leaves
+        self.num_leaves += 1
+        self.update( pos, remaining )
+        return pos
+
+    def update( self, pos, remaining ):
+        if remaining < 0:
+            self.open.pop( pos, None )
+        else:
+            self.open[ pos ] = remaining
+
+    def find( self, size ):
+        if not self.open:
+            return None
+        pos = max( self.open )
+        if self.open[ pos ] >= size:
+            return pos
+        return None
+
+
+class Packer( object ):
+    ''' Assign items to Bins using one of STRATEGIES.
+        Open bins are indexed by remaining capacity so each insert costs
+        O(log bins) instead of a scan over every open bin.
+        A bin is closed as soon as it is full (see Bin.is_full) and is then
+        handed to on_close( key, bin ) and never considered again.
+    '''
+    def __init__( self,
+                  strategy='first-fit',
+                  on_close=None,
+                  mk_key=None,
+                  **bin_opts ):
+        if strategy not in STRATEGIES:
+            raise UserWarning( "Unknown packing strategy '{0}'".format( strategy ) )
+        self.strategy = strategy
+        self.bin_opts = bin_opts
+        self.on_close = on_close
+        self.mk_key = mk_key
+        if strategy == 'best-fit':
+            self.index = BestFitIndex()
+        elif strategy == 'locality':
+            self.index = NextFitIndex()
+        else:
+            self.index = FirstFitIndex()
+        self.open_bins = {}
+        self.closed_bins = {}
+        self.pending = []
+        self.bincount = 0
+
+    def __str__( self ):
+        return "<{C} ({S} open:{O} closed:{D})>".format(
+            C=self.__class__.__name__,
+            S=self.strategy,
+            O=len( self.open_bins ),
+            D=len( self.closed_bins ) )
+    __repr__ = __str__
+
+    def __getstate__( self ):
+        # callbacks are usually closures, the owner must set them again after unpickling
+        state = self.__dict__.copy()
+        state[ 'on_close' ] = None
+        state[ 'mk_key' ] = None
+        return state
+
+    def add( self, item ):
+        ''' Pack item into a bin.
+            For first-fit-decreasing, items are held until finish() is called.
+        '''
+        if self.strategy == 'first-fit-decreasing':
+            self.pending.append( item )
+        else:
+            self._place( item )
+
+    def finish( self ):
+        ''' Pack any held items, then close all remaining open bins.
+            Return dict of all closed bins
+        '''
+        if self.pending:
+            self.pending.sort( key=lambda x: x.size, reverse=True )
+            for item in self.pending:
+                self._place( item )
+            self.pending = []
+        for pos in list( self.open_bins.keys() ):
+            self._close( pos )
+        return self.closed_bins
+
+    def _new_bin( self ):
+        newbin = Bin( **self.bin_opts )
+        pos = self.index.append( newbin.remaining() )
+        if self.mk_key:
+            key = self.mk_key( self.bincount )
+        else:
+            key = self.bincount
+        self.bincount += 1
+        self.open_bins[ pos ] = ( key, newbin )
+        return pos
+
+    def _place( self, item ):
+        pos = self.index.find( item.size )
+        # the index only knows sizes, Hardlinks may still be too many files
+        if pos is not None and not self.open_bins[ pos ][ 1 ].insert( item ):
+            pos = None
+        if pos is None:
+            if self.strategy == 'locality':
+                # bins hold contiguous runs of the input, never revisit them
+                for openpos in list( self.open_bins.keys() ):
+                    self._close( openpos )
+            pos = self._new_bin()
+            if not self.open_bins[ pos ][ 1 ].insert( item ):
+                raise UserWarning( 'Failed to insert item into bin: {0}'.format( item ) )
+        key, bin = self.open_bins[ pos ]
+        if bin.is_full():
+            self._close( pos )
+        else:
+            self.index.update( pos, bin.remaining() )
+
+    def _close( self, pos ):
+        key, bin = self.open_bins.pop( pos )
+        self.index.update( pos, -1 )
+        if self.on_close:
+            self.on_close( key, bin )
+        else:
+            self.closed_bins[ key ] = bin
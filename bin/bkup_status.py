@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+
+import abc
+import argparse
+import bisect
+import datetime
+import json
+import logging
+import os
+import pathlib
+import subprocess
+import time
+
+import summary
+
+logr = logging.getLogger()
+# history.py imports this module and sets up its own handler
+if __name__ == '__main__':
+    console_handler = logging.StreamHandler()
+    formatter = logging.Formatter( '%(levelname)s [%(filename)s %(lineno)d] %(message)s' )
+    console_handler.setFormatter( formatter )
+    logr.addHandler( console_handler )
+    logr.setLevel( logging.WARNING )
+
+DESCRIPTION = '''
+    List all known backups with their status (bkup ls).
+    Each DATADIR state directory is read once for all backups, slice results
+    come from the per-infodir status cache (see summary.py) and remote
+    listings are cached for --ttl seconds.
+    Backups whose last_status is COMPLETE or a FAIL are not checked again.
+'''
+
+HEADER = ( 'BKUP_DIR', 'DATE', 'TIME', 'TYPE', 'STATUS' )
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser( description=DESCRIPTION )
+    parser.add_argument( '--ttl', type=int,
+        help=( 'Seconds to reuse a remote directory listing '
+               '(default: GLOBUS::LS_CACHE_TTL or %(default)s)' ) )
+    parser.add_argument( '--remote_dir',
+        help=( 'Local directory that stands in for the remote endpoint, '
+               'instead of using the globus cli' ) )
+    parser.add_argument( '-v', '--verbose', action='store_true' )
+    parser.add_argument( '-d', '--debug', action='store_true' )
+    parser.set_defaults(
+        ttl = None,
+    )
+    args = parser.parse_args()
+    if args.verbose:
+        logr.setLevel( logging.INFO )
+    if args.debug:
+        logr.setLevel( logging.DEBUG )
+    return args
+
+
+class RemoteLister( abc.ABC ):
+    ''' Lists directories on the long term storage side
+    '''
+    @abc.abstractmethod
+    def listdir( self, path ):
+        ''' Return list of names in path.
+            Raise OSError if path cannot be listed.
+        '''
+
+
+class GlobusLister( RemoteLister ):
+    def __init__( self, cli, endpoint ):
+        self.cli = cli
+        self.endpoint = endpoint
+
+    def listdir( self, path ):
+        cmd = [ self.cli, 'ls', '{0}:{1}'.format( self.endpoint, path ) ]
+        proc = subprocess.run( cmd,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL,
+                               universal_newlines=True )
+        if proc.returncode != 0:
+            raise OSError( "'{0}' exited with code {1}".format( ' '.join( cmd ), proc.returncode ) )
+        return [ line.strip() for line in proc.stdout.splitlines() if line.strip() ]
+
+
+class LocalLister( RemoteLister ):
+    ''' A local directory standing in for the remote endpoint
+    '''
+    def __init__( self, basedir ):
+        self.basedir = basedir
+
+    def listdir( self, path ):
+        return os.listdir( os.path.join( self.basedir, path.lstrip( '/' ) ) )
+
+
+class CachedLister( RemoteLister ):
+    ''' Reuse listings of another lister for ttl seconds.
+        Listings are kept in cachefile so they survive between runs.
+        Failed listings are not cached.
+    '''
+    def __init__( self, lister, ttl, cachefile=None ):
+        self.lister = lister
+        self.ttl = ttl
+        self.cachefile = cachefile
+        self.entries = {}
+        self.dirty = False
+        if cachefile and os.path.exists( cachefile ):
+            try:
+                with open( cachefile ) as f:
+                    self.entries = json.load( f )
+            except ( OSError, ValueError ) as e:
+                logr.warning( "Ignoring unreadable cache '{0}': {1}".format( cachefile, e ) )
+
+    def listdir( self, path ):
+        entry = self.entries.get( path )
+        if entry and time.time() - entry[0] < self.ttl:
+            logr.debug( "Cached listing of '{0}'".format( path ) )
+            return entry[1]
+        names = self.lister.listdir( path )
+        self.entries[ path ] = [ time.time(), names ]
+        self.dirty = True
+        return names
+
+    def save( self ):
+        if not ( self.cachefile and self.dirty ):
+            return
+        now = time.time()
+        self.entries = { k: v for k, v in self.entries.items() if now - v[0] < self.ttl }
+        tmpfn = self.cachefile + '.tmp'
+        try:
+            with open( tmpfn, 'w' ) as f:
+                json.dump( self.entries, f )
+            os.rename( tmpfn, self.cachefile )
+        except OSError as e:
+            logr.warning( "Unable to save cache '{0}': {1}".format( self.cachefile, e ) )
+
+
+class DataDirIndex( object ):
+    ''' Sorted names of everything below each of a set of DATADIR state
+        directories, read once. Files belonging to a backup all start with
+        "KEY_TIMESTAMP", so counting them is a pair of bisects.
+    '''
+    def __init__( self, dirs ):
+        self.names = {}
+        for label, path in dirs.items():
+            names = []
+            for root, dirnames, filenames in os.walk( path ):
+                names.extend( dirnames )
+                names.extend( filenames )
+            names.sort()
+            self.names[ label ] = names
+            logr.debug( "Indexed {0} names in '{1}'".format( len( names ), path ) )
+
+    def count( self, label, prefix ):
+        names = self.names[ label ]
+        return ( bisect.bisect_left( names, prefix + '\U0010ffff' )
+                 - bisect.bisect_left( names, prefix ) )
+
+
+def datadir_path( cfg, section, key ):
+    ''' State directories are relative to GENERAL::DATADIR unless absolute
+    '''
+    return os.path.join( cfg[ 'GENERAL' ][ 'DATADIR' ], cfg[ section ][ key ] )
+
+
+def all_bkup_dirs( cfg ):
+    ''' Generate ( key, infodir ) for old (annal) and current backups of every DIRKEY
+    '''
+    infodir = cfg[ 'GENERAL' ][ 'INFODIR' ]
+    annaldir = cfg[ 'GENERAL' ].get( 'ANNALDIR', '' )
+    for key in cfg[ 'DIRS' ]:
+        bases = [ os.path.join( infodir, key ) ]
+        if annaldir:
+            bases.insert( 0, os.path.realpath(
+                '{0}/{1}/{2}'.format( annaldir, infodir, key ) ) )
+        for base in bases:
+            if not os.path.isdir( base ):
+                continue
+            for d in sorted( e.path for e in os.scandir( base ) if e.is_dir() ):
+                yield ( key, d )
+
+
+def archive_status( bkupdir, key_ts, index ):
+    ''' Return one of IN-PROGRESS, COMPLETE, FAILURES-DETECTED, EMPTY, UNKNOWN
+    '''
+    exit_codes = [ s.exitcode for s in bkupdir.slices.values() if s.exitcode is not None ]
+    err_count = index.count( 'DAR_ERR', key_ts )
+    expected = bkupdir.num_dar_optfiles
+    if max( exit_codes + [ err_count ] ) > 0:
+        return 'FAILURES-DETECTED'
+    elif expected < 1:
+        return 'EMPTY'
+    elif len( exit_codes ) < expected:
+        return 'IN-PROGRESS'
+    elif len( exit_codes ) == expected:
+        return 'COMPLETE'
+    return 'UNKNOWN'
+
+
+def transfer_status( key, ts, index, lister, remote_basedir ):
+    ''' Return one of IN-PROGRESS, COMPLETE, FAILURES-DETECTED, PENDING, UNKNOWN
+    '''
+    key_ts = '{0}_{1}'.format( key, ts )
+    if index.count( 'TXFR_ERR', key_ts ) > 0:
+        return 'FAILURES-DETECTED'
+    elif index.count( 'TXFR_WORK', key_ts ) > 0:
+        return 'IN-PROGRESS'
+    elif index.count( 'TXFR_READY', key_ts ) > 0:
+        return 'PENDING'
+    # nothing left locally, done once the infodir archive is on the remote side
+    info_fn = '{0}_INFO.1.dar'.format( key_ts )
+    try:
+        names = lister.listdir( '{0}/{1}/{2}'.format( remote_basedir, key, ts ) )
+    except OSError as e:
+        logr.debug( e )
+        names = []
+    if sum( 1 for n in names if info_fn in n ) == 1:
+        return 'COMPLETE'
+    return 'UNKNOWN'
+
+
+def bkup_type( infodir ):
+    for name in os.listdir( infodir ):
+        if name.startswith( 'allfileslist.' ):
+            return name.split( '.', 1 )[1]
+    return 'FULL?'
+
+
+def bkup_status( key, infodir, index, lister, remote_basedir ):
+    ''' Return status of a backup, updating its last_status file
+    '''
+    status_file = os.path.join( infodir, 'last_status' )
+    last_status = 'UNKNOWN'
+    if os.path.exists( status_file ):
+        with open( status_file ) as f:
+            last_status = f.readline().strip()
+    logr.debug( "'{0}': last_status = '{1}'".format( infodir, last_status ) )
+    if 'FAIL' in last_status or last_status == 'COMPLETE':
+        return last_status
+    ts = os.path.basename( infodir )
+    bkupdir = summary.BkupDir( pathlib.Path( infodir ) )
+    arch_status = archive_status( bkupdir, '{0}_{1}'.format( key, ts ), index )
+    status = 'ARCHIVE({0})'.format( arch_status )
+    if arch_status == 'COMPLETE':
+        txfr_status = transfer_status( key, ts, index, lister, remote_basedir )
+        status = 'TRANSFER({0})'.format( txfr_status )
+        if txfr_status == 'COMPLETE':
+            status = 'COMPLETE'
+    with open( status_file, 'w' ) as f:
+        f.write( status + '\n' )
+    return status
+
+
+def print_table( rows ):
+    ''' Same layout as "column -t" '''
+    widths = [ max( len( r[ i ] ) for r in rows ) for i in range( len( rows[0] ) ) ]
+    for r in rows:
+        print( '  '.join( [ v.ljust( w ) for v, w in zip( r[:-1], widths ) ] + [ r[-1] ] ) )
+
+
+def run():
+    args = process_cmdline()
+    cfg = summary.load_cfg()
+    index = DataDirIndex( {
+        'DAR_ERR': datadir_path( cfg, 'DAR', 'ERRDIR' ),
+        'TXFR_READY': datadir_path( cfg, 'TXFR', 'SRCDIR_OUTBOUND' ),
+        'TXFR_WORK': datadir_path( cfg, 'TXFR', 'WORKDIR_OUTBOUND' ),
+        'TXFR_ERR': datadir_path( cfg, 'TXFR', 'ERRDIR_OUTBOUND' ),
+    } )
+    globus = cfg[ 'GLOBUS' ]
+    if args.remote_dir:
+        remote = LocalLister( args.remote_dir )
+    else:
+        remote = GlobusLister( globus[ 'CLI' ], globus[ 'ENDPOINT_REMOTE' ] )
+    ttl = args.ttl
+    if ttl is None:
+        ttl = int( globus.get( 'LS_CACHE_TTL', 600 ) )
+    lister = CachedLister( remote, ttl,
+        os.path.join( cfg[ 'GENERAL' ][ 'INFODIR' ], '.remote_ls.cache' ) )
+    rows = []
+    for key, infodir in all_bkup_dirs( cfg ):
+        logr.debug( "checking '{0}'".format( infodir ) )
+        ts = os.path.basename( infodir )
+        try:
+            dt = datetime.datetime.fromtimestamp( int( ts ) )
+        except ValueError:
+            logr.warning( "Skipping '{0}', not a timestamp".format( infodir ) )
+            continue
+        status = bkup_status( key, infodir, index, lister, globus[ 'BASEDIR_REMOTE' ] )
+        rows.append( ( infodir,
+                       dt.strftime( '%Y-%m-%d' ),
+                       dt.strftime( '%H:%M:%S' ),
+                       bkup_type( infodir ),
+                       status ) )
+    lister.save()
+    rows.sort( key=lambda r: ( r[1], r[2], r[0] ) )
+    print_table( [ HEADER ] + rows )
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+
+import argparse
+import bz2
+import collections
+import concurrent.futures
+import logging
+import lzma
+import os
+import random
+import sys
+import time
+import zlib
+
+import summary
+import throttle
+
+logr = logging.getLogger()
+console_handler = logging.StreamHandler()
+formatter = logging.Formatter( '%(levelname)s [%(filename)s %(lineno)d] %(message)s' )
+console_handler.setFormatter( formatter )
+logr.addHandler( console_handler )
+logr.setLevel( logging.WARNING )
+
+DESCRIPTION = '''
+    Choose the dar compression of each new slice from a sample of its data.
+    For each bin of BINSFILE (see split_filelist.py --bins) a few blocks of
+    some of the files in INFODIR/KEY.filelist are compressed in memory. Files
+    are picked with probability proportional to their size (from KEY.sizes),
+    so the mean ratio of compressed to sampled bytes estimates the ratio of
+    the whole slice.
+    A slice is compressed with ALGO:LEVEL if that saves at least MIN_SAVING of
+    its bytes. Extensions in --exclude, and extensions whose samples do not
+    compress, are left uncompressed (dar -Z).
+    Prints "KEY RATIO EST_BYTES COMPRESSION EXCLUDES" for each bin, where
+    COMPRESSION is ALGO:LEVEL or none and EXCLUDES is a comma separated list
+    of extensions or -.
+    zstd, lz4 and lzo are estimated with zlib at a similar effort.
+'''
+
+ALGOS = ( 'gzip', 'bzip2', 'xz', 'zstd', 'lz4', 'lzo' )
+
+# Default compression level of each algorithm
+DEFAULT_LEVELS = { 'gzip': 6, 'bzip2': 9, 'xz': 6, 'zstd': 3, 'lz4': 1, 'lzo': 1 }
+
+# Samples of an extension that keep more than this of their size do not compress
+INCOMPRESSIBLE = 0.95
+
+# Extensions are only used for -Z if they look like one
+MAX_EXT_LEN = 8
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser( description=DESCRIPTION,
+        formatter_class=argparse.RawDescriptionHelpFormatter )
+    parser.add_argument( 'infodir' )
+    parser.add_argument( 'binsfile', type=argparse.FileType( 'r' ) )
+    parser.add_argument( '-c', '--compression', required=True,
+        help='ALGO[:LEVEL] to use for slices that compress, one of {0}'.format( ', '.join( ALGOS ) ) )
+    parser.add_argument( '-m', '--min_saving', type=float,
+        help='fraction of bytes compression must save (default: %(default)s)' )
+    parser.add_argument( '-x', '--exclude',
+        help='space separated extensions never compressed (default: none)' )
+    parser.add_argument( '-f', '--files', type=int,
+        help='files sampled per slice (default: %(default)s)' )
+    parser.add_argument( '-b', '--blocks', type=int,
+        help='blocks sampled per file (default: %(default)s)' )
+    parser.add_argument( '-s', '--block_size', type=int,
+        help='bytes per block (default: %(default)s)' )
+    parser.add_argument( '-t', '--threads', type=int,
+        help='files read at once (default: %(default)s)' )
+    parser.add_argument( '-v', '--verbose', action='store_true' )
+    parser.add_argument( '-d', '--debug', action='store_true' )
+    parser.set_defaults(
+        min_saving = 0.1,
+        exclude = '',
+        files = 32,
+        blocks = 4,
+        block_size = 65536,
+        threads = 8,
+    )
+    args = parser.parse_args()
+    if args.verbose:
+        logr.setLevel( logging.INFO )
+    if args.debug:
+        logr.setLevel( logging.DEBUG )
+    args.algo, args.level = parse_compression( args.compression )
+    args.exclude = set( args.exclude.split() )
+    return args
+
+
+def parse_compression( spec ):
+    ''' Return tuple of ( algo, level ) from ALGO[:LEVEL]
+    '''
+    algo, sep, level = spec.strip().partition( ':' )
+    if algo not in ALGOS:
+        raise UserWarning( "Unknown compression '{0}', expected one of {1}".format(
+            spec, ', '.join( ALGOS ) ) )
+    try:
+        level = int( level ) if level else DEFAULT_LEVELS[ algo ]
+    except ValueError:
+        raise UserWarning( "Invalid compression level in '{0}'".format( spec ) )
+    return ( algo, level )
+
+
+def compressed_size( data, algo, level ):
+    if algo == 'gzip':
+        return len( zlib.compress( data, min( level, 9 ) ) )
+    if algo == 'bzip2':
+        return len( bz2.compress( data, max( 1, min( level, 9 ) ) ) )
+    if algo == 'xz':
+        return len( lzma.compress( data, preset=min( level, 9 ) ) )
+    if algo == 'zstd':
+        return len( zlib.compress( data, 6 if level < 10 else 9 ) )
+    return len( zlib.compress( data, 1 ) )
+
+
+def extension( path ):
+    ''' Return the extension of a path (bytes) as str, None if it has none
+    '''
+    name = os.path.basename( path )
+    base, dot, ext = name.rpartition( b'.' )
+    if not base or not ext or len( ext ) > MAX_EXT_LEN or not ext.isalnum():
+        return None
+    return ext.decode( 'ascii', 'replace' )
+
+
+def sample_file( path, size, args, gov ):
+    ''' Return tuple of ( bytes sampled, compressed bytes ), None if unreadable.
+        Blocks are spread evenly over the file.
+    '''
+    nblocks = max( 1, min( args.blocks, size // args.block_size ) )
+    step = max( size - args.block_size, 0 ) // max( nblocks - 1, 1 )
+    raw = 0
+    packed = 0
+    try:
+        fd = os.open( path, os.O_RDONLY )
+    except OSError as e:
+        logr.debug( e )
+        return None
+    try:
+        for i in range( nblocks ):
+            data = os.pread( fd, args.block_size, i * step )
+            if not data:
+                break
+            wait = gov.read( len( data ) )
+            if wait > 0:
+                time.sleep( wait )
+            raw += len( data )
+            packed += compressed_size( data, args.algo, args.level )
+    except OSError as e:
+        logr.debug( e )
+        return None
+    finally:
+        os.close( fd )
+    if raw < 1:
+        return None
+    return ( raw, packed )
+
+
+def read_slice( infodir, key ):
+    ''' Return tuple of ( list of paths, list of sizes ) of a new slice.
+        Sizes are None without a .sizes file.
+    '''
+    fnbase = os.path.join( infodir, key )
+    with open( fnbase + '.filelist', 'rb' ) as f:
+        paths = [ line.rstrip( b'\n' ) for line in f ]
+    try:
+        with open( fnbase + '.sizes' ) as f:
+            sizes = [ int( line ) for line in f ]
+    except ( OSError, ValueError ):
+        sizes = None
+    if sizes is not None and len( sizes ) != len( paths ):
+        sizes = None
+    return ( paths, sizes )
+
+
+def probe_slice( key, paths, sizes, args, pool, gov ):
+    ''' Return tuple of ( ratio, list of excluded extensions ), where ratio is
+        the estimated archive bytes / input bytes of the slice with those
+        extensions left uncompressed.
+    '''
+    if sizes is None:
+        sizes = [ 1 ] * len( paths )
+    candidates = [ i for i, s in enumerate( sizes ) if s > 0 ]
+    if not candidates:
+        return ( 1.0, [] )
+    # same picks when a backup is set up again
+    rnd = random.Random( key )
+    picks = collections.Counter( rnd.choices( candidates, weights=[ sizes[ i ] for i in candidates ],
+                                              k=args.files ) )
+    # a file picked more than once is read once and counted as often as picked
+    futures = { i: pool.submit( sample_file, paths[ i ], sizes[ i ], args, gov ) for i in picks }
+    by_ext = collections.defaultdict( lambda: [ 0, 0 ] )
+    ratios = []
+    for i in sorted( picks ):
+        result = futures[ i ].result()
+        if result is None:
+            continue
+        raw, packed = result
+        ext = extension( paths[ i ] )
+        by_ext[ ext ][0] += raw
+        by_ext[ ext ][1] += packed
+        ratios.append( ( ext, packed / raw, picks[ i ] ) )
+    present = set( extension( p ) for p in paths )
+    excluded = set( args.exclude & present )
+    excluded.update( ext for ext, ( raw, packed ) in by_ext.items()
+                     if ext is not None and packed / raw > INCOMPRESSIBLE )
+    if not ratios:
+        return ( 1.0, sorted( excluded ) )
+    # picks are weighted by size, so each counts the same
+    ratio = ( sum( n * ( 1.0 if ext in excluded else min( r, 1.0 ) ) for ext, r, n in ratios )
+              / sum( n for ext, r, n in ratios ) )
+    logr.info( 'Slice {0}: sampled {1} files, ratio {2:.3f}, excluded {3}'.format(
+        key, len( ratios ), ratio, ','.join( sorted( excluded ) ) or '-' ) )
+    return ( ratio, sorted( excluded ) )
+
+
+def run():
+    args = process_cmdline()
+    cfg = summary.load_cfg()
+    gov = throttle.Governor( cfg )
+    compression = '{0}:{1}'.format( args.algo, args.level )
+    total = [ 0, 0 ]
+    with concurrent.futures.ThreadPoolExecutor( max_workers=args.threads ) as pool:
+        for line in args.binsfile:
+            parts = line.split()
+            if len( parts ) < 3:
+                continue
+            key, nbytes = parts[0], int( parts[2] )
+            try:
+                paths, sizes = read_slice( args.infodir, key )
+            except OSError as e:
+                # renamed already by an earlier run of mk_bkup_tasks
+                logr.debug( e )
+                continue
+            ratio, excluded = probe_slice( key, paths, sizes, args, pool, gov )
+            choice = compression
+            if 1.0 - ratio < args.min_saving:
+                choice = 'none'
+                ratio = 1.0
+                excluded = []
+            est = int( round( nbytes * ratio ) )
+            total[0] += nbytes
+            total[1] += est
+            print( '{0} {1:.4f} {2} {3} {4}'.format(
+                key, ratio, est, choice, ','.join( excluded ) or '-' ) )
+    logr.info( 'Estimated archive bytes {1} of {0} input bytes'.format( *total ) )
+
+
+if __name__ == '__main__':
+    try:
+        run()
+    except ( UserWarning, OSError ) as e:
+        logr.error( e )
+        sys.exit( 1 )
@@ -2,49 +2,156 @@
 
 import xml.etree.ElementTree
 import argparse
+import heapq
+import subprocess
 import sys
-import os.path
-import pprint
+import os
+import tempfile
 import logging
 
+DESCRIPTION = '''
+    Print the path of every file in a dar catalogue listing (dar -Txml).
+    The xml is parsed incrementally and each entry is discarded as soon as
+    it has been read, so memory use depends on directory depth, not on the
+    number of entries in the catalogue.
+'''
+
+# Entries that dar archives as a single item, ie: what split_filelist.py
+# puts in a filelist
+ENTRY_TAGS = ( 'File', 'Symlink', 'Socket', 'Pipe' )
+# Ignored along with everything below them
+SKIP_TAGS = ( 'Catalog', 'Attributes' )
+
+
 def process_cmdline():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser( description=DESCRIPTION )
     parser.add_argument('-f', '--fsroot', help='fsroot that was given to dar create')
+    parser.add_argument('--dar', metavar='CATALOGUE',
+        help='read the xml from "dar -Txml -l CATALOGUE" instead of from FILE' )
+    parser.add_argument('--dar_cmd', help='dar executable (default: %(default)s)' )
+    parser.add_argument('-o', '--outfile', help='write to this file instead of stdout' )
+    parser.add_argument('-s', '--sort', action='store_true',
+        help='sort output bytewise, same as "LC_ALL=C sort"' )
+    parser.add_argument('--sort_buffer', type=int,
+        help='max paths held in memory while sorting (default: %(default)s)' )
+    parser.add_argument('--tmpdir', help='where to keep sorted runs that exceed sort_buffer' )
     parser.add_argument('files', metavar='FILE', nargs='*', help='files to read, if empty, stdin is used')
-    defaults = { 'fsroot': '__FSROOT__' }
+    defaults = {
+        'fsroot': '__FSROOT__',
+        'dar_cmd': 'dar',
+        'sort_buffer': 1000000,
+    }
     parser.set_defaults( **defaults )
     return parser.parse_args()
 
 
-def read_xml( args ):
-    xtree = None
-    if len( args.files ) > 0:
-        xtree = xml.etree.ElementTree.parse( args.files[0] )
-    else:
-        xtree = xml.etree.ElementTree.parse( sys.stdin )
-    return xtree
-
-
-def xml2filenames( path, elem ):
-    logging.debug( 'Enter: path={}, {}'.format( path, pprint.pformat( elem ) ) )
-    for child in elem:
-        logging.debug( 'Processing: {}'.format( pprint.pformat( child ) ) )
-        if child.tag in ( 'Catalog', 'Attributes' ):
-            continue
-        newpath = os.path.join( path, child.attrib[ 'name' ] )
-        if child.tag == 'Directory':
-            xml2filenames( newpath, child )
-        elif child.tag in ( 'File', 'Symlink', 'Socket', 'Pipe' ):
-            print( newpath )
+def iter_filenames( source, fsroot ):
+    ''' Generate the path, as bytes, of each entry in a dar xml listing.
+        Directories are tracked on a stack of path prefixes; every element is
+        cleared and detached from its parent when it ends.
+    '''
+    prefixes = [ os.fsencode( os.path.join( fsroot, '' ) ) ]
+    stack = []
+    # depth inside an element whose children are not catalogue entries
+    skip = 0
+    for event, elem in xml.etree.ElementTree.iterparse( source, events=( 'start', 'end' ) ):
+        if event == 'start':
+            if skip:
+                skip += 1
+                continue
+            stack.append( elem )
+            if len( stack ) == 1:
+                continue
+            tag = elem.tag
+            if tag == 'Directory':
+                prefixes.append( prefixes[-1] + os.fsencode( elem.attrib[ 'name' ] ) + b'/' )
+            elif tag in ENTRY_TAGS:
+                yield prefixes[-1] + os.fsencode( elem.attrib[ 'name' ] )
+                skip = 1
+            elif tag in SKIP_TAGS:
+                skip = 1
+            else:
+                raise UserWarning( "Unknown Element tag '{}'".format( tag ) )
         else:
-            raise UserWarning( "Unknown Element tag '{}'".format( child.tag ) )
+            if skip > 1:
+                skip -= 1
+                continue
+            skip = 0
+            stack.pop()
+            if elem.tag == 'Directory':
+                prefixes.pop()
+            elem.clear()
+            if stack:
+                stack[-1].remove( elem )
+
+
+def _write_run( lines, tmpdir ):
+    f = tempfile.TemporaryFile( dir=tmpdir )
+    f.writelines( line + b'\n' for line in lines )
+    f.seek( 0 )
+    return f
+
+
+def _read_run( f ):
+    for line in f:
+        yield line[:-1]
+
+
+def external_sort( names, bufsize, tmpdir=None ):
+    ''' Sort names holding at most bufsize of them in memory.
+        Full buffers are sorted and spilled to temporary files, which are
+        then merged.
+    '''
+    runs = []
+    chunk = []
+    for name in names:
+        chunk.append( name )
+        if len( chunk ) >= bufsize:
+            chunk.sort()
+            runs.append( _write_run( chunk, tmpdir ) )
+            chunk = []
+    chunk.sort()
+    if not runs:
+        return iter( chunk )
+    runs.append( _write_run( chunk, tmpdir ) )
+    logging.debug( 'Merging {} sorted runs'.format( len( runs ) ) )
+    return heapq.merge( *[ _read_run( f ) for f in runs ] )
+
 
 def run():
     args = process_cmdline()
-    xtree = read_xml( args )
-    root = xtree.getroot()
-    xml2filenames( args.fsroot, root )
-
+    proc = None
+    if args.dar:
+        cmd = [ args.dar_cmd, '-Q', '-Txml', '-as', '-l', args.dar ]
+        proc = subprocess.Popen( cmd, stdout=subprocess.PIPE )
+        source = proc.stdout
+    elif len( args.files ) > 0:
+        source = args.files[0]
+    else:
+        source = sys.stdin.buffer
+    if args.outfile:
+        # only a complete listing ever appears under outfile
+        out = open( args.outfile + '.tmp', 'wb' )
+    else:
+        out = sys.stdout.buffer
+    try:
+        names = iter_filenames( source, args.fsroot )
+        if args.sort:
+            names = external_sort( names, args.sort_buffer, args.tmpdir )
+        out.writelines( name + b'\n' for name in names )
+    except xml.etree.ElementTree.ParseError:
+        # a truncated listing is most likely the fault of dar, report that instead
+        if proc and proc.wait() != 0:
+            raise UserWarning( "'{}' exited with code {}".format(
+                ' '.join( cmd ), proc.returncode ) )
+        raise
+    finally:
+        if args.outfile:
+            out.close()
+    if proc and proc.wait() != 0:
+        raise UserWarning( "'{}' exited with code {}".format( ' '.join( cmd ), proc.returncode ) )
+    if args.outfile:
+        os.rename( out.name, args.outfile )
 
 if __name__ == '__main__':
 #    logging.basicConfig( level=logging.DEBUG )
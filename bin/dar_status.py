@@ -0,0 +1,390 @@
+#!/usr/bin/python3
+
+import argparse
+import collections
+import datetime
+import json
+import logging
+import os
+import pathlib
+import re
+import sys
+import time
+
+import summary
+import metrics_export
+
+logr = logging.getLogger()
+console_handler = logging.StreamHandler()
+formatter = logging.Formatter( '%(levelname)s [%(filename)s %(lineno)d] %(message)s' )
+console_handler.setFormatter( formatter )
+logr.addHandler( console_handler )
+logr.setLevel( logging.WARNING )
+
+DESCRIPTION = '''
+    Progress of the running dar slices of one or more backups.
+    Each running slice's dar log (--verbose=all) is read on from where the
+    last poll stopped and the paths dar reports are matched against the
+    slice's filelist, with sizes from the .sizes file that split_filelist.py
+    writes next to it (for slices without one, bytes are counted in
+    proportion to files). Reports files and bytes done, current rate and ETA
+    for each slice, each host and each backup. Log offsets are kept in
+    .progress.cache in the infodir, so each run only reads what dar logged
+    since the one before.
+'''
+
+# dar --verbose=all lines for the paths it saves
+LOG_RE = re.compile(
+    rb'^(?:Adding (?:file|folder|Hard link) to archive|Recording hard link into the archive): (.*)$',
+    re.MULTILINE )
+
+# Secs of history that the current rate is measured over (between 1x and 2x)
+RATE_WINDOW = 60
+
+CACHE_FILENAME = '.progress.cache'
+
+SliceRow = collections.namedtuple( 'SliceRow',
+    'name host files_done files_total bytes_done bytes_total rate eta' )
+HostRow = collections.namedtuple( 'HostRow',
+    'host slices bytes_left rate eta' )
+BkupRow = collections.namedtuple( 'BkupRow',
+    'key timestamp running pending files_done files_total bytes_done bytes_total rate eta' )
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser( description=DESCRIPTION )
+    parser.add_argument( 'infodirs', nargs='*', metavar='INFODIR',
+        help='bkup infodirs (default: the latest backup of each DIRKEY)' )
+    parser.add_argument( '-w', '--watch', type=float, metavar='SECS',
+        help='refresh every SECS seconds until interrupted, like top' )
+    parser.add_argument( '-v', '--verbose', action='store_true' )
+    parser.add_argument( '-d', '--debug', action='store_true' )
+    args = parser.parse_args()
+    if args.verbose:
+        logr.setLevel( logging.INFO )
+    if args.debug:
+        logr.setLevel( logging.DEBUG )
+    if args.watch is not None and args.watch <= 0:
+        parser.error( 'watch interval must be more than 0' )
+    return args
+
+
+def _eta( left, rate ):
+    if left is None or not rate:
+        return None
+    return max( left, 0 ) / rate
+
+
+class SliceProgress( object ):
+    ''' Read position in one slice's dar log and what dar saved up to there.
+        ref and mid are ( time, bytes ) samples for the current rate.
+    '''
+    __slots__ = ( 'start', 'offset', 'files', 'bytes',
+                  'ref_time', 'ref_bytes', 'mid_time', 'mid_bytes' )
+
+    def __init__( self, start, offset=0, files=0, bytes=0,
+                  ref_time=None, ref_bytes=0, mid_time=None, mid_bytes=0 ):
+        self.start = start
+        self.offset = offset
+        self.files = files
+        self.bytes = bytes
+        self.ref_time = start if ref_time is None else ref_time
+        self.ref_bytes = ref_bytes
+        self.mid_time = start if mid_time is None else mid_time
+        self.mid_bytes = mid_bytes
+
+    def as_list( self ):
+        return [ getattr( self, k ) for k in self.__slots__ ]
+
+    def sample( self, now ):
+        ''' Record bytes done as of now. Return current rate in bytes/sec.
+        '''
+        if now - self.mid_time >= RATE_WINDOW:
+            self.ref_time, self.ref_bytes = self.mid_time, self.mid_bytes
+            self.mid_time, self.mid_bytes = now, self.bytes
+        secs = now - self.ref_time
+        if secs <= 0:
+            return 0.0
+        return ( self.bytes - self.ref_bytes ) / secs
+
+
+class SliceFiles( object ):
+    ''' Paths of one slice and their sizes, from its .filelist and .sizes.
+        Without a .sizes file every size is 0 and has_sizes is False.
+    '''
+    def __init__( self, fnbase ):
+        with open( fnbase + '.filelist', 'rb' ) as f:
+            paths = [ line.rstrip( b'\n' ) for line in f ]
+        try:
+            with open( fnbase + '.sizes' ) as f:
+                sizes = [ int( line ) for line in f ]
+        except ( OSError, ValueError ):
+            sizes = None
+        if sizes is not None and len( sizes ) == len( paths ):
+            self.sizes = dict( zip( paths, sizes ) )
+            self.total_bytes = sum( sizes )
+        else:
+            self.sizes = dict.fromkeys( paths, 0 )
+            self.total_bytes = None
+        self.has_sizes = self.total_bytes is not None
+        self.total_files = len( paths )
+        # paths dar reported already, only in this process
+        self.seen = set()
+
+
+class Monitor( object ):
+    ''' Progress of one backup, updated by poll()
+    '''
+    def __init__( self, key, infodir ):
+        self.key = key
+        self.infodir = infodir
+        self.timestamp = os.path.basename( infodir )
+        self.cache_fn = os.path.join( infodir, CACHE_FILENAME )
+        self.progress = self._load_cache()
+        self.files = {}
+        self.totals = self._load_totals()
+
+    def _load_cache( self ):
+        try:
+            with open( self.cache_fn ) as f:
+                data = json.load( f )
+            return { k: SliceProgress( *v ) for k, v in data.items() }
+        except ( OSError, ValueError, TypeError ) as e:
+            logr.debug( "No progress cache '{0}': {1}".format( self.cache_fn, e ) )
+            return {}
+
+    def _save_cache( self ):
+        tmpfn = '{0}.{1}.tmp'.format( self.cache_fn, os.getpid() )
+        try:
+            with open( tmpfn, 'w' ) as f:
+                json.dump( { k: p.as_list() for k, p in self.progress.items() }, f )
+            os.rename( tmpfn, self.cache_fn )
+        except OSError as e:
+            # not writable, eg. another user's backup: offsets live in memory
+            logr.debug( "Can't save progress cache '{0}': {1}".format( self.cache_fn, e ) )
+
+    def _load_totals( self ):
+        ''' Return ( files, bytes ) of the whole backup from split.bins, None
+            if unknown
+        '''
+        nfiles = nbytes = 0
+        try:
+            with open( os.path.join( self.infodir, 'split.bins' ) ) as f:
+                for line in f:
+                    uuid, n, size = line.split()
+                    nfiles += int( n )
+                    nbytes += int( size )
+        except ( OSError, ValueError ):
+            return None
+        return ( nfiles, nbytes )
+
+    def _read_log( self, name, fnbase, p ):
+        ''' Read what dar logged since p.offset, count the paths of the slice
+        '''
+        logfile = fnbase + '.log'
+        try:
+            size = os.path.getsize( logfile )
+        except OSError:
+            return
+        if size < p.offset:
+            # log was restarted, eg. the task was run again
+            p.__init__( p.start )
+            self.files.pop( name, None )
+        if size == p.offset:
+            return
+        files = self.files.get( name )
+        if files is None:
+            try:
+                files = self.files[ name ] = SliceFiles( fnbase )
+            except OSError as e:
+                logr.warning( "Can't read filelist of '{0}': {1}".format( fnbase, e ) )
+                return
+        with open( logfile, 'rb' ) as f:
+            f.seek( p.offset )
+            data = f.read( size - p.offset )
+        end = data.rfind( b'\n' ) + 1
+        for m in LOG_RE.finditer( data, 0, end ):
+            path = m.group( 1 ).rstrip( b'\r' )
+            nbytes = files.sizes.get( path )
+            if nbytes is None or path in files.seen:
+                continue
+            files.seen.add( path )
+            p.files += 1
+            p.bytes += nbytes
+        p.offset += end
+
+    def poll( self, now ):
+        ''' Return tuple of ( BkupRow, list of SliceRow ) as of now
+        '''
+        bkupdir = summary.BkupDir( pathlib.Path( self.infodir ) )
+        fnbases = { str( p )[ :-len( '.ini' ) ].rsplit( '_', 1 )[-1]: str( p )[ :-len( '.ini' ) ]
+                    for p in bkupdir.filelist }
+        done_files = done_bytes = 0
+        running = {}
+        rows = []
+        for name, s in sorted( bkupdir.slices.items() ):
+            if s.start is None:
+                continue
+            if s.elapsed is not None:
+                if s.exitcode == 0:
+                    done_files += s.files or 0
+                    done_bytes += s.bytes or 0
+                continue
+            fnbase = fnbases[ name ]
+            p = self.progress.get( name )
+            if p is None or p.start != s.start:
+                p = SliceProgress( s.start )
+                self.files.pop( name, None )
+            self._read_log( name, fnbase, p )
+            running[ name ] = p
+            files = self.files.get( name )
+            files_total = s.files or ( files.total_files if files else None )
+            bytes_total = s.bytes or ( files.total_bytes if files else None )
+            bytes_done = p.bytes
+            if files is not None and not files.has_sizes and bytes_total and files_total:
+                bytes_done = bytes_total * p.files // files_total
+                p.bytes = bytes_done
+            rate = p.sample( now )
+            left = bytes_total - bytes_done if bytes_total is not None else None
+            rows.append( SliceRow( name, s.hostname or 'unknown', p.files, files_total,
+                                   bytes_done, bytes_total, rate, _eta( left, rate ) ) )
+            done_files += p.files
+            done_bytes += bytes_done
+        self.progress = running
+        for name in list( self.files ):
+            if name not in running:
+                del self.files[ name ]
+        self._save_cache()
+        files_total, bytes_total = self.totals or ( None, None )
+        rate = sum( r.rate for r in rows )
+        pending = max( 0, bkupdir.num_expected_slices - len( bkupdir.slices ) )
+        left = bytes_total - done_bytes if bytes_total is not None else None
+        bkup = BkupRow( self.key, self.timestamp, len( rows ), pending, done_files, files_total,
+                        done_bytes, bytes_total, rate, _eta( left, rate ) )
+        return ( bkup, rows )
+
+
+def host_rows( rows ):
+    hosts = collections.OrderedDict()
+    for r in sorted( rows, key=lambda r: r.host ):
+        h = hosts.setdefault( r.host, [ 0, 0, 0.0 ] )
+        h[0] += 1
+        if r.bytes_total is not None:
+            h[1] += max( r.bytes_total - r.bytes_done, 0 )
+        h[2] += r.rate
+    return [ HostRow( host, n, left, rate, _eta( left, rate ) )
+             for host, ( n, left, rate ) in hosts.items() ]
+
+
+def human_bytes( n ):
+    if n is None:
+        return '?'
+    for unit in ( '', 'K', 'M', 'G', 'T' ):
+        if abs( n ) < 1024:
+            break
+        n /= 1024.0
+    return '{0:.1f}{1}'.format( n, unit ) if unit else '{0:.0f}'.format( n )
+
+
+def human_secs( secs ):
+    if secs is None:
+        return '?'
+    return str( datetime.timedelta( seconds=int( secs ) ) )
+
+
+def pct( done, total ):
+    if not total:
+        return '?'
+    return '{0:.1f}%'.format( 100.0 * done / total )
+
+
+def format_table( rows ):
+    ''' Same layout as "column -t" '''
+    widths = [ max( len( r[ i ] ) for r in rows ) for i in range( len( rows[0] ) ) ]
+    return [ '  '.join( [ v.ljust( w ) for v, w in zip( r[:-1], widths ) ] + [ r[-1] ] )
+             for r in rows ]
+
+
+def report( results ):
+    ''' Return report text for a list of ( BkupRow, list of SliceRow )
+    '''
+    lines = []
+    for bkup, rows in results:
+        lines.append( '{0} {1}: {2} running, {3} pending; files {4}/{5} ({6}); '
+                      'bytes {7}/{8} ({9}); rate {10}/s; ETA {11}'.format(
+            bkup.key, bkup.timestamp, bkup.running, bkup.pending,
+            bkup.files_done, '?' if bkup.files_total is None else bkup.files_total,
+            pct( bkup.files_done, bkup.files_total ),
+            human_bytes( bkup.bytes_done ), human_bytes( bkup.bytes_total ),
+            pct( bkup.bytes_done, bkup.bytes_total ),
+            human_bytes( bkup.rate ), human_secs( bkup.eta ) ) )
+        if not rows:
+            lines.append( '' )
+            continue
+        table = [ ( 'SLICE', 'HOST', 'FILES', 'FILES%', 'BYTES', 'BYTES%', 'RATE/s', 'ETA' ) ]
+        for r in rows:
+            table.append( ( r.name, r.host,
+                            '{0}/{1}'.format( r.files_done, '?' if r.files_total is None else r.files_total ),
+                            pct( r.files_done, r.files_total ),
+                            '{0}/{1}'.format( human_bytes( r.bytes_done ), human_bytes( r.bytes_total ) ),
+                            pct( r.bytes_done, r.bytes_total ),
+                            human_bytes( r.rate ), human_secs( r.eta ) ) )
+        lines.extend( '  ' + line for line in format_table( table ) )
+        table = [ ( 'HOST', 'SLICES', 'BYTES_LEFT', 'RATE/s', 'ETA' ) ]
+        for h in host_rows( rows ):
+            table.append( ( h.host, str( h.slices ), human_bytes( h.bytes_left ),
+                            human_bytes( h.rate ), human_secs( h.eta ) ) )
+        lines.append( '' )
+        lines.extend( '  ' + line for line in format_table( table ) )
+        lines.append( '' )
+    return '\n'.join( lines ) + '\n'
+
+
+def poll_all( monitors, show_idle ):
+    now = time.time()
+    results = []
+    for m in monitors:
+        bkup, rows = m.poll( now )
+        if show_idle or bkup.running or bkup.pending:
+            results.append( ( bkup, rows ) )
+    return results
+
+
+def run():
+    args = process_cmdline()
+    cfg = summary.load_cfg()
+    if args.infodirs:
+        bkup_dirs = []
+        for d in args.infodirs:
+            if not os.path.isdir( d ):
+                raise UserWarning( "Not a directory: '{0}'".format( d ) )
+            d = os.path.abspath( d )
+            bkup_dirs.append( ( os.path.basename( os.path.dirname( d ) ), d ) )
+    else:
+        bkup_dirs = list( metrics_export.current_bkup_dirs( cfg ) )
+    monitors = [ Monitor( key, d ) for key, d in bkup_dirs ]
+    show_idle = bool( args.infodirs )
+    if args.watch is None:
+        text = report( poll_all( monitors, show_idle ) )
+        sys.stdout.write( text if text.strip() else 'No running backups\n' )
+        return
+    try:
+        while True:
+            text = report( poll_all( monitors, show_idle ) )
+            # clear screen, cursor home
+            sys.stdout.write( '\033[H\033[2J' )
+            sys.stdout.write( '{0}  (every {1:g}s, ctrl-c to quit)\n\n'.format(
+                time.strftime( '%Y-%m-%d %H:%M:%S' ), args.watch ) )
+            sys.stdout.write( text if text.strip() else 'No running backups\n' )
+            sys.stdout.flush()
+            time.sleep( args.watch )
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    try:
+        run()
+    except ( UserWarning, OSError ) as e:
+        logr.error( e )
+        sys.exit( 1 )
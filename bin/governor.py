@@ -0,0 +1,273 @@
+#!/usr/bin/python3
+
+import argparse
+import logging
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import time
+
+import summary
+import throttle
+
+logr = logging.getLogger()
+console_handler = logging.StreamHandler()
+formatter = logging.Formatter( '%(levelname)s [%(filename)s %(lineno)d] %(message)s' )
+console_handler.setFormatter( formatter )
+logr.addHandler( console_handler )
+logr.setLevel( logging.WARNING )
+
+DESCRIPTION = '''
+    Apply the THROTTLE profiles of settings.ini (see throttle.py).
+    run    - run a dar task: wait for a dar slot, then pause the task
+             (SIGSTOP / SIGCONT) while its node reads faster than
+             READ_BYTES_PER_SEC or while more tasks run than the profile
+             allows. Exit code is the task's, or GOVERNOR_FAILED (125) if
+             the task could not be started. Once started, the task is
+             always waited for; if the slot db fails it runs as allowed.
+    pace   - copy stdin to stdout one line per META_OPS_PER_SEC token,
+             to pace the directories that scandir.bash hands to find
+    status - show the current profile, bucket levels and dar slots
+    enabled - exit 0 if throttling is configured, 1 if not
+'''
+
+# Secs between reads of the task's I/O counters
+TICK = 1
+
+# Secs between dar slot heartbeats, also how long a profile change can take
+# to pause or resume a task
+HEARTBEAT = 10
+
+# Exit code of run when the governor fails before the task starts,
+# dar exits with 0-11 and 128+N when killed by signal N
+GOVERNOR_FAILED = 125
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser( description=DESCRIPTION,
+        formatter_class=argparse.RawDescriptionHelpFormatter )
+    parser.add_argument( '-s', '--secs_file',
+        help='write seconds spent throttled (run, pace) to this file' )
+    parser.add_argument( '-v', '--verbose', action='store_true' )
+    parser.add_argument( '-d', '--debug', action='store_true' )
+    subparsers = parser.add_subparsers( dest='action' )
+    p_run = subparsers.add_parser( 'run', help='run a dar task under the throttle' )
+    p_run.add_argument( 'cmd', nargs=argparse.REMAINDER, help='command and its args' )
+    p_pace = subparsers.add_parser( 'pace', help='pace lines from stdin' )
+    p_pace.add_argument( '-c', '--cost', type=int,
+        help='meta ops per line (default: %(default)s)' )
+    p_pace.set_defaults(
+        cost = 1,
+    )
+    subparsers.add_parser( 'status', help='show profile, buckets and dar slots' )
+    subparsers.add_parser( 'enabled', help='exit 0 if throttling is configured' )
+    args = parser.parse_args()
+    if args.verbose:
+        logr.setLevel( logging.INFO )
+    if args.debug:
+        logr.setLevel( logging.DEBUG )
+    if not args.action:
+        parser.error( 'missing action' )
+    if args.action == 'run':
+        if args.cmd and args.cmd[0] == '--':
+            args.cmd = args.cmd[1:]
+        if not args.cmd:
+            parser.error( 'missing command' )
+    return args
+
+
+def read_chars( pid ):
+    ''' Return bytes read by pid so far, including from the page cache,
+        which still costs the filesystem metadata and network round trips
+    '''
+    try:
+        with open( '/proc/{0}/io'.format( pid ) ) as f:
+            for line in f:
+                if line.startswith( 'rchar:' ):
+                    return int( line.split()[1] )
+    except OSError:
+        pass
+    return 0
+
+
+def save_secs( fn, secs ):
+    if fn:
+        with open( fn, 'w' ) as f:
+            f.write( '{0:.0f}\n'.format( secs ) )
+
+
+def heartbeat( slots, gov, paused ):
+    ''' Update the task's dar slot. Return False if the task must pause.
+        Without a slot, or if the slot db fails, the task is allowed.
+    '''
+    if slots is None:
+        return True
+    try:
+        return slots.heartbeat( gov.limits(), paused )
+    except sqlite3.Error as e:
+        logr.error( 'Dar slot heartbeat failed: {0}'.format( e ) )
+        return True
+
+
+def govern( proc, gov, slots ):
+    ''' Pause proc while its node is over the read rate or while proc is
+        beyond the profile's dar limits, until proc exits.
+        Return seconds paused.
+    '''
+    paused = 0.0
+    last_chars = read_chars( proc.pid )
+    last_beat = time.time()
+    allowed = True
+    while True:
+        try:
+            proc.wait( timeout=TICK )
+            return paused
+        except subprocess.TimeoutExpired:
+            pass
+        chars = read_chars( proc.pid )
+        wait = gov.read( max( chars - last_chars, 0 ) )
+        last_chars = max( chars, last_chars )
+        if time.time() - last_beat >= HEARTBEAT:
+            allowed = heartbeat( slots, gov, paused )
+            last_beat = time.time()
+        if wait <= 0 and allowed:
+            continue
+        start = time.time()
+        end_wait = start + wait
+        logr.debug( 'Pausing pid {0}: read wait {1:.1f}s, allowed {2}'.format(
+            proc.pid, wait, allowed ) )
+        proc.send_signal( signal.SIGSTOP )
+        try:
+            while proc.poll() is None:
+                now = time.time()
+                if now - last_beat >= HEARTBEAT:
+                    allowed = heartbeat( slots, gov, paused + now - start )
+                    last_beat = now
+                if allowed and now >= end_wait:
+                    break
+                time.sleep( TICK if now >= end_wait else min( TICK, end_wait - now ) )
+        finally:
+            if proc.poll() is None:
+                proc.send_signal( signal.SIGCONT )
+            paused += time.time() - start
+
+
+def run_task( cfg, cmd, secs_file ):
+    ''' Run cmd under the throttle. Return its exit code.
+        Errors of the governor after cmd started are logged, cmd keeps
+        running (unthrottled if need be) and is always waited for.
+    '''
+    gov = throttle.Governor( cfg )
+    slots = None
+    start = time.time()
+    try:
+        slots = throttle.DarSlots( throttle.slots_db( cfg ) )
+        slots.acquire( gov, poll=HEARTBEAT )
+    except sqlite3.Error as e:
+        logr.error( 'Dar slot db failed, running without a slot: {0}'.format( e ) )
+        slots = None
+    waited = time.time() - start
+    if waited >= 1:
+        logr.info( 'Waited {0:.0f} secs for a dar slot'.format( waited ) )
+    paused = 0.0
+    try:
+        proc = subprocess.Popen( cmd )
+    except OSError:
+        release( slots )
+        raise
+
+    def forward( signum, frame ):
+        # a stopped task only acts on the signal once it is continued
+        proc.send_signal( signum )
+        proc.send_signal( signal.SIGCONT )
+
+    try:
+        for signum in ( signal.SIGTERM, signal.SIGINT, signal.SIGHUP ):
+            signal.signal( signum, forward )
+        paused = govern( proc, gov, slots )
+    except ( UserWarning, OSError, sqlite3.Error ) as e:
+        logr.error( 'Governor failed, task runs unthrottled: {0}'.format( e ) )
+    finally:
+        if proc.poll() is None:
+            proc.send_signal( signal.SIGCONT )
+            proc.wait()
+        release( slots )
+    logr.info( 'Throttled secs: waited {0:.0f}, paused {1:.0f}'.format( waited, paused ) )
+    try:
+        save_secs( secs_file, waited + paused )
+    except OSError as e:
+        logr.warning( e )
+    if proc.returncode < 0:
+        return 128 - proc.returncode
+    return proc.returncode
+
+
+def release( slots ):
+    ''' Free the task's dar slot, a slot left behind is dropped once its
+        process is gone
+    '''
+    if slots is None:
+        return
+    try:
+        slots.release()
+    except sqlite3.Error as e:
+        logr.warning( 'Cannot release dar slot: {0}'.format( e ) )
+
+
+def pace( cfg, cost, secs_file ):
+    gov = throttle.Governor( cfg )
+    slept = 0.0
+    for line in sys.stdin.buffer:
+        slept += gov.meta( cost )
+        sys.stdout.buffer.write( line )
+        sys.stdout.buffer.flush()
+    save_secs( secs_file, slept )
+
+
+def print_status( cfg ):
+    gov = throttle.Governor( cfg )
+    profile = gov.limits()
+    print( 'Profile: {0}'.format( profile.name ) )
+    for k in throttle.LIMIT_KEYS:
+        v = getattr( profile, k.lower() )
+        print( '  {0:20s} {1}'.format( k, 'no limit' if v is None else v ) )
+    for name, bucket in ( ( 'meta_ops', gov.meta_bucket ), ( 'read_bytes', gov.read_bucket ) ):
+        level = bucket.level()
+        print( 'Bucket {0}: {1}'.format( name, 'unused' if level is None else '{0:.0f}'.format( level ) ) )
+    fn = throttle.slots_db( cfg )
+    rows = throttle.DarSlots( fn ).rows() if os.path.exists( fn ) else []
+    print( 'Dar tasks: {0}'.format( len( rows ) ) )
+    now = time.time()
+    for host, pid, start, heartbeat, paused in rows:
+        stale = ' STALE' if now - heartbeat > throttle.SLOT_STALE else ''
+        print( '  {0} {1} running {2:.0f}s paused {3:.0f}s{4}'.format(
+            host, pid, now - start, paused, stale ) )
+
+
+def run():
+    args = process_cmdline()
+    if args.action == 'run':
+        # exit code of the task is passed on, keep the governor's own apart
+        try:
+            return run_task( summary.load_cfg(), args.cmd, args.secs_file )
+        except ( UserWarning, OSError, sqlite3.Error ) as e:
+            logr.error( e )
+            return GOVERNOR_FAILED
+    cfg = summary.load_cfg()
+    if args.action == 'enabled':
+        return 0 if throttle.is_enabled( cfg ) else 1
+    if args.action == 'pace':
+        pace( cfg, args.cost, args.secs_file )
+    elif args.action == 'status':
+        print_status( cfg )
+    return 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit( run() )
+    except ( UserWarning, OSError ) as e:
+        logr.error( e )
+        sys.exit( 1 )
@@ -0,0 +1,357 @@
+#!/usr/bin/python3
+
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import logging
+import os
+import pathlib
+import re
+import sqlite3
+import statistics
+import sys
+import time
+
+import bkup_status
+import summary
+
+logr = logging.getLogger()
+console_handler = logging.StreamHandler()
+formatter = logging.Formatter( '%(levelname)s [%(filename)s %(lineno)d] %(message)s' )
+console_handler.setFormatter( formatter )
+logr.addHandler( console_handler )
+logr.setLevel( logging.WARNING )
+
+DESCRIPTION = '''
+    History of all backups in one sqlite db (HISTORY::DBFILE), to follow
+    trends across backups without parsing every infodir again.
+    Each backup has one row of totals and phase timings (scan, split, dar
+    wall clock, dar less throttled, verify and throttled seconds) and one
+    row per slice.
+    add      - record the given infodirs, run by 'bkup wrapup'
+    backfill - record every current and annal infodir that is not in the db,
+               or was not complete when recorded, several at a time
+    report   - throughput of each backup of each DIRKEY and of each host per
+               month. Throughput is input bytes per dar second. Backups (and
+               host months) more than SIGMA standard deviations below the
+               mean of the BASELINE before them (same DIRKEY and type) are
+               flagged SLOW. The standard deviation counts as at least
+               MIN_REL_SD of the mean.
+'''
+
+# Backups (or host months) needed before one can be compared
+MIN_BASELINE = 3
+
+# Spread of a baseline is taken as at least this fraction of its mean, so
+# a steady history still flags a backup that is much slower
+MIN_REL_SD = 0.05
+
+SPLIT_RUNTIME_RE = re.compile( r'^Runtime: *([0-9.]+) secs' )
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS backups ( '
+    'key TEXT, ts INTEGER, type TEXT, infodir TEXT, complete INTEGER, recorded REAL, '
+    'slices INTEGER, failed INTEGER, files INTEGER, bytes INTEGER, archive_bytes INTEGER, '
+    'start INTEGER, end INTEGER, scan_secs REAL, split_secs REAL, dar_wall_secs INTEGER, '
+    'dar_secs INTEGER, verify_secs INTEGER, throttled_secs INTEGER, '
+    'PRIMARY KEY ( key, ts ) )',
+    'CREATE TABLE IF NOT EXISTS slices ( '
+    'key TEXT, ts INTEGER, num TEXT, host TEXT, start INTEGER, end INTEGER, '
+    'elapsed INTEGER, exitcode INTEGER, files INTEGER, bytes INTEGER, archive_bytes INTEGER, '
+    'verify_elapsed INTEGER, throttled_secs INTEGER, '
+    'PRIMARY KEY ( key, ts, num ) )',
+    'CREATE INDEX IF NOT EXISTS slices_host ON slices ( host, start )',
+)
+
+BACKUP_COLS = ( 'key', 'ts', 'type', 'infodir', 'complete', 'recorded', 'slices', 'failed',
+                'files', 'bytes', 'archive_bytes', 'start', 'end', 'scan_secs', 'split_secs',
+                'dar_wall_secs', 'dar_secs', 'verify_secs', 'throttled_secs' )
+SLICE_COLS = ( 'key', 'ts', 'num', 'host', 'start', 'end', 'elapsed', 'exitcode', 'files',
+               'bytes', 'archive_bytes', 'verify_elapsed', 'throttled_secs' )
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser( description=DESCRIPTION,
+        formatter_class=argparse.RawDescriptionHelpFormatter )
+    parser.add_argument( '--db', help='history db (default: HISTORY::DBFILE)' )
+    parser.add_argument( '-v', '--verbose', action='store_true' )
+    parser.add_argument( '-d', '--debug', action='store_true' )
+    subparsers = parser.add_subparsers( dest='action' )
+    p_add = subparsers.add_parser( 'add', help='record infodirs' )
+    p_add.add_argument( 'infodirs', nargs='+', metavar='INFODIR' )
+    p_backfill = subparsers.add_parser( 'backfill', help='record all existing infodirs' )
+    p_backfill.add_argument( '-j', '--jobs', type=int,
+        help='infodirs read at once (default: number of cpus)' )
+    p_report = subparsers.add_parser( 'report', help='trends and slow backups' )
+    p_report.add_argument( '-k', '--key', action='append',
+        help='only this DIRKEY (repeatable)' )
+    p_report.add_argument( '-b', '--baseline', type=int,
+        help='backups to compare with (default: HISTORY::BASELINE or 10)' )
+    p_report.add_argument( '-s', '--sigma', type=float,
+        help='flag below mean - SIGMA * stdev (default: HISTORY::SIGMA or 2)' )
+    p_report.add_argument( '-n', '--last', type=int,
+        help='show the last N backups of each DIRKEY and months of each host (default: all)' )
+    p_report.add_argument( '--slow_only', action='store_true',
+        help='only show flagged backups and host months' )
+    args = parser.parse_args()
+    if args.verbose:
+        logr.setLevel( logging.INFO )
+    if args.debug:
+        logr.setLevel( logging.DEBUG )
+    if not args.action:
+        parser.error( 'missing action' )
+    return args
+
+
+def db_path( cfg ):
+    fn = ''
+    if cfg.has_section( 'HISTORY' ):
+        fn = cfg[ 'HISTORY' ].get( 'DBFILE', '' ).strip()
+    return fn or os.path.join( cfg[ 'GENERAL' ][ 'INFODIR' ], 'history.sqlite3' )
+
+
+def connect( fn ):
+    db = sqlite3.connect( fn, timeout=60 )
+    for stmt in SCHEMA:
+        db.execute( stmt )
+    db.commit()
+    return db
+
+
+def split_secs( infodir ):
+    ''' Return the split runtime saved by split_filelist.py --with_summary
+    '''
+    try:
+        with open( os.path.join( infodir, '02.binpack.runtime' ) ) as f:
+            for line in f:
+                m = SPLIT_RUNTIME_RE.match( line )
+                if m:
+                    return float( m.group( 1 ) )
+    except OSError:
+        pass
+    return None
+
+
+def collect( key, infodir ):
+    ''' Return tuple of ( backup row, list of slice rows ) of one infodir
+    '''
+    ts = int( os.path.basename( infodir ) )
+    bkupdir = summary.BkupDir( pathlib.Path( infodir ) )
+    slices = []
+    for num, s in sorted( bkupdir.slices.items() ):
+        slices.append( ( key, ts, num, s.hostname, s.start, s.end, s.elapsed, s.exitcode,
+                         s.files, s.bytes, s.archive_bytes, s.verify_elapsed, s.throttled_secs ) )
+    done = [ s for s in bkupdir.slices.values() if s.exitcode == 0 ]
+    status = bkupdir.dar_status()
+    try:
+        scan = bkupdir.scandir_runtime().total_seconds()
+    except ( OSError, KeyError, ValueError, IndexError ) as e:
+        logr.debug( "{0}: no scan time: {1}".format( infodir, e ) )
+        scan = None
+    starts = [ s.start for s in bkupdir.slices.values() if s.start is not None ]
+    ends = [ s.end for s in bkupdir.slices.values() if s.end is not None ]
+    start = min( starts ) if starts else None
+    end = max( ends ) if ends else None
+    complete = int( status.total > 0 and status.succeeded == status.total )
+    backup = ( key, ts, bkup_status.bkup_type( infodir ), infodir, complete, time.time(),
+               status.total, status.failed,
+               sum( s.files or 0 for s in done ),
+               sum( s.bytes or 0 for s in done ),
+               sum( s.archive_bytes or 0 for s in done ),
+               start, end, scan, split_secs( infodir ),
+               end - start if start and end else None,
+               sum( summary.dar_secs( s ) or 0 for s in done ),
+               sum( s.verify_elapsed or 0 for s in done ),
+               sum( s.throttled_secs or 0 for s in done ) )
+    return ( backup, slices )
+
+
+def _init_worker():
+    # each worker reads one infodir at a time, the pool is the parallelism
+    summary.PARALLEL_PARSE_MIN = sys.maxsize
+
+
+def record( db, backup, slices ):
+    key, ts = backup[:2]
+    with db:
+        db.execute( 'DELETE FROM slices WHERE key = ? AND ts = ?', ( key, ts ) )
+        db.execute( 'INSERT OR REPLACE INTO backups ( {0} ) VALUES ( {1} )'.format(
+            ', '.join( BACKUP_COLS ), ', '.join( '?' * len( BACKUP_COLS ) ) ), backup )
+        db.executemany( 'INSERT INTO slices ( {0} ) VALUES ( {1} )'.format(
+            ', '.join( SLICE_COLS ), ', '.join( '?' * len( SLICE_COLS ) ) ), slices )
+
+
+def infodir2key( infodir ):
+    return os.path.basename( os.path.dirname( os.path.abspath( infodir ) ) )
+
+
+def add( db, infodirs ):
+    for d in infodirs:
+        d = os.path.abspath( d )
+        if not os.path.isdir( d ):
+            raise UserWarning( "Not a directory: '{0}'".format( d ) )
+        backup, slices = collect( infodir2key( d ), d )
+        record( db, backup, slices )
+        logr.info( "Recorded '{0}': {1} slices".format( d, len( slices ) ) )
+
+
+def backfill( db, cfg, jobs ):
+    done = set( db.execute( 'SELECT key, ts FROM backups WHERE complete = 1' ) )
+    todo = []
+    for key, infodir in bkup_status.all_bkup_dirs( cfg ):
+        try:
+            ts = int( os.path.basename( infodir ) )
+        except ValueError:
+            logr.warning( "Skipping '{0}', not a timestamp".format( infodir ) )
+            continue
+        if ( key, ts ) not in done:
+            todo.append( ( key, infodir ) )
+    logr.info( "Backfilling {0} infodirs ({1} recorded already)".format( len( todo ), len( done ) ) )
+    count = 0
+    with concurrent.futures.ProcessPoolExecutor( max_workers=jobs, initializer=_init_worker ) as pool:
+        futures = { pool.submit( collect, key, d ): d for key, d in todo }
+        for f in concurrent.futures.as_completed( futures ):
+            try:
+                backup, slices = f.result()
+            except ( OSError, ValueError, sqlite3.Error ) as e:
+                logr.warning( "Skipping '{0}': {1}".format( futures[ f ], e ) )
+                continue
+            record( db, backup, slices )
+            count += 1
+            logr.debug( "Recorded '{0}'".format( futures[ f ] ) )
+    print( 'Recorded {0} of {1} infodirs'.format( count, len( todo ) ) )
+
+
+def flag_slow( rates, baseline, sigma ):
+    ''' For each rate (None if unknown), in time order, return tuple of
+        ( baseline mean, z score ) against up to baseline earlier known rates,
+        ( None, None ) while there are fewer than MIN_BASELINE of them.
+        The standard deviation is at least MIN_REL_SD of the mean.
+    '''
+    rv = []
+    history = []
+    for r in rates:
+        if r is None:
+            rv.append( ( None, None ) )
+            continue
+        recent = history[ -baseline: ]
+        if len( recent ) < MIN_BASELINE:
+            rv.append( ( None, None ) )
+        else:
+            mean = statistics.mean( recent )
+            sd = max( statistics.pstdev( recent ), MIN_REL_SD * mean )
+            rv.append( ( mean, ( r - mean ) / sd if sd > 0 else 0.0 ) )
+        history.append( r )
+    return rv
+
+
+def _rate( nbytes, secs ):
+    return nbytes / secs if nbytes and secs else None
+
+
+def _mibs( v ):
+    return '-' if v is None else '{0:.1f}'.format( v / 1048576 )
+
+
+def _secs( v ):
+    return '-' if v is None else str( datetime.timedelta( seconds=int( v ) ) )
+
+
+def _z( v ):
+    return '-' if v is None else '{0:+.1f}'.format( v )
+
+
+def _flag( z, sigma ):
+    return 'SLOW' if z is not None and z < -sigma else ''
+
+
+def key_report( db, keys, baseline, sigma, last, slow_only ):
+    rows = [ ( 'DIRKEY', 'DATE', 'TYPE', 'SLICES', 'GIB', 'SCAN', 'SPLIT', 'DAR_WALL',
+               'MIB/S', 'BASE_MIB/S', 'SIGMA', 'FLAG' ) ]
+    query = ( 'SELECT key, ts, type, slices, bytes, scan_secs, split_secs, dar_wall_secs, '
+              'dar_secs FROM backups ORDER BY key, type, ts' )
+    groups = collections.OrderedDict()
+    for r in db.execute( query ):
+        if keys and r[0] not in keys:
+            continue
+        groups.setdefault( ( r[0], r[2] ), [] ).append( r )
+    out = []
+    for ( key, btype ), backups in groups.items():
+        rates = [ _rate( b[4], b[8] ) for b in backups ]
+        flags = flag_slow( rates, baseline, sigma )
+        lines = []
+        for b, rate, ( mean, z ) in zip( backups, rates, flags ):
+            if slow_only and not _flag( z, sigma ):
+                continue
+            lines.append( ( b[1], ( key,
+                datetime.datetime.fromtimestamp( b[1] ).strftime( '%Y-%m-%d' ),
+                btype, str( b[3] ), '{0:.1f}'.format( ( b[4] or 0 ) / 1073741824 ),
+                _secs( b[5] ), _secs( b[6] ), _secs( b[7] ),
+                _mibs( rate ), _mibs( mean ), _z( z ), _flag( z, sigma ) ) ) )
+        out.extend( lines[ -last: ] if last else lines )
+    out.sort( key=lambda x: ( x[1][0], x[0] ) )
+    rows.extend( r for ts, r in out )
+    print( 'Throughput of each backup, compared with the {0} before it of the same DIRKEY and type'.format(
+        baseline ) )
+    bkup_status.print_table( rows )
+
+
+def host_report( db, keys, baseline, sigma, last, slow_only ):
+    rows = [ ( 'HOST', 'MONTH', 'SLICES', 'GIB', 'DAR_HOURS', 'MIB/S', 'BASE_MIB/S', 'SIGMA', 'FLAG' ) ]
+    # dar seconds, as summary.dar_secs
+    query = ( 'SELECT key, host, start, bytes, elapsed - IFNULL( throttled_secs, 0 ) AS secs FROM slices '
+              'WHERE exitcode = 0 AND start IS NOT NULL AND secs > 0 ORDER BY host, start' )
+    months = collections.OrderedDict()
+    for key, host, start, nbytes, elapsed in db.execute( query ):
+        if keys and key not in keys:
+            continue
+        month = datetime.datetime.fromtimestamp( start ).strftime( '%Y-%m' )
+        m = months.setdefault( ( host or 'unknown', month ), [ 0, 0, 0 ] )
+        m[0] += 1
+        m[1] += nbytes or 0
+        m[2] += elapsed
+    by_host = collections.OrderedDict()
+    for ( host, month ), m in months.items():
+        by_host.setdefault( host, [] ).append( ( month, m ) )
+    for host, ms in by_host.items():
+        rates = [ _rate( m[1], m[2] ) for month, m in ms ]
+        flags = flag_slow( rates, baseline, sigma )
+        lines = []
+        for ( month, m ), rate, ( mean, z ) in zip( ms, rates, flags ):
+            if slow_only and not _flag( z, sigma ):
+                continue
+            lines.append( ( host, month, str( m[0] ), '{0:.1f}'.format( m[1] / 1073741824 ),
+                            '{0:.1f}'.format( m[2] / 3600 ), _mibs( rate ), _mibs( mean ),
+                            _z( z ), _flag( z, sigma ) ) )
+        rows.extend( lines[ -last: ] if last else lines )
+    print( 'Throughput of each host per month, compared with the {0} months before it'.format(
+        baseline ) )
+    bkup_status.print_table( rows )
+
+
+def run():
+    args = process_cmdline()
+    cfg = summary.load_cfg()
+    db = connect( args.db or db_path( cfg ) )
+    if args.action == 'add':
+        add( db, args.infodirs )
+    elif args.action == 'backfill':
+        backfill( db, cfg, args.jobs )
+    elif args.action == 'report':
+        hist = cfg[ 'HISTORY' ] if cfg.has_section( 'HISTORY' ) else {}
+        baseline = args.baseline or int( hist.get( 'BASELINE', '' ) or 10 )
+        sigma = args.sigma if args.sigma is not None else float( hist.get( 'SIGMA', '' ) or 2 )
+        keys = set( args.key or () )
+        key_report( db, keys, baseline, sigma, args.last, args.slow_only )
+        print()
+        host_report( db, keys, baseline, sigma, args.last, args.slow_only )
+    db.close()
+
+
+if __name__ == '__main__':
+    try:
+        run()
+    except ( UserWarning, OSError, sqlite3.Error ) as e:
+        logr.error( e )
+        sys.exit( 1 )
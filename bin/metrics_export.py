@@ -0,0 +1,269 @@
+#!/usr/bin/python3
+
+import argparse
+import collections
+import json
+import logging
+import os
+import pathlib
+import statistics
+import sys
+import time
+
+import summary
+
+logr = logging.getLogger()
+# dar_status.py imports this module and sets up its own handler
+if __name__ == '__main__':
+    console_handler = logging.StreamHandler()
+    formatter = logging.Formatter( '%(levelname)s [%(filename)s %(lineno)d] %(message)s' )
+    console_handler.setFormatter( formatter )
+    logr.addHandler( console_handler )
+    logr.setLevel( logging.WARNING )
+
+DESCRIPTION = '''
+    Export dar slice metrics of backups, running or finished, for graphing.
+    Slice values come from the slice ini files (through the summary.py
+    status cache) and are aggregated per worker host and per DIRKEY:
+    slice counts by state, input files and bytes, archive and catalogue
+    bytes, dar and verify seconds, throughput, and the most recent load
+    average of each host.
+    Output is a Prometheus textfile (for the node_exporter textfile
+    collector) or a json snapshot, which also lists every slice.
+    The output file is replaced atomically, so it can be written from cron.
+'''
+
+# Summed per group, from SliceStatus fields (and dar_secs) of finished slices
+SUM_FIELDS = ( 'files', 'bytes', 'archive_bytes', 'catalog_bytes', 'dar_secs', 'verify_elapsed',
+               'throttled_secs', 'est_archive_bytes' )
+
+STATES = ( 'running', 'succeeded', 'failed' )
+
+PROM_PREFIX = 'pdbkup'
+
+# name, help, type of the metrics of each group
+PROM_METRICS = (
+    ( 'slices', 'Dar slices by state', 'gauge' ),
+    ( 'pending_slices', 'Dar slices not started yet', 'gauge' ),
+    ( 'files', 'Input files of finished slices', 'gauge' ),
+    ( 'bytes', 'Input bytes of finished slices', 'gauge' ),
+    ( 'archive_bytes', 'Archive bytes of finished slices', 'gauge' ),
+    ( 'est_archive_bytes', 'Archive bytes of finished slices estimated by compress_probe.py', 'gauge' ),
+    ( 'catalog_bytes', 'Catalogue bytes of finished slices', 'gauge' ),
+    ( 'dar_seconds', 'Dar seconds of finished slices', 'gauge' ),
+    ( 'verify_seconds', 'Verify seconds of finished slices', 'gauge' ),
+    ( 'throttled_seconds', 'Seconds finished slices waited for or were paused by the throttle', 'gauge' ),
+    ( 'running_seconds', 'Seconds the longest running slice has been running', 'gauge' ),
+    ( 'rate_bytes_per_second', 'Input bytes per dar second of finished slices', 'gauge' ),
+    ( 'rate_files_per_second', 'Input files per dar second of finished slices', 'gauge' ),
+    ( 'median_slice_rate_bytes_per_second', 'Median input rate of single slices', 'gauge' ),
+    ( 'load_average', 'Most recent 1 minute load average seen by a slice', 'gauge' ),
+)
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser( description=DESCRIPTION )
+    parser.add_argument( 'infodirs', nargs='*', metavar='INFODIR',
+        help='bkup infodirs to export (default: the latest backup of each DIRKEY)' )
+    parser.add_argument( '-a', '--all', action='store_true',
+        help='export every current backup (not annals) of each DIRKEY' )
+    parser.add_argument( '-f', '--format', choices=( 'prom', 'json' ),
+        help='(default: %(default)s)' )
+    parser.add_argument( '-o', '--outfile', help='write here instead of stdout' )
+    parser.add_argument( '-v', '--verbose', action='store_true' )
+    parser.add_argument( '-d', '--debug', action='store_true' )
+    parser.set_defaults(
+        format = 'prom',
+    )
+    args = parser.parse_args()
+    if args.verbose:
+        logr.setLevel( logging.INFO )
+    if args.debug:
+        logr.setLevel( logging.DEBUG )
+    return args
+
+
+def current_bkup_dirs( cfg, latest_only=True ):
+    ''' Generate ( key, infodir ) of the current backups of every DIRKEY
+    '''
+    infodir = cfg[ 'GENERAL' ][ 'INFODIR' ]
+    for key in cfg[ 'DIRS' ]:
+        base = os.path.join( infodir, key )
+        if not os.path.isdir( base ):
+            continue
+        dirs = sorted( e.path for e in os.scandir( base ) if e.is_dir() )
+        if latest_only:
+            dirs = dirs[-1:]
+        for d in dirs:
+            yield ( key, d )
+
+
+def slice_state( s ):
+    if s.elapsed is None:
+        return 'running'
+    return 'succeeded' if s.exitcode == 0 else 'failed'
+
+
+def slice_records( key, infodir, now ):
+    ''' Return tuple of ( list of dicts, one per started slice; number of
+        slices not started yet )
+    '''
+    bkupdir = summary.BkupDir( pathlib.Path( infodir ) )
+    ts = os.path.basename( infodir )
+    records = []
+    for name, s in sorted( bkupdir.slices.items() ):
+        if s.start is None:
+            continue
+        r = collections.OrderedDict( [
+            ( 'dirkey', key ),
+            ( 'timestamp', ts ),
+            ( 'slice', name ),
+            ( 'host', s.hostname or 'unknown' ),
+            ( 'state', slice_state( s ) ),
+        ] )
+        r.update( ( k, v ) for k, v in zip( s._fields, s ) if k != 'hostname' )
+        r[ 'dar_secs' ] = summary.dar_secs( s )
+        if r[ 'state' ] == 'running':
+            r[ 'running_seconds' ] = max( 0, int( now - s.start ) )
+        records.append( r )
+    pending = max( 0, bkupdir.num_expected_slices - len( records ) )
+    return ( records, pending )
+
+
+def aggregate( records ):
+    ''' Return dict of metric name -> value (or dict of state -> value for
+        slices) over records
+    '''
+    agg = collections.OrderedDict()
+    agg[ 'slices' ] = collections.OrderedDict( ( st, 0 ) for st in STATES )
+    for f in SUM_FIELDS:
+        agg[ f ] = 0
+    agg[ 'running_seconds' ] = 0
+    rates = []
+    load = None
+    for r in records:
+        agg[ 'slices' ][ r[ 'state' ] ] += 1
+        if r[ 'state' ] == 'running':
+            agg[ 'running_seconds' ] = max( agg[ 'running_seconds' ], r[ 'running_seconds' ] )
+        if r[ 'state' ] == 'succeeded':
+            for f in SUM_FIELDS:
+                agg[ f ] += r[ f ] or 0
+            if r[ 'bytes' ] is not None:
+                rates.append( r[ 'bytes' ] / max( r[ 'dar_secs' ], 1 ) )
+        # latest reading wins, slices that are still running count as now
+        when = r[ 'end' ] if r[ 'loadavg_end' ] is not None else r[ 'start' ]
+        val = r[ 'loadavg_end' ] if r[ 'loadavg_end' ] is not None else r[ 'loadavg_start' ]
+        if val is not None and ( load is None or ( when or 0 ) >= load[0] ):
+            load = ( when or 0, val )
+    agg[ 'dar_seconds' ] = agg.pop( 'dar_secs' )
+    agg[ 'verify_seconds' ] = agg.pop( 'verify_elapsed' )
+    agg[ 'throttled_seconds' ] = agg.pop( 'throttled_secs' )
+    secs = max( agg[ 'dar_seconds' ], 1 )
+    agg[ 'rate_bytes_per_second' ] = round( agg[ 'bytes' ] / secs, 2 )
+    agg[ 'rate_files_per_second' ] = round( agg[ 'files' ] / secs, 2 )
+    agg[ 'median_slice_rate_bytes_per_second' ] = round( statistics.median( rates ), 2 ) if rates else 0
+    agg[ 'load_average' ] = load[1] if load else None
+    return agg
+
+
+def group_by( records, field ):
+    groups = collections.OrderedDict()
+    for r in sorted( records, key=lambda r: r[ field ] ):
+        groups.setdefault( r[ field ], [] ).append( r )
+    return groups
+
+
+def snapshot( bkup_dirs, now ):
+    ''' Return dict with per slice records and per host and per DIRKEY aggregates
+    '''
+    records = []
+    pending = collections.Counter()
+    for key, infodir in bkup_dirs:
+        logr.info( "Reading '{0}'".format( infodir ) )
+        recs, num_pending = slice_records( key, infodir, now )
+        records.extend( recs )
+        pending[ key ] += num_pending
+    hosts = collections.OrderedDict(
+        ( h, aggregate( recs ) ) for h, recs in group_by( records, 'host' ).items() )
+    dirkeys = collections.OrderedDict()
+    for key, recs in group_by( records, 'dirkey' ).items():
+        dirkeys[ key ] = aggregate( recs )
+    for key in sorted( pending ):
+        dirkeys.setdefault( key, aggregate( [] ) )[ 'pending_slices' ] = pending[ key ]
+    return collections.OrderedDict( [
+        ( 'time', int( now ) ),
+        ( 'hosts', hosts ),
+        ( 'dirkeys', dirkeys ),
+        ( 'slices', records ),
+    ] )
+
+
+def _prom_value( v ):
+    return repr( float( v ) ) if isinstance( v, float ) else str( v )
+
+
+def prom_lines( snap ):
+    ''' Generate lines of the Prometheus text format
+    '''
+    for scope, label in ( ( 'hosts', 'host' ), ( 'dirkeys', 'dirkey' ) ):
+        groups = snap[ scope ]
+        for name, text, mtype in PROM_METRICS:
+            samples = []
+            for g, agg in groups.items():
+                v = agg.get( name )
+                if v is None:
+                    continue
+                if isinstance( v, dict ):
+                    samples.extend( ( '{0}="{1}",state="{2}"'.format( label, g, st ), n )
+                                    for st, n in v.items() )
+                else:
+                    samples.append( ( '{0}="{1}"'.format( label, g ), v ) )
+            if not samples:
+                continue
+            metric = '{0}_{1}_{2}'.format( PROM_PREFIX, label, name )
+            yield '# HELP {0} {1}'.format( metric, text )
+            yield '# TYPE {0} {1}'.format( metric, mtype )
+            for labels, v in samples:
+                yield '{0}{{{1}}} {2}'.format( metric, labels, _prom_value( v ) )
+    metric = '{0}_metrics_time_seconds'.format( PROM_PREFIX )
+    yield '# HELP {0} When these metrics were exported'.format( metric )
+    yield '# TYPE {0} gauge'.format( metric )
+    yield '{0} {1}'.format( metric, snap[ 'time' ] )
+
+
+def write_output( text, outfile ):
+    if not outfile:
+        sys.stdout.write( text )
+        return
+    tmpfn = outfile + '.tmp'
+    with open( tmpfn, 'w' ) as f:
+        f.write( text )
+    os.rename( tmpfn, outfile )
+
+
+def run():
+    args = process_cmdline()
+    cfg = summary.load_cfg()
+    if args.infodirs:
+        bkup_dirs = []
+        for d in args.infodirs:
+            if not os.path.isdir( d ):
+                raise UserWarning( "Not a directory: '{0}'".format( d ) )
+            d = os.path.abspath( d )
+            bkup_dirs.append( ( os.path.basename( os.path.dirname( d ) ), d ) )
+    else:
+        bkup_dirs = list( current_bkup_dirs( cfg, latest_only=not args.all ) )
+    snap = snapshot( bkup_dirs, time.time() )
+    if args.format == 'json':
+        text = json.dumps( snap, indent=2 ) + '\n'
+    else:
+        text = ''.join( line + '\n' for line in prom_lines( snap ) )
+    write_output( text, args.outfile )
+
+
+if __name__ == '__main__':
+    try:
+        run()
+    except ( UserWarning, OSError ) as e:
+        logr.error( e )
+        sys.exit( 1 )
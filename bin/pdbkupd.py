@@ -0,0 +1,342 @@
+#!/usr/bin/python3
+
+import argparse
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import signal
+import struct
+import subprocess
+import sys
+import time
+
+import summary
+
+logr = logging.getLogger()
+console_handler = logging.StreamHandler()
+formatter = logging.Formatter( '%(asctime)s %(levelname)s [%(filename)s %(lineno)d] %(message)s' )
+console_handler.setFormatter( formatter )
+logr.addHandler( console_handler )
+logr.setLevel( logging.WARNING )
+
+DESCRIPTION = '''
+    Run the stages that follow a dar slice as soon as their input appears,
+    instead of waiting for cron. Each dar task verifies its slice and only
+    then moves the archive to DAR::ENDDIR (TXFR::SRCDIR_OUTBOUND), so
+    archives are transferred once verified:
+      worker   - sqlworker cmdfile in PARALLEL::WORKDIR      -> bkup startworker,
+                 run in the foreground and started again every
+                 WORKER_POLL_SECS while there are task queues
+      wrapup   - task queues, after each worker run and every
+                 TXFR_POLL_SECS                         -> bkup wrapup
+      transfer - archives in TXFR::SRCDIR_OUTBOUND          -> txfr startnew
+      clean    - tasks in TXFR::WORKDIR_OUTBOUND             -> txfr clean
+      purge    - files in PURGE::SRCDIR                      -> bkup purge
+    State directories are watched with inotify (or polled if inotify is not
+    available). Events are coalesced: a stage starts SETTLE_SECS after the
+    last event, or MAX_DELAY_SECS after the first, and never runs twice at
+    once. Transfer completion cannot be watched, so clean is polled every
+    TXFR_POLL_SECS while tasks are in flight. All state is read from the
+    directories at startup, so the daemon can be restarted at any time.
+'''
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+EVENT_HDR = struct.Struct( 'iIII' )
+
+# Longest sleep, so finished stages are noticed quickly
+MAX_SLEEP = 5
+
+# Secs before a stage whose command could not be started is tried again
+START_RETRY = 60
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser( description=DESCRIPTION )
+    parser.add_argument( '--poll', action='store_true',
+        help='Poll the state directories instead of using inotify' )
+    parser.add_argument( '--pidfile',
+        help='(default: DAEMON::PIDFILE or GENERAL::DATADIR/pdbkupd.pid)' )
+    parser.add_argument( '-v', '--verbose', action='store_true' )
+    parser.add_argument( '-d', '--debug', action='store_true' )
+    args = parser.parse_args()
+    if args.verbose:
+        logr.setLevel( logging.INFO )
+    if args.debug:
+        logr.setLevel( logging.DEBUG )
+    return args
+
+
+class InotifyWatcher( object ):
+    ''' Wait for new entries in a set of directories, using inotify through libc
+    '''
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__( self, dirs ):
+        self.libc = ctypes.CDLL( ctypes.util.find_library( 'c' ), use_errno=True )
+        self.fd = self.libc.inotify_init1( IN_NONBLOCK | IN_CLOEXEC )
+        if self.fd < 0:
+            raise OSError( ctypes.get_errno(), 'inotify_init1 failed' )
+        self.wds = {}
+        for d in dirs:
+            wd = self.libc.inotify_add_watch( self.fd, os.fsencode( d ), self.MASK )
+            if wd < 0:
+                raise OSError( ctypes.get_errno(), "inotify_add_watch failed for '{0}'".format( d ) )
+            self.wds[ wd ] = d
+
+    def wait( self, timeout ):
+        ''' Return set of ( dir, name ) of new entries, waiting at most timeout
+            secs. A name of None means anything in dir may have changed.
+        '''
+        r, w, x = select.select( [ self.fd ], [], [], timeout )
+        if not r:
+            return set()
+        try:
+            data = os.read( self.fd, 65536 )
+        except BlockingIOError:
+            return set()
+        changed = set()
+        pos = 0
+        while pos < len( data ):
+            wd, mask, cookie, namelen = EVENT_HDR.unpack_from( data, pos )
+            name = data[ pos + EVENT_HDR.size:pos + EVENT_HDR.size + namelen ].rstrip( b'\0' )
+            pos += EVENT_HDR.size + namelen
+            if mask & IN_Q_OVERFLOW:
+                # events were lost
+                return set( ( d, None ) for d in self.wds.values() )
+            if wd in self.wds:
+                changed.add( ( self.wds[ wd ], os.fsdecode( name ) ) )
+        return changed
+
+
+class PollWatcher( object ):
+    ''' Same as InotifyWatcher, by comparing directory listings every interval secs
+    '''
+    def __init__( self, dirs, interval ):
+        self.interval = interval
+        self.names = { d: self._list( d ) for d in dirs }
+
+    @staticmethod
+    def _list( d ):
+        try:
+            return set( os.listdir( d ) )
+        except OSError as e:
+            logr.warning( e )
+            return set()
+
+    def wait( self, timeout ):
+        time.sleep( max( 0, min( timeout, self.interval ) ) )
+        changed = set()
+        for d, old in self.names.items():
+            new = self._list( d )
+            changed.update( ( d, name ) for name in new - old )
+            self.names[ d ] = new
+        return changed
+
+
+def has_entries( path, suffix='' ):
+    try:
+        with os.scandir( path ) as it:
+            return any( e.name.endswith( suffix ) for e in it )
+    except OSError:
+        return False
+
+
+class Stage( object ):
+    ''' A command that runs when its watched directory (if any) gets new
+        entries ending in suffix. pending() tells whether there is input for the stage;
+        if input is left after a run, the stage runs again recheck secs later.
+        When a run finishes, the stages named in after that have input are
+        triggered too.
+    '''
+    def __init__( self, name, cmd, watch, settle, max_delay,
+                  suffix='', pending=None, recheck=None, after=() ):
+        self.name = name
+        self.cmd = cmd
+        self.watch = watch
+        self.suffix = suffix
+        self.settle = settle
+        self.max_delay = max_delay
+        self.pending = pending
+        self.recheck = recheck
+        self.after = after
+        self.first_event = None
+        self.last_event = None
+        self.wake_at = None
+        self.proc = None
+
+    def matches( self, d, name ):
+        return d == self.watch and ( name is None or name.endswith( self.suffix ) )
+
+    def trigger( self, now ):
+        if self.first_event is None:
+            self.first_event = now
+        self.last_event = now
+
+    def due( self ):
+        ''' Return time the stage should start, or None if it has nothing to do
+        '''
+        times = []
+        if self.first_event is not None:
+            times.append( min( self.last_event + self.settle, self.first_event + self.max_delay ) )
+        if self.wake_at is not None:
+            times.append( self.wake_at )
+        return min( times, default=None )
+
+    def start( self, now ):
+        logr.info( "Starting {0}: {1}".format( self.name, ' '.join( self.cmd ) ) )
+        self.first_event = None
+        self.last_event = None
+        self.wake_at = None
+        try:
+            self.proc = subprocess.Popen( self.cmd, stdin=subprocess.DEVNULL )
+        except OSError as e:
+            logr.error( "Cannot start {0}, retry in {1} secs: {2}".format( self.name, START_RETRY, e ) )
+            self.wake_at = now + START_RETRY
+
+    def check( self, now ):
+        ''' Reap a finished run, return True if the stage just finished
+        '''
+        if self.proc is None or self.proc.poll() is None:
+            return False
+        rc = self.proc.returncode
+        self.proc = None
+        if rc != 0:
+            logr.warning( "{0} exited with code {1}".format( self.name, rc ) )
+        else:
+            logr.info( "{0} done".format( self.name ) )
+        if self.recheck and self.pending and self.pending():
+            self.wake_at = now + self.recheck
+        return True
+
+
+def mk_stages( cfg ):
+    base = os.environ[ 'PDBKUP_BASE' ]
+    run_sh = os.path.join( base, 'bin', 'run.sh' )
+    datadir = cfg[ 'GENERAL' ][ 'DATADIR' ]
+    daemon = cfg[ 'DAEMON' ] if cfg.has_section( 'DAEMON' ) else {}
+    settle = int( daemon.get( 'SETTLE_SECS', 30 ) )
+    max_delay = int( daemon.get( 'MAX_DELAY_SECS', 300 ) )
+    poll = int( daemon.get( 'TXFR_POLL_SECS', 300 ) )
+    worker_poll = int( daemon.get( 'WORKER_POLL_SECS', 60 ) )
+    # relative to DATADIR unless absolute
+    queuedir = os.path.join( datadir, cfg[ 'PARALLEL' ][ 'WORKDIR' ] )
+    readydir = os.path.join( datadir, cfg[ 'TXFR' ][ 'SRCDIR_OUTBOUND' ] )
+    txfrdir = os.path.join( datadir, cfg[ 'TXFR' ][ 'WORKDIR_OUTBOUND' ] )
+    purgedir = os.path.join( datadir, cfg[ 'PURGE' ][ 'SRCDIR' ] )
+    return [
+        # the task queue databases live here too, only cmdfiles count;
+        # the worker of this node, in place of the sqlworker script's 'at'
+        Stage( 'worker', [ run_sh, 'bkup', 'startworker', '--fg' ], queuedir, settle, max_delay,
+               suffix='.sqlworker.cmd',
+               pending=lambda: has_entries( queuedir, '.sqlworker.cmd' ), recheck=worker_poll,
+               after=( 'wrapup', ) ),
+        # finished queues get their infodir archived for transfer; tasks of
+        # other nodes' workers can finish at any time, so look again later
+        Stage( 'wrapup', [ run_sh, 'bkup', 'wrapup' ], None, settle, max_delay,
+               pending=lambda: has_entries( queuedir, '.sqlworker.cmd' ), recheck=poll ),
+        # a batch that is not full is held back by txfr startnew, look again later
+        Stage( 'transfer', [ run_sh, 'txfr', 'startnew' ], readydir, settle, max_delay,
+               pending=lambda: has_entries( readydir ), recheck=poll ),
+        # finished tasks free slots for more transfers
+        Stage( 'clean', [ run_sh, 'txfr', 'clean' ], txfrdir, poll, poll,
+               suffix='.filelist',
+               pending=lambda: has_entries( txfrdir, '.filelist' ), recheck=poll,
+               after=( 'transfer', ) ),
+        Stage( 'purge', [ run_sh, 'bkup', 'purge' ], purgedir, settle, max_delay,
+               pending=lambda: has_entries( purgedir ) ),
+    ]
+
+
+def write_pidfile( fn ):
+    ''' Refuse to run if another daemon owns fn
+    '''
+    try:
+        with open( fn ) as f:
+            pid = int( f.read().strip() )
+        os.kill( pid, 0 )
+    except ( OSError, ValueError ):
+        pass
+    else:
+        raise UserWarning( "pdbkupd is already running as pid {0} (see '{1}')".format( pid, fn ) )
+    tmpfn = fn + '.tmp'
+    with open( tmpfn, 'w' ) as f:
+        f.write( '{0}\n'.format( os.getpid() ) )
+    os.rename( tmpfn, fn )
+
+
+def run():
+    args = process_cmdline()
+    cfg = summary.load_cfg()
+    pidfile = args.pidfile
+    if not pidfile and cfg.has_section( 'DAEMON' ):
+        pidfile = cfg[ 'DAEMON' ].get( 'PIDFILE' )
+    if not pidfile:
+        pidfile = os.path.join( cfg[ 'GENERAL' ][ 'DATADIR' ], 'pdbkupd.pid' )
+    write_pidfile( pidfile )
+    stages = mk_stages( cfg )
+    dirs = sorted( set( s.watch for s in stages if s.watch ) )
+    poll = min( s.settle for s in stages ) or 1
+    watcher = None
+    if not args.poll:
+        try:
+            watcher = InotifyWatcher( dirs )
+        except ( OSError, AttributeError, TypeError ) as e:
+            logr.warning( "inotify not available ({0}), polling instead".format( e ) )
+    if watcher is None:
+        watcher = PollWatcher( dirs, poll )
+
+    stopping = []
+    def stop( signum, frame ):
+        logr.info( "Got signal {0}, stopping".format( signum ) )
+        stopping.append( signum )
+    signal.signal( signal.SIGTERM, stop )
+    signal.signal( signal.SIGINT, stop )
+
+    # rebuild state: anything already waiting is treated as new
+    now = time.time()
+    for s in stages:
+        if s.pending and s.pending():
+            logr.info( "{0}: input found at startup".format( s.name ) )
+            s.trigger( now )
+    try:
+        while not stopping:
+            now = time.time()
+            for s in stages:
+                if s.check( now ):
+                    for other in stages:
+                        if other.name in s.after and other.pending():
+                            other.trigger( now )
+            for s in stages:
+                due = s.due()
+                if s.proc is None and due is not None and due <= now:
+                    s.start( now )
+            waits = [ s.due() - now for s in stages if s.due() is not None and s.proc is None ]
+            timeout = max( 0, min( waits + [ MAX_SLEEP ] ) )
+            try:
+                changed = watcher.wait( timeout )
+            except InterruptedError:
+                continue
+            now = time.time()
+            for d, name in changed:
+                for s in stages:
+                    if s.matches( d, name ):
+                        logr.debug( "{0}: new entry '{1}' in '{2}'".format( s.name, name, d ) )
+                        s.trigger( now )
+    finally:
+        os.remove( pidfile )
+
+
+if __name__ == '__main__':
+    try:
+        run()
+    except ( UserWarning, OSError ) as e:
+        logr.error( e )
+        sys.exit( 1 )
@@ -0,0 +1,530 @@
+#!/usr/bin/python3
+
+import argparse
+import collections
+import concurrent.futures
+import configparser
+import glob
+import logging
+import math
+import os
+import re
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+logr = logging.getLogger()
+console_handler = logging.StreamHandler()
+formatter = logging.Formatter( '%(levelname)s [%(filename)s %(lineno)d] %(message)s' )
+console_handler.setFormatter( formatter )
+logr.addHandler( console_handler )
+logr.setLevel( logging.WARNING )
+
+DESCRIPTION = '''
+    Restore a DIRKEY from its dar slices (see xtract_dar).
+    The plan is built from the slice ini files in the backup dirs: the
+    newest FULL backup, then each INCR after it in timestamp order. Each
+    backup is one stage; the slices of a stage are extracted concurrently,
+    largest first, and a stage starts only when the one before it is done.
+    Every finished slice leaves a marker in the state dir, so a restore that
+    was interrupted resumes where it stopped. A slice being extracted has an
+    active marker with its host and pid, updated every ACTIVE_HEARTBEAT
+    secs; workers waiting for a stage count a slice whose marker went stale
+    (or that never got one) as failed, so a node that died does not hold up
+    the others forever.
+      plan   - print the stages and which slices are done
+      purge  - empty the restore root, in parallel, and forget finished slices
+      run    - extract on this node
+      queue  - make one sqlmaster queue per stage and a sqlworker cmd file
+               that any number of nodes can run (see worker)
+      worker - work through the stage queues, waiting for each stage to be
+               finished by all nodes before starting the next
+      extract - extract one slice (the task that run and worker execute)
+'''
+
+DAR_OPTS = [ '--no-warn=all', '-Q', '--verbose=all', '--overwriting-policy', 'Oo' ]
+
+# KEY_TIMESTAMP_TYPE_NNNN, see mk_bkup_tasks
+FNBASE_RE = re.compile( r'^(?P<key>.+?)_(?P<ts>[0-9]+)_(?P<type>[A-Z]+)_(?P<num>[0-9]{4})$' )
+DAR_SUFFIX = '.dar.1.dar'
+
+# Give each concurrent dar at least this much of a stage to extract
+MIN_JOB_BYTES = 1024**3
+
+# Secs between checks for slices other nodes are still extracting
+BARRIER_POLL = 10
+
+# Secs between updates of the active marker of a slice being extracted
+ACTIVE_HEARTBEAT = 60
+
+# Secs after which an active marker that was not updated is taken as dead,
+# also how long a slice taken from a queue may go without one
+ACTIVE_STALE = 600
+
+Slice = collections.namedtuple( 'Slice', 'fnbase key ts bkuptype num darbase size' )
+Stage = collections.namedtuple( 'Stage', 'ts bkuptype slices' )
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser( description=DESCRIPTION,
+        formatter_class=argparse.RawDescriptionHelpFormatter )
+    parser.add_argument( '-b', '--bkupdir', action='append',
+        help=( 'dir with the slice ini files and dar archives of a backup, '
+               'repeat for each backup in the chain (default: dir of this script)' ) )
+    parser.add_argument( '-s', '--statedir',
+        help='where logs and finished-slice markers are kept (default: the first bkupdir)' )
+    parser.add_argument( '-j', '--max_jobs', type=int,
+        help='max concurrent dar (or deletes, for purge) on this node (default: one per core)' )
+    parser.add_argument( '--dar_cmd', help='dar executable (default: %(default)s)' )
+    parser.add_argument( '--parallel_cmd', help='GNU parallel executable (default: %(default)s)' )
+    parser.add_argument( '-v', '--verbose', action='store_true' )
+    parser.add_argument( '-d', '--debug', action='store_true' )
+    subparsers = parser.add_subparsers( dest='action' )
+    subparsers.add_parser( 'plan', help='Print the restore plan' )
+    for name in ( 'purge', 'run', 'queue', 'worker' ):
+        p = subparsers.add_parser( name )
+        p.add_argument( 'root', help='restore root' )
+    p_extract = subparsers.add_parser( 'extract' )
+    p_extract.add_argument( 'root', help='restore root' )
+    p_extract.add_argument( 'darbase', help='dar archive basename (without .1.dar)' )
+    here = os.path.dirname( os.path.abspath( __file__ ) )
+    local_dar = os.path.join( here, 'dar' )
+    parser.set_defaults(
+        dar_cmd = shutil.which( 'dar' ) or local_dar,
+        parallel_cmd = 'parallel',
+    )
+    args = parser.parse_args()
+    if args.verbose:
+        logr.setLevel( logging.INFO )
+    if args.debug:
+        logr.setLevel( logging.DEBUG )
+    if not args.action:
+        parser.error( 'missing action' )
+    if not args.bkupdir:
+        args.bkupdir = [ here ]
+    args.bkupdir = [ os.path.abspath( d ) for d in args.bkupdir ]
+    if not args.statedir:
+        args.statedir = args.bkupdir[0]
+    if args.max_jobs is not None and args.max_jobs < 1:
+        parser.error( 'max_jobs must be at least 1' )
+    if hasattr( args, 'root' ):
+        args.root = os.path.abspath( args.root )
+    return args
+
+
+def num_cpus():
+    try:
+        return len( os.sched_getaffinity( 0 ) )
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def num_jobs( sizes, max_jobs=None ):
+    ''' Concurrent dar for a stage: one per core, but no more than the stage
+        has slices, or MIN_JOB_BYTES chunks of data
+    '''
+    n = min( num_cpus(), len( sizes ), max( 1, math.ceil( sum( sizes ) / MIN_JOB_BYTES ) ) )
+    if max_jobs:
+        n = min( n, max_jobs )
+    return max( n, 1 )
+
+
+def find_archives( dirs ):
+    ''' Return dict of fnbase -> darbase for every slice archive below dirs
+    '''
+    archives = {}
+    for d in dirs:
+        for dirpath, dirnames, filenames in os.walk( d ):
+            for fn in filenames:
+                if fn.endswith( DAR_SUFFIX ):
+                    fnbase = fn[ :-len( DAR_SUFFIX ) ]
+                    archives.setdefault( fnbase, os.path.join( dirpath, fnbase + '.dar' ) )
+    return archives
+
+
+def find_slices( bkupdirs ):
+    ''' Return list of Slice for the slice ini files in bkupdirs
+    '''
+    archives = find_archives( bkupdirs )
+    slices = {}
+    unfinished = set()
+    for d in bkupdirs:
+        for inifile in glob.glob( os.path.join( d, '*_[0-9][0-9][0-9][0-9].ini' ) ):
+            fnbase = os.path.basename( inifile )[ :-len( '.ini' ) ]
+            m = FNBASE_RE.match( fnbase )
+            if not m or fnbase in slices:
+                continue
+            cfg = configparser.ConfigParser( interpolation=None )
+            cfg.optionxform = lambda option: option
+            cfg.read( inifile )
+            exitcode = cfg.get( 'DAR', 'EXITCODE', fallback=None )
+            if exitcode != '0':
+                logr.warning( "Slice '{0}' did not finish (EXITCODE {1}), its files "
+                              "cannot be restored".format( fnbase, exitcode ) )
+                unfinished.add( fnbase )
+                continue
+            darbase = archives.get( fnbase )
+            if darbase is None:
+                raise UserWarning( "No archive '{0}{1}' below {2}".format(
+                    fnbase, DAR_SUFFIX, ', '.join( bkupdirs ) ) )
+            slices[ fnbase ] = Slice( fnbase, m.group( 'key' ), m.group( 'ts' ), m.group( 'type' ),
+                                      m.group( 'num' ), darbase,
+                                      os.path.getsize( darbase + '.1.dar' ) )
+    unknown = set( archives ) - set( slices ) - unfinished
+    if unknown:
+        logr.warning( "Archives without a finished slice ini are skipped: {0}".format(
+            ', '.join( sorted( unknown ) ) ) )
+    return list( slices.values() )
+
+
+def mk_plan( slices ):
+    ''' Return list of Stage: the newest FULL, then the INCRs after it by
+        timestamp. Slices of a stage are largest first.
+    '''
+    if not slices:
+        raise UserWarning( "No slices found" )
+    keys = set( s.key for s in slices )
+    if len( keys ) > 1:
+        raise UserWarning( "Slices of more than one DIRKEY found: {0}".format( ', '.join( sorted( keys ) ) ) )
+    backups = collections.defaultdict( list )
+    for s in slices:
+        backups[ ( int( s.ts ), s.ts, s.bkuptype ) ].append( s )
+    order = sorted( backups )
+    fulls = [ i for i, b in enumerate( order ) if b[2] == 'FULL' ]
+    if not fulls:
+        raise UserWarning( "No FULL backup found, an INCR cannot be restored on its own" )
+    if fulls[-1] > 0:
+        logr.warning( "Ignoring backups older than the newest FULL: {0}".format(
+            ', '.join( b[1] for b in order[ :fulls[-1] ] ) ) )
+    stages = []
+    for b in order[ fulls[-1]: ]:
+        stages.append( Stage( b[1], b[2],
+            sorted( backups[ b ], key=lambda s: ( -s.size, s.fnbase ) ) ) )
+    return stages
+
+
+class State( object ):
+    ''' Logs and markers of finished slices, plus restore.ini (see verify_restore)
+    '''
+    def __init__( self, statedir ):
+        self.statedir = statedir
+        self.inifile = os.path.join( statedir, 'restore.ini' )
+
+    def path( self, fnbase, suffix ):
+        return os.path.join( self.statedir, '{0}.dar.restore.{1}'.format( fnbase, suffix ) )
+
+    def is_done( self, fnbase ):
+        return os.path.exists( self.path( fnbase, 'done' ) )
+
+    def is_failed( self, fnbase ):
+        return os.path.exists( self.path( fnbase, 'failed' ) )
+
+    def set_active( self, fnbase ):
+        ''' Mark fnbase as being extracted by this process
+        '''
+        fn = self.path( fnbase, 'active' )
+        with open( fn + '.tmp', 'w' ) as f:
+            f.write( '{0} {1}\n'.format( socket.gethostname(), os.getpid() ) )
+        os.rename( fn + '.tmp', fn )
+
+    def heartbeat( self, fnbase ):
+        os.utime( self.path( fnbase, 'active' ) )
+
+    def active( self, fnbase ):
+        ''' Return tuple of ( host, pid, secs since the last heartbeat ) of
+            the process extracting fnbase, None if there is none
+        '''
+        fn = self.path( fnbase, 'active' )
+        try:
+            with open( fn ) as f:
+                host, pid = f.read().split()
+            age = time.time() - os.path.getmtime( fn )
+        except ( OSError, ValueError ):
+            return None
+        return ( host, int( pid ), age )
+
+    def mark( self, fnbase, status, root ):
+        fn = self.path( fnbase, status )
+        with open( fn + '.tmp', 'w' ) as f:
+            f.write( root + '\n' )
+        os.rename( fn + '.tmp', fn )
+
+    def clear( self, fnbase=None ):
+        ''' Forget finished slices, all of them if fnbase is None
+        '''
+        pattern = '{0}.dar.restore.*'.format( fnbase or '*' )
+        for fn in glob.glob( os.path.join( self.statedir, pattern ) ):
+            if fn.endswith( ( '.done', '.failed', '.active' ) ):
+                os.remove( fn )
+
+    def root( self ):
+        cfg = configparser.ConfigParser( interpolation=None )
+        cfg.read( self.inifile )
+        return cfg.get( 'RESTORE', 'ROOT', fallback=None )
+
+    def set_root( self, root ):
+        ''' Save root in restore.ini. Markers of a restore to another root
+            do not count for this one.
+        '''
+        old = self.root()
+        if old == root:
+            return
+        if old is not None:
+            logr.warning( "Restore root changed from '{0}', starting over".format( old ) )
+        self.clear()
+        cfg = configparser.ConfigParser( interpolation=None )
+        cfg.optionxform = lambda option: option
+        cfg.read( self.inifile )
+        if not cfg.has_section( 'RESTORE' ):
+            cfg.add_section( 'RESTORE' )
+        cfg.set( 'RESTORE', 'ROOT', root )
+        with open( self.inifile + '.tmp', 'w' ) as f:
+            cfg.write( f )
+        os.rename( self.inifile + '.tmp', self.inifile )
+
+
+def extract( darbase, root, dar_cmd, state ):
+    ''' Extract one slice into root. Return dar exit code.
+    '''
+    fnbase = os.path.basename( darbase )[ :-len( '.dar' ) ]
+    state.clear( fnbase )
+    cmd = [ dar_cmd ] + DAR_OPTS + [ '--extract', darbase, '--fs-root', root ]
+    logr.info( "Extracting '{0}'".format( fnbase ) )
+    start = time.time()
+    state.set_active( fnbase )
+    with open( state.path( fnbase, 'log' ), 'wb' ) as log, \
+         open( state.path( fnbase, 'err' ), 'wb' ) as err:
+        proc = subprocess.Popen( cmd, stdin=subprocess.DEVNULL, stdout=log, stderr=err )
+        while True:
+            try:
+                rc = proc.wait( timeout=ACTIVE_HEARTBEAT )
+                break
+            except subprocess.TimeoutExpired:
+                state.heartbeat( fnbase )
+    end = time.time()
+    with open( state.path( fnbase, 'cmd.log' ), 'w' ) as f:
+        f.write( 'STARTTIME: {0:.0f}\nENDTIME: {1:.0f}\nELAPSED_SECONDS: {2:.0f}\nEXITCODE: {3}\n'.format(
+            start, end, end - start, rc ) )
+    state.mark( fnbase, 'done' if rc == 0 else 'failed', root )
+    os.remove( state.path( fnbase, 'active' ) )
+    if rc != 0:
+        logr.warning( "dar exited with code {0} for '{1}', see '{2}'".format(
+            rc, fnbase, state.path( fnbase, 'err' ) ) )
+    return rc
+
+
+def print_plan( stages, state ):
+    for i, stage in enumerate( stages ):
+        done = sum( 1 for s in stage.slices if state.is_done( s.fnbase ) )
+        print( 'STAGE {0} {1} {2} slices={3} bytes={4} done={5} jobs={6}'.format(
+            i, stage.ts, stage.bkuptype, len( stage.slices ),
+            sum( s.size for s in stage.slices ), done,
+            num_jobs( [ s.size for s in stage.slices ] ) ) )
+        for s in stage.slices:
+            print( '  {0} {1} {2}'.format( s.fnbase, s.size,
+                'DONE' if state.is_done( s.fnbase ) else
+                'FAILED' if state.is_failed( s.fnbase ) else 'TODO' ) )
+
+
+def _rm( path ):
+    try:
+        if os.path.isdir( path ) and not os.path.islink( path ):
+            shutil.rmtree( path )
+        else:
+            os.remove( path )
+    except FileNotFoundError:
+        pass
+
+
+def purge( root, jobs ):
+    ''' Remove everything below root, keeping root.
+        Subtrees two levels down are removed by a pool of threads (deletes
+        are metadata bound, so threads overlap well), then what is left.
+    '''
+    if not os.path.isdir( root ):
+        os.makedirs( root )
+        return
+    tops = [ e for e in os.scandir( root ) ]
+    paths = []
+    for e in tops:
+        if e.is_dir( follow_symlinks=False ):
+            paths.extend( sub.path for sub in os.scandir( e.path ) )
+        else:
+            paths.append( e.path )
+    logr.info( "Removing {0} entries below '{1}' with {2} threads".format( len( paths ), root, jobs ) )
+    with concurrent.futures.ThreadPoolExecutor( max_workers=jobs ) as pool:
+        list( pool.map( _rm, paths ) )
+    for e in tops:
+        _rm( e.path )
+
+
+def run_stage( stage, root, args, state ):
+    ''' Extract the slices of a stage that are not done on this node.
+        Return number of failed slices.
+    '''
+    todo = [ s for s in stage.slices if not state.is_done( s.fnbase ) ]
+    if not todo:
+        return 0
+    jobs = num_jobs( [ s.size for s in todo ], args.max_jobs )
+    logr.info( "Stage {0} {1}: {2} slices, {3} jobs".format( stage.ts, stage.bkuptype, len( todo ), jobs ) )
+    with concurrent.futures.ThreadPoolExecutor( max_workers=jobs ) as pool:
+        codes = list( pool.map( lambda s: extract( s.darbase, root, args.dar_cmd, state ), todo ) )
+    return sum( 1 for rc in codes if rc != 0 )
+
+
+def dburl( queuefile ):
+    ''' sqlite dburl for GNU parallel, same as xtract_dar used to make
+    '''
+    return 'sqlite3:///{0}/tasks'.format( queuefile.replace( '/', '%2F' ) )
+
+
+def queuefile( state, i ):
+    return os.path.join( state.statedir, 'restore.stage{0:02d}.queue'.format( i ) )
+
+
+def task_cmd( s, root, args ):
+    return ' '.join( shlex.quote( a ) for a in [
+        'python3', os.path.abspath( __file__ ),
+        '--statedir', args.statedir, '--dar_cmd', args.dar_cmd,
+        'extract', root, s.darbase ] )
+
+
+def mk_queues( stages, root, args, state ):
+    ''' One sqlmaster queue per stage holding the slices not done yet,
+        largest first. Return path of the sqlworker cmd file.
+    '''
+    for i, stage in enumerate( stages ):
+        qfile = queuefile( state, i )
+        if os.path.exists( qfile ):
+            os.remove( qfile )
+        todo = [ s for s in stage.slices if not state.is_done( s.fnbase ) ]
+        if not todo:
+            continue
+        proc = subprocess.run( [ args.parallel_cmd, '--sqlmaster', dburl( qfile ), 'bash', '-c' ],
+            input=''.join( task_cmd( s, root, args ) + '\n' for s in todo ),
+            universal_newlines=True )
+        if proc.returncode != 0:
+            raise UserWarning( "Creating queue '{0}' failed with code {1}".format( qfile, proc.returncode ) )
+    cmdfile = os.path.join( state.statedir, 'restore.sqlworker.cmd' )
+    worker = [ 'python3', os.path.abspath( __file__ ) ]
+    for d in args.bkupdir:
+        worker += [ '--bkupdir', d ]
+    worker += [ '--statedir', args.statedir, '--dar_cmd', args.dar_cmd,
+                '--parallel_cmd', args.parallel_cmd ]
+    with open( cmdfile + '.tmp', 'w' ) as f:
+        f.write( '#!/bin/bash\n' )
+        f.write( '# Run on every restore node, concurrency follows the cores of each node\n' )
+        f.write( ' '.join( shlex.quote( a ) for a in worker )
+                 + ' "$@" worker {0}\n'.format( shlex.quote( root ) ) )
+    os.rename( cmdfile + '.tmp', cmdfile )
+    return cmdfile
+
+
+def is_stale( state, fnbase, waiting_since ):
+    ''' True if the process extracting fnbase stopped: its active marker was
+        not updated for ACTIVE_STALE secs, or its pid is gone (on this host),
+        or it had none for ACTIVE_STALE secs of waiting
+    '''
+    active = state.active( fnbase )
+    if active is None:
+        # finished since the caller looked
+        if state.is_done( fnbase ) or state.is_failed( fnbase ):
+            return False
+        if time.time() - waiting_since < ACTIVE_STALE:
+            return False
+        logr.error( "Slice '{0}' was not started in {1} secs".format( fnbase, ACTIVE_STALE ) )
+        return True
+    host, pid, age = active
+    if age >= ACTIVE_STALE:
+        logr.error( "Slice '{0}' on {1} pid {2} stopped updating {3:.0f} secs ago".format(
+            fnbase, host, pid, age ) )
+        return True
+    if host == socket.gethostname() and not _alive( pid ):
+        logr.error( "Slice '{0}' on {1} pid {2} is gone".format( fnbase, host, pid ) )
+        return True
+    return False
+
+
+def _alive( pid ):
+    try:
+        os.kill( pid, 0 )
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def work_queues( stages, root, args, state ):
+    ''' Take tasks from each stage queue until it is empty, then wait for the
+        other nodes to finish the stage. Return number of failed slices.
+    '''
+    for i, stage in enumerate( stages ):
+        qfile = queuefile( state, i )
+        if os.path.exists( qfile ):
+            jobs = num_jobs( [ s.size for s in stage.slices ], args.max_jobs )
+            logr.info( "Stage {0} {1}: working queue with {2} jobs".format( stage.ts, stage.bkuptype, jobs ) )
+            subprocess.call( [ args.parallel_cmd, '-j', str( jobs ),
+                               '--sqlworker', dburl( qfile ), 'bash', '-c' ] )
+        waiting_since = time.time()
+        while True:
+            left = [ s for s in stage.slices
+                     if not ( state.is_done( s.fnbase ) or state.is_failed( s.fnbase ) ) ]
+            if not left:
+                break
+            for s in left:
+                if is_stale( state, s.fnbase, waiting_since ):
+                    state.mark( s.fnbase, 'failed', root )
+            logr.info( "Stage {0}: waiting for {1} slices on other nodes".format( stage.ts, len( left ) ) )
+            time.sleep( BARRIER_POLL )
+        failed = [ s.fnbase for s in stage.slices if state.is_failed( s.fnbase ) ]
+        if failed:
+            logr.error( "Stage {0} {1} has failed slices: {2}".format(
+                stage.ts, stage.bkuptype, ', '.join( failed ) ) )
+            return len( failed )
+    return 0
+
+
+def run():
+    args = process_cmdline()
+    state = State( args.statedir )
+    if args.action == 'extract':
+        if state.root() not in ( None, args.root ):
+            raise UserWarning( "Restore root is '{0}' in '{1}'".format( state.root(), state.inifile ) )
+        sys.exit( 1 if extract( args.darbase, args.root, args.dar_cmd, state ) else 0 )
+    if args.action == 'purge':
+        purge( args.root, args.max_jobs or 4 * num_cpus() )
+        state.clear()
+        return
+    stages = mk_plan( find_slices( args.bkupdir ) )
+    if args.action == 'plan':
+        print_plan( stages, state )
+        return
+    if not os.path.isdir( args.root ):
+        os.makedirs( args.root )
+    state.set_root( args.root )
+    if args.action == 'run':
+        for stage in stages:
+            failed = run_stage( stage, args.root, args, state )
+            if failed:
+                raise UserWarning( "Stage {0} {1}: {2} slices failed, later stages were not "
+                                   "started".format( stage.ts, stage.bkuptype, failed ) )
+        print( 'Restore complete' )
+    elif args.action == 'queue':
+        cmdfile = mk_queues( stages, args.root, args, state )
+        print( cmdfile )
+    elif args.action == 'worker':
+        if work_queues( stages, args.root, args, state ):
+            sys.exit( 1 )
+        print( 'Restore complete' )
+
+
+if __name__ == '__main__':
+    try:
+        run()
+    except ( UserWarning, OSError ) as e:
+        logr.error( e )
+        sys.exit( 1 )
@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+
+import argparse
+import collections
+import itertools
+import logging
+import os
+import pathlib
+import sys
+
+import summary
+
+logr = logging.getLogger()
+console_handler = logging.StreamHandler()
+formatter = logging.Formatter( '%(levelname)s [%(filename)s %(lineno)d] %(message)s' )
+console_handler.setFormatter( formatter )
+logr.addHandler( console_handler )
+logr.setLevel( logging.WARNING )
+
+DESCRIPTION = '''
+    Predict the dar runtime of each slice of a new backup.
+    ELAPSED = INTERCEPT + PER_FILE * FILES + PER_BYTE * BYTES is fitted, by
+    least squares with no negative coefficients, on the successful slices of
+    earlier backups of the same DIRKEY (read through the summary.py status
+    cache). FILES and BYTES of each slice are saved in its ini file by
+    mk_bkup_tasks.
+'''
+
+Model = collections.namedtuple( 'Model', 'intercept per_file per_byte samples' )
+
+# Rough dar throughput, only used until a DIRKEY has enough history
+DEFAULT_MODEL = Model( 0.0, 1.0e-3, 1.0e-8, 0 )
+
+# Fewer successful slices than this and DEFAULT_MODEL is used
+MIN_SAMPLES = 10
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser( description=DESCRIPTION )
+    parser.add_argument( '-k', '--key', required=True, help='DIRKEY of the backup' )
+    parser.add_argument( '-x', '--exclude', action='append',
+        help='infodir to leave out of the history, ie: the current backup (repeatable)' )
+    parser.add_argument( '-n', '--max_history', type=int,
+        help='number of most recent earlier backups to fit on (default: %(default)s)' )
+    parser.add_argument( '-v', '--verbose', action='store_true' )
+    parser.add_argument( '-d', '--debug', action='store_true' )
+    subparsers = parser.add_subparsers( dest='action' )
+    subparsers.add_parser( 'fit', help='Print the fitted model' )
+    p_predict = subparsers.add_parser( 'predict',
+        help=( 'Read "KEY FILES BYTES" lines (see split_filelist.py --bins) and print '
+               '"KEY FILES BYTES PREDICTED_ELAPSED", longest first' ) )
+    p_predict.add_argument( 'binsfile', type=argparse.FileType( 'r' ) )
+    parser.set_defaults(
+        exclude = [],
+        max_history = 10,
+    )
+    args = parser.parse_args()
+    if args.verbose:
+        logr.setLevel( logging.INFO )
+    if args.debug:
+        logr.setLevel( logging.DEBUG )
+    if not args.action:
+        parser.error( 'missing action' )
+    return args
+
+
+def history_dirs( cfg, key, exclude=(), max_history=10 ):
+    ''' Return the infodirs of the max_history most recent backups of key,
+        current or annal, newest first
+    '''
+    exclude = set( os.path.realpath( d ) for d in exclude )
+    infodir = cfg[ 'GENERAL' ][ 'INFODIR' ]
+    annaldir = cfg[ 'GENERAL' ].get( 'ANNALDIR', '' )
+    bases = [ os.path.join( infodir, key ) ]
+    if annaldir:
+        bases.append( os.path.realpath( '{0}/{1}/{2}'.format( annaldir, infodir, key ) ) )
+    dirs = []
+    for base in bases:
+        if not os.path.isdir( base ):
+            continue
+        dirs.extend( e.path for e in os.scandir( base )
+                     if e.is_dir() and os.path.realpath( e.path ) not in exclude )
+    dirs.sort( key=os.path.basename, reverse=True )
+    return dirs[ :max_history ]
+
+
+def samples( infodirs ):
+    ''' Generate ( files, bytes, elapsed ) of each successful slice,
+        elapsed without the time the throttle held it back
+    '''
+    for d in infodirs:
+        bkupdir = summary.BkupDir( pathlib.Path( d ) )
+        n = 0
+        for s in bkupdir.slices.values():
+            elapsed = summary.dar_secs( s )
+            if s.exitcode != 0 or not elapsed or s.files is None or s.bytes is None:
+                continue
+            n += 1
+            yield ( s.files, s.bytes, elapsed )
+        logr.debug( "{0}: {1} samples".format( d, n ) )
+
+
+def _solve( a, b ):
+    ''' Solve the square system a x = b by gaussian elimination with partial
+        pivoting. Return None if a is singular.
+    '''
+    n = len( b )
+    m = [ list( row ) + [ v ] for row, v in zip( a, b ) ]
+    for col in range( n ):
+        pivot = max( range( col, n ), key=lambda r: abs( m[ r ][ col ] ) )
+        if abs( m[ pivot ][ col ] ) < 1e-12:
+            return None
+        m[ col ], m[ pivot ] = m[ pivot ], m[ col ]
+        for r in range( col + 1, n ):
+            f = m[ r ][ col ] / m[ col ][ col ]
+            for c in range( col, n + 1 ):
+                m[ r ][ c ] -= f * m[ col ][ c ]
+    x = [ 0.0 ] * n
+    for r in reversed( range( n ) ):
+        x[ r ] = ( m[ r ][ n ] - sum( m[ r ][ c ] * x[ c ] for c in range( r + 1, n ) ) ) / m[ r ][ r ]
+    return x
+
+
+def fit( rows ):
+    ''' Return the Model with the least squared error over rows of
+        ( files, bytes, elapsed ), or DEFAULT_MODEL if there are too few rows.
+        With only three terms, every subset of them is fitted and the best
+        one without negative coefficients wins (exact non-negative least
+        squares). Columns are scaled to 1 so byte counts don't swamp the rest.
+    '''
+    rows = list( rows )
+    if len( rows ) < MIN_SAMPLES:
+        logr.info( "{0} samples, using default model".format( len( rows ) ) )
+        return DEFAULT_MODEL
+    scale = [ 1.0,
+              float( max( r[0] for r in rows ) ) or 1.0,
+              float( max( r[1] for r in rows ) ) or 1.0 ]
+    # normal equations of the full model, each subset uses a slice of them
+    gram = [ [ 0.0 ] * 3 for i in range( 3 ) ]
+    xty = [ 0.0 ] * 3
+    yty = 0.0
+    for r in rows:
+        x = ( 1.0, r[0] / scale[1], r[1] / scale[2] )
+        y = float( r[2] )
+        for i in range( 3 ):
+            xty[ i ] += x[ i ] * y
+            for j in range( 3 ):
+                gram[ i ][ j ] += x[ i ] * x[ j ]
+        yty += y * y
+    best = None
+    for k in range( 1, 4 ):
+        for terms in itertools.combinations( range( 3 ), k ):
+            coef = _solve( [ [ gram[ i ][ j ] for j in terms ] for i in terms ],
+                           [ xty[ i ] for i in terms ] )
+            if coef is None or min( coef ) < 0:
+                continue
+            full = [ 0.0, 0.0, 0.0 ]
+            for i, c in zip( terms, coef ):
+                full[ i ] = c
+            # sum of squared errors, from the normal equations
+            sse = ( yty - 2 * sum( f * v for f, v in zip( full, xty ) )
+                    + sum( full[ i ] * gram[ i ][ j ] * full[ j ]
+                           for i in range( 3 ) for j in range( 3 ) ) )
+            if best is None or sse < best[0]:
+                best = ( sse, full )
+    if best is None:
+        return DEFAULT_MODEL
+    c = best[1]
+    return Model( c[0], c[1] / scale[1], c[2] / scale[2], len( rows ) )
+
+
+def predict( model, files, nbytes ):
+    return model.intercept + model.per_file * files + model.per_byte * nbytes
+
+
+def read_bins( f ):
+    ''' Return list of ( key, files, bytes ) from a split_filelist.py --bins file
+    '''
+    bins = []
+    for line in f:
+        parts = line.split()
+        if len( parts ) != 3:
+            raise UserWarning( "Malformed line in '{0}': {1}".format( f.name, line.rstrip() ) )
+        bins.append( ( parts[0], int( parts[1] ), int( parts[2] ) ) )
+    return bins
+
+
+def run():
+    args = process_cmdline()
+    cfg = summary.load_cfg()
+    dirs = history_dirs( cfg, args.key, args.exclude, args.max_history )
+    logr.info( "History for '{0}': {1}".format( args.key, dirs ) )
+    model = fit( samples( dirs ) )
+    logr.info( model )
+    if args.action == 'fit':
+        for k, v in zip( model._fields, model ):
+            print( '{0}: {1}'.format( k.upper(), v ) )
+    elif args.action == 'predict':
+        bins = [ ( key, files, nbytes, predict( model, files, nbytes ) )
+                 for key, files, nbytes in read_bins( args.binsfile ) ]
+        bins.sort( key=lambda b: b[3], reverse=True )
+        for key, files, nbytes, secs in bins:
+            print( key, files, nbytes, int( round( secs ) ) )
+
+
+if __name__ == '__main__':
+    try:
+        run()
+    except ( UserWarning, OSError ) as e:
+        logr.error( e )
+        sys.exit( 1 )
@@ -8,18 +8,27 @@
 #   outdir    - String - absolute path of directory to store output and log file(s)
 #   timestamp - String - [OPTIONAL] - select only files newer than timestamp
 #                        Default = 0 (epoch)
+#   jobs      - Int    - [OPTIONAL] - number of find processes run at once
+#                        Default = one per core
 # OUTPUT
-#   <outdir>/scandir.out - list of files
+#   <outdir>/scandir.out - list of files, "SIZE\0PATH" lines
+#                          with "\0DEV:INO:NLINK" appended for files that
+#                          have more than one link
 #   <outdir>/scandir.joblog - joblog from Gnu Parallel
+#   <outdir>/scandir.throttled - seconds the scan was held back by the
+#                          META_OPS_PER_SEC throttle (only if throttling
+#                          is configured, see bin/governor.py)
 
-if [[ $# -lt 2 || $# -gt 3 ]] ; then
-    echo "Error - scandir: Expected two input parameters; got '$#'"
+if [[ $# -lt 2 || $# -gt 4 ]] ; then
+    echo "Error - scandir: Expected two to four input parameters; got '$#'"
     exit 1
 fi
 srcdir="$1"
 outdir="$2"
 timestamp=$( echo "$3" | tr -cd '[0-9]' )
 [[ -n "$timestamp" ]] || timestamp=0
+jobs=$( echo "$4" | tr -cd '[0-9]' )
+[[ -n "$jobs" ]] || jobs=100%
 
 ##TESTING LIMIT
 #maxdepth='-maxdepth 3'
@@ -27,17 +36,35 @@ timestamp=$( echo "$3" | tr -cd '[0-9]' )
 outfile=$outdir/scandir.out
 joblog=$outdir/scandir.joblog
 emptydirs=$outdir/emptydirs
+throttled=$outdir/scandir.throttled
+
+# Nothing is resumed, start from empty output
+# (jobs append to outfile, leftovers of an interrupted scan would be duplicated)
+: > "$outfile"
+rm -f "$joblog" "$emptydirs" "$throttled"
+
+# Pace directories handed to find, one meta op for each. The walk below is
+# held back with them once the pipe fills. Entries stat'ed by each find are
+# not counted (scandir.py charges them), so META_OPS_PER_SEC limits
+# directories per second here.
+pace=( cat )
+governor="$PDBKUP_BASE/bin/governor.py"
+if [[ -n "$PDBKUP_BASE" ]] && python3 "$governor" enabled ; then
+    pace=( python3 "$governor" --secs_file "$throttled" pace )
+fi
 
 # Find only Dirs
 # Save empty dirs to a file
 # Pipe Dirnames to parallel to find all non-dir children
-# Save Filesize + Filename to a file
+# Save Filesize + Filename (+ Device:Inode:Linkcount if multiply-linked) to a file
 find "$srcdir" $maxdepth -type d ! -name $'*[\x1-\x1f]*' -printf '%n\0%p\n' \
 | tee >( grep -Pa '^2\x0' > $emptydirs ) \
 | cut -d '' -f 2 \
-| parallel -d '\n' --joblog $joblog \
-    find '{}' -maxdepth 1 \\\( -type f -o -type l \\\) ! -name "\$'*[\\x1-\\x1f]*'" -newerct "@$timestamp" -printf '%s\\0%p\\n' >> $outfile
+| "${pace[@]}" \
+| parallel -d '\n' -j $jobs --joblog $joblog \
+    find '{}' -maxdepth 1 \\\( -type f -o -type l \\\) ! -name "\$'*[\\x1-\\x1f]*'" -newerct "@$timestamp" \\\( -links +1 -printf '%s\\0%p\\0%D:%i:%n\\n' -o -printf '%s\\0%p\\n' \\\) >> $outfile
 echo "Filesystem scan, elapsed seconds: $SECONDS"
+[[ -f "$throttled" ]] && echo "Filesystem scan, throttled seconds: $( cat "$throttled" )"
 
 cat "$emptydirs" >> "$outfile"
 rm -f "$emptydirs"
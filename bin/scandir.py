@@ -0,0 +1,379 @@
+#!/usr/bin/python3
+
+import argparse
+import collections
+import configparser
+import logging
+import os
+import re
+import threading
+import time
+
+import summary
+import throttle
+
+logr = logging.getLogger()
+console_handler = logging.StreamHandler()
+formatter = logging.Formatter( '%(levelname)s [%(filename)s %(lineno)d] %(message)s' )
+console_handler.setFormatter( formatter )
+logr.addHandler( console_handler )
+logr.setLevel( logging.WARNING )
+
+DESCRIPTION = '''
+    Scan a directory tree with a pool of threads.
+    Output is the same as scandir.bash:
+      <outdir>/scandir.out   - "SIZE\\0PATH" for each file and symlink,
+                               "SIZE\\0PATH\\0DEV:INO:NLINK" if it has
+                               more than one link,
+                               "NLINK\\0PATH" for each empty directory
+      <outdir>/scandir.stats - runtime and per-worker throughput (INI format)
+    Progress is checkpointed in <outdir>/scandir.checkpoint. If that file
+    exists, the scan resumes where it left off instead of starting over.
+    With --throttle, readdir and stat calls are held to META_OPS_PER_SEC of
+    the current THROTTLE profile in settings.ini, shared with all other
+    scans on the node.
+'''
+
+# Same names that scandir.bash skips with ! -name $'*[\\x1-\\x1f]*'
+BAD_NAME = re.compile( b'[\x01-\x1f]' )
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser( description=DESCRIPTION )
+    parser.add_argument( 'srcdir', help='absolute path of directory to be scanned' )
+    parser.add_argument( 'outdir', help='directory to store output and stats files' )
+    parser.add_argument( 'timestamp', nargs='?',
+        help='select only files with ctime newer than timestamp (default: 0)' )
+    parser.add_argument( '-j', '--threads', type=int,
+        help='number of scanner threads (default: %(default)s)' )
+    parser.add_argument( '-i', '--interval', type=int,
+        help='seconds between progress reports (default: %(default)s)' )
+    parser.add_argument( '-c', '--checkpoint_interval', type=int,
+        help='seconds between checkpoints (default: %(default)s)' )
+    parser.add_argument( '-t', '--throttle', action='store_true',
+        help='apply the THROTTLE profiles of settings.ini (needs PDBKUP_BASE)' )
+    parser.add_argument( '-v', '--verbose', action='store_true' )
+    parser.add_argument( '-d', '--debug', action='store_true' )
+    parser.set_defaults(
+        threads = 16,
+        interval = 300,
+        checkpoint_interval = 60,
+    )
+    args = parser.parse_args()
+    if args.verbose:
+        logr.setLevel( logging.INFO )
+    if args.debug:
+        logr.setLevel( logging.DEBUG )
+    ts = ''.join( c for c in ( args.timestamp or '' ) if c.isdigit() )
+    args.timestamp = int( ts ) if ts else 0
+    if args.threads < 1:
+        raise UserWarning( 'Need at least one thread, got {0}'.format( args.threads ) )
+    if not os.path.isdir( args.srcdir ):
+        raise UserWarning( "Source directory '{0}' does not exist".format( args.srcdir ) )
+    if not os.path.isdir( args.outdir ):
+        raise UserWarning( "Output directory '{0}' does not exist".format( args.outdir ) )
+    return args
+
+
+class WorkerStats( object ):
+    __slots__ = ( 'dirs', 'files', 'empty_dirs', 'errors', 'busy', 'steals', 'throttled' )
+
+    def __init__( self ):
+        self.dirs = 0
+        self.files = 0
+        self.empty_dirs = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.steals = 0
+        self.throttled = 0.0
+
+
+class Scanner( object ):
+    ''' Multi-threaded directory walker.
+        Each worker has its own deque of directories to scan. A worker takes
+        new work from the end of its own deque (depth first) and, when that
+        is empty, steals from the front of another worker's deque.
+    '''
+    def __init__( self, outfh, timestamp=0, threads=16, ckptfh=None, ckpt_interval=60,
+                  governor=None, done=None ):
+        self.outfh = outfh
+        self.out_bytes = outfh.tell()
+        # Each checkpoint record is "OFFSET\0DIR\0SUBDIR\0SUBDIR...\n", where
+        # OFFSET is the size of the output once DIR was written to it
+        self.ckptfh = ckptfh
+        self.ckpt_interval = ckpt_interval
+        self.ckpt_records = []
+        self.last_ckpt = time.time()
+        # directories completed before a resume, their output is already saved
+        self.done = done or set()
+        self.resumed_dirs = len( self.done )
+        self.newer_than_ns = timestamp * 1000000000
+        self.num_threads = threads
+        self.queues = [ collections.deque() for i in range( threads ) ]
+        self.stats = [ WorkerStats() for i in range( threads ) ]
+        # number of directories queued or being scanned
+        self.pending = 0
+        self.cond = threading.Condition()
+        self.finished = threading.Event()
+        self.outlock = threading.Lock()
+        # throttle.Governor, None for no throttling
+        self.governor = governor
+
+    def push( self, wid, path ):
+        with self.cond:
+            self.pending += 1
+            self.queues[ wid ].append( path )
+            self.cond.notify()
+
+    def _next( self, wid ):
+        ''' Return next directory for worker wid, None when all work is done
+        '''
+        while True:
+            try:
+                return self.queues[ wid ].pop()
+            except IndexError:
+                pass
+            for i in range( 1, self.num_threads ):
+                victim = self.queues[ ( wid + i ) % self.num_threads ]
+                try:
+                    path = victim.popleft()
+                except IndexError:
+                    continue
+                self.stats[ wid ].steals += 1
+                return path
+            with self.cond:
+                if self.pending == 0:
+                    return None
+                self.cond.wait( 0.1 )
+
+    def _done( self ):
+        with self.cond:
+            self.pending -= 1
+            if self.pending == 0:
+                self.finished.set()
+                self.cond.notify_all()
+
+    def _commit( self, path, lines, subdirs ):
+        ''' Write output for a completed directory and record it for the checkpoint
+        '''
+        with self.outlock:
+            if lines:
+                data = b''.join( lines )
+                self.outfh.write( data )
+                self.out_bytes += len( data )
+            if self.ckptfh:
+                self.ckpt_records.append(
+                    b'\x00'.join( [ b'%d' % self.out_bytes, path ] + subdirs ) + b'\n' )
+                if time.time() - self.last_ckpt >= self.ckpt_interval:
+                    self._checkpoint()
+
+    def _checkpoint( self ):
+        ''' Output must reach the disk before the checkpoint records that refer to it.
+            Caller must hold outlock.
+        '''
+        self.outfh.flush()
+        os.fsync( self.outfh.fileno() )
+        self.ckptfh.write( b''.join( self.ckpt_records ) )
+        self.ckptfh.flush()
+        os.fsync( self.ckptfh.fileno() )
+        self.ckpt_records = []
+        self.last_ckpt = time.time()
+
+    def _entry( self, wid, entry, subdirs ):
+        ''' Queue a subdirectory, or return the output line of a file that
+            changed (None if it did not). Raises OSError if entry cannot be stat'ed.
+        '''
+        if entry.is_dir( follow_symlinks=False ):
+            subdirs.append( entry.path )
+            if entry.path not in self.done:
+                self.push( wid, entry.path )
+        elif entry.is_file( follow_symlinks=False ) or entry.is_symlink():
+            st = entry.stat( follow_symlinks=False )
+            if st.st_ctime_ns > self.newer_than_ns:
+                if st.st_nlink > 1:
+                    return b'%d\x00%s\x00%d:%d:%d\n' % (
+                        st.st_size, entry.path, st.st_dev, st.st_ino, st.st_nlink )
+                return b'%d\x00%s\n' % ( st.st_size, entry.path )
+        return None
+
+    def _scan( self, wid, path ):
+        stats = self.stats[ wid ]
+        lines = []
+        subdirs = []
+        num_entries = 0
+        try:
+            with os.scandir( path ) as it:
+                for entry in it:
+                    num_entries += 1
+                    if BAD_NAME.search( entry.name ):
+                        logr.warning( 'Skipping name with control characters: {0!r}'.format(
+                            entry.path ) )
+                        continue
+                    try:
+                        line = self._entry( wid, entry, subdirs )
+                    except OSError as e:
+                        # vanished or unreadable, the rest of the directory is still saved
+                        stats.errors += 1
+                        logr.warning( 'Error scanning {0!r}: {1}'.format( entry.path, e ) )
+                        continue
+                    if line:
+                        lines.append( line )
+        except OSError as e:
+            stats.errors += 1
+            logr.warning( 'Error scanning {0!r}: {1}'.format( path, e ) )
+            self._commit( path, [], subdirs )
+            return
+        if num_entries == 0:
+            try:
+                nlink = os.lstat( path ).st_nlink
+            except OSError as e:
+                stats.errors += 1
+                logr.warning( 'Error scanning {0!r}: {1}'.format( path, e ) )
+            else:
+                lines.append( b'%d\x00%s\n' % ( nlink, path ) )
+                stats.empty_dirs += 1
+        stats.dirs += 1
+        stats.files += len( lines )
+        self._commit( path, lines, subdirs )
+        if self.governor:
+            # one readdir plus one stat per entry
+            stats.throttled += self.governor.meta( 1 + num_entries )
+
+    def worker( self, wid ):
+        stats = self.stats[ wid ]
+        while True:
+            path = self._next( wid )
+            if path is None:
+                break
+            start = time.time()
+            try:
+                self._scan( wid, path )
+            finally:
+                stats.busy += time.time() - start
+                self._done()
+
+    def run( self, dirs, interval=300 ):
+        ''' Scan each directory in dirs and everything below it
+        '''
+        for i, path in enumerate( dirs ):
+            self.push( i % self.num_threads, path )
+        if self.pending == 0:
+            return
+        threads = [ threading.Thread( target=self.worker, args=( i, ), daemon=True )
+                    for i in range( self.num_threads ) ]
+        starttime = time.time()
+        for t in threads:
+            t.start()
+        while not self.finished.wait( interval ):
+            elapsed = time.time() - starttime
+            dirs = sum( s.dirs for s in self.stats )
+            files = sum( s.files for s in self.stats )
+            logr.info( "Dirs:{D} Files:{F} Queued:{Q} Secs:{S:2.0f} Rate:{R:5.0f} dirs/s".format(
+                D=dirs, F=files, Q=self.pending, S=elapsed, R=dirs / elapsed ) )
+        for t in threads:
+            t.join()
+
+
+def load_checkpoint( fn ):
+    ''' Read checkpoint records.
+        Return tuple of ( output offset, checkpoint length, completed dirs, pending dirs )
+        where checkpoint length covers only complete records.
+    '''
+    offset = 0
+    length = 0
+    done = set()
+    found = set()
+    with open( fn, 'rb' ) as f:
+        for line in f:
+            if not line.endswith( b'\n' ):
+                break
+            parts = line[:-1].split( b'\x00' )
+            offset = int( parts[0] )
+            done.add( parts[1] )
+            found.update( parts[2:] )
+            length += len( line )
+    return ( offset, length, done, found - done )
+
+
+def save_stats( scanner, fn, start, end ):
+    cfg = configparser.ConfigParser()
+    cfg.optionxform = lambda option: option
+    elapsed = end - start
+    cfg[ 'SCANDIR' ] = {
+        'ENGINE': 'python',
+        'START': '{0:.0f}'.format( start ),
+        'END': '{0:.0f}'.format( end ),
+        'ELAPSED': '{0:.0f}'.format( elapsed ),
+        'THREADS': str( scanner.num_threads ),
+        'DIRS': str( sum( s.dirs for s in scanner.stats ) ),
+        'FILES': str( sum( s.files for s in scanner.stats ) ),
+        'EMPTY_DIRS': str( sum( s.empty_dirs for s in scanner.stats ) ),
+        'ERRORS': str( sum( s.errors for s in scanner.stats ) ),
+        'RESUMED_DIRS': str( scanner.resumed_dirs ),
+        'THROTTLED': '{0:.0f}'.format( sum( s.throttled for s in scanner.stats ) ),
+    }
+    for i, s in enumerate( scanner.stats ):
+        # busy includes time slept by the throttle
+        working = s.busy - s.throttled
+        rate = s.dirs / working if working > 0 else 0
+        cfg[ 'WORKER_{0:03d}'.format( i ) ] = {
+            'DIRS': str( s.dirs ),
+            'FILES': str( s.files ),
+            'STEALS': str( s.steals ),
+            'BUSY': '{0:.1f}'.format( s.busy ),
+            'THROTTLED': '{0:.1f}'.format( s.throttled ),
+            'DIRS_PER_SEC': '{0:.1f}'.format( rate ),
+        }
+        logr.info( "Worker:{W} Dirs:{D} Files:{F} Steals:{T} Busy:{B:2.0f} Rate:{R:5.0f} dirs/s".format(
+            W=i, D=s.dirs, F=s.files, T=s.steals, B=s.busy, R=rate ) )
+    with open( fn, 'w' ) as f:
+        cfg.write( f )
+
+
+def run():
+    args = process_cmdline()
+    outfile = os.path.join( args.outdir, 'scandir.out' )
+    statsfile = os.path.join( args.outdir, 'scandir.stats' )
+    ckptfile = os.path.join( args.outdir, 'scandir.checkpoint' )
+    root = os.fsencode( args.srcdir )
+    governor = None
+    if args.throttle:
+        cfg = summary.load_cfg()
+        if throttle.is_enabled( cfg ):
+            governor = throttle.Governor( cfg )
+    start = time.time()
+    done = set()
+    pending = [ root ]
+    if os.path.exists( ckptfile ) and os.path.exists( outfile ):
+        offset, length, done, pending = load_checkpoint( ckptfile )
+        if root not in done:
+            pending.add( root )
+        # drop anything written after the last checkpoint
+        os.truncate( outfile, offset )
+        os.truncate( ckptfile, length )
+        logr.warning( 'Resuming scan from checkpoint: {0} dirs done, {1} pending'.format(
+            len( done ), len( pending ) ) )
+        mode = 'ab'
+    else:
+        mode = 'wb'
+    with open( outfile, mode, buffering=1048576 ) as outfh, \
+         open( ckptfile, mode ) as ckptfh:
+        scanner = Scanner( outfh,
+                           timestamp=args.timestamp,
+                           threads=args.threads,
+                           ckptfh=ckptfh,
+                           ckpt_interval=args.checkpoint_interval,
+                           governor=governor,
+                           done=done )
+        scanner.run( pending, interval=args.interval )
+    os.remove( ckptfile )
+    end = time.time()
+    save_stats( scanner, statsfile, start, end )
+    print( 'Filesystem scan, elapsed seconds: {0:.0f}'.format( end - start ) )
+    if governor:
+        print( 'Filesystem scan, throttled seconds: {0:.0f}'.format(
+            sum( s.throttled for s in scanner.stats ) ) )
+
+
+if __name__ == '__main__':
+    run()
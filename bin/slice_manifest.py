@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+
+import argparse
+import bisect
+import logging
+import os
+
+logr = logging.getLogger()
+console_handler = logging.StreamHandler()
+formatter = logging.Formatter( '%(levelname)s [%(filename)s %(lineno)d] %(message)s' )
+console_handler.setFormatter( formatter )
+logr.addHandler( console_handler )
+logr.setLevel( logging.WARNING )
+
+DESCRIPTION = '''
+    Directory to dar slice manifest.
+    Each line of a manifest is "DIRECTORY\\0NNNN,NNNN\\n", sorted by directory.
+    A directory whose slices are the same as its parent's is left out, so
+    lookups fall back to the nearest listed ancestor.
+'''
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser( description=DESCRIPTION )
+    parser.add_argument( '-v', '--verbose', action='store_true' )
+    parser.add_argument( '-d', '--debug', action='store_true' )
+    subparsers = parser.add_subparsers( dest='action' )
+    p_resolve = subparsers.add_parser( 'resolve',
+        help='Replace bin uuids with slice sequence numbers' )
+    p_resolve.add_argument( '--renames', required=True,
+        help='File with one "UUID NUM" line per renamed filelist' )
+    p_resolve.add_argument( 'infile', help='Manifest written by split_filelist.py' )
+    p_resolve.add_argument( 'outfile' )
+    p_lookup = subparsers.add_parser( 'lookup',
+        help='Print slice sequence numbers needed to restore the given paths' )
+    p_lookup.add_argument( 'manifest' )
+    p_lookup.add_argument( 'paths', metavar='PATH', nargs='+' )
+    args = parser.parse_args()
+    if args.verbose:
+        logr.setLevel( logging.INFO )
+    if args.debug:
+        logr.setLevel( logging.DEBUG )
+    if not args.action:
+        parser.error( 'missing action' )
+    return args
+
+
+def read_manifest( fn ):
+    ''' Return sorted list of ( directory, slice names ) from a manifest file
+    '''
+    entries = []
+    with open( fn, 'rb' ) as f:
+        for line in f:
+            d, names = line.rstrip( b'\n' ).split( b'\x00', 1 )
+            entries.append( ( d, names.decode().split( ',' ) ) )
+    return entries
+
+
+def resolve( args ):
+    renames = {}
+    with open( args.renames ) as f:
+        for line in f:
+            uuid, num = line.split()
+            renames[ uuid ] = num
+    kept = {}
+    tmpfn = args.outfile + '.tmp'
+    with open( tmpfn, 'wb' ) as out:
+        for d, names in read_manifest( args.infile ):
+            nums = sorted( set( renames[ n ] for n in names ) )
+            kept[ d ] = nums
+            if kept.get( os.path.dirname( d ) ) == nums:
+                continue
+            out.write( d + b'\x00' + ','.join( nums ).encode() + b'\n' )
+    os.rename( tmpfn, args.outfile )
+    logr.info( "Resolved {0} directories into '{1}'".format( len( kept ), args.outfile ) )
+
+
+def lookup( args ):
+    entries = read_manifest( args.manifest )
+    dirs = [ d for d, nums in entries ]
+    found = set()
+    for path in args.paths:
+        p = os.fsencode( path.rstrip( '/' ) )
+        i = bisect.bisect_left( dirs, p )
+        if i < len( dirs ) and dirs[ i ] == p:
+            found.update( entries[ i ][ 1 ] )
+        else:
+            # not listed, its files live in the slices of the nearest ancestor
+            a = p
+            while a != os.path.dirname( a ):
+                a = os.path.dirname( a )
+                j = bisect.bisect_left( dirs, a )
+                if j < len( dirs ) and dirs[ j ] == a:
+                    found.update( entries[ j ][ 1 ] )
+                    break
+        # everything below the path
+        pfx = p + b'/'
+        i = bisect.bisect_left( dirs, pfx )
+        while i < len( dirs ) and dirs[ i ].startswith( pfx ):
+            found.update( entries[ i ][ 1 ] )
+            i += 1
+    for num in sorted( found ):
+        print( num )
+
+
+def run():
+    args = process_cmdline()
+    if args.action == 'resolve':
+        resolve( args )
+    elif args.action == 'lookup':
+        lookup( args )
+
+
+if __name__ == '__main__':
+    run()
@@ -1,12 +1,14 @@
 #!/usr/bin/python3
 
 import argparse
+import collections
 import logging
 import binpack
 import uuid
 import statistics
 import time
 import os.path
+import pickle
 import pprint
 
 logr = logging.getLogger()
@@ -23,10 +25,37 @@ def process_cmdline():
         help='Max size, in bytes, of sum of all file sizes in each output file' )
     parser.add_argument( '-n', '--numfiles_max', type=int,
         help='Max number of files in each output file' )
+    parser.add_argument( '-c', '--cost_max', type=float,
+        help=( 'Max cost of each output file, where the cost of a file is '
+               'COST_PER_FILE + COST_PER_BYTE * size; ie: predicted dar seconds '
+               '(see runtime_model.py). Size and count limits still apply' ) )
+    parser.add_argument( '--cost_per_file', type=float,
+        help='Cost of each file (default: %(default)s)' )
+    parser.add_argument( '--cost_per_byte', type=float,
+        help='Cost of each byte (default: %(default)s)' )
     parser.add_argument( '-o', '--outdir',
         help='Output directory' )
-    parser.add_argument( 'infile', type=argparse.FileType('r') )
+    parser.add_argument( 'infile', type=argparse.FileType('rb') )
     parser.add_argument( '--with_summary', action='store_true' )
+    parser.add_argument( '--strategy', choices=binpack.STRATEGIES,
+        help='Bin packing strategy (default: %(default)s)' )
+    parser.add_argument( '--compare', action='store_true',
+        help=( 'Run every packing strategy on the input and print a summary '
+               'for each; no output files are written' ) )
+    parser.add_argument( '--manifest',
+        help=( 'Write a sorted map of directory to bin names to this file '
+               '(see slice_manifest.py)' ) )
+    parser.add_argument( '--bins',
+        help=( 'Write "KEY FILES BYTES" for each bin to this file '
+               '(see runtime_model.py)' ) )
+    parser.add_argument( '--stream', action='store_true',
+        help=( 'Write each bin to its filelist as soon as it is full; '
+               'memory is bounded by the open bins' ) )
+    parser.add_argument( '--checkpoint',
+        help=( 'Periodically save progress to this file (requires --stream). '
+               'If the file exists, resume from it.' ) )
+    parser.add_argument( '--checkpoint_interval', type=int,
+        help='Seconds between checkpoints (default: %(default)s)' )
     parser.add_argument( '-v', '--verbose', action='store_true' )
     parser.add_argument( '-d', '--debug', action='store_true' )
     group_sep = parser.add_mutually_exclusive_group()
@@ -36,11 +65,24 @@ def process_cmdline():
         size_max = 1073741824,
         numfiles_max = 1048576,
         outdir = '.',
+        strategy = 'first-fit',
+        checkpoint_interval = 60,
+        cost_per_file = 0.0,
+        cost_per_byte = 0.0,
         field_sep = None
     )
     args = parser.parse_args()
     if args.null_sep:
         args.field_sep = '\x00'
+    if args.field_sep is not None:
+        args.field_sep = os.fsencode( args.field_sep )
+    if args.cost_max is not None and min( args.cost_per_file, args.cost_per_byte ) < 0:
+        raise UserWarning( "Costs per file and per byte cannot be negative" )
+    if args.checkpoint and not args.stream:
+        raise UserWarning( "--checkpoint requires --stream" )
+    if args.stream and args.strategy == 'first-fit-decreasing':
+        raise UserWarning( "Strategy '{0}' must see all input, it cannot stream".format(
+            args.strategy ) )
     if args.verbose:
         logr.setLevel( logging.INFO )
     if args.debug:
@@ -50,96 +92,364 @@ def process_cmdline():
     return args
 
 
-def run():
-    args = process_cmdline()
-    outfn_count = 1
-    active_bins = {}
-    donelist = []
-    final_bins = {}
+def add_link( args, filename, size, link ):
+    ''' Add a path of a multiply-linked inode to its group in args.links.
+        Return the binpack.Hardlinks once all NLINK paths are seen, else None.
+    '''
+    inode, sep, nlink = link.rpartition( b':' )
+    group = args.links.get( inode )
+    if group is None:
+        group = binpack.Hardlinks( filename, size )
+        args.links[ inode ] = group
+    else:
+        group.links.append( filename )
+    if group.nfiles < int( nlink ):
+        return None
+    del args.links[ inode ]
+    return group
+
+
+def count_links( args, group ):
+    args.link_stats[ 'inodes' ] += 1
+    args.link_stats[ 'links' ] += len( group.links )
+    args.link_stats[ 'bytes_saved' ] += group.size * len( group.links )
+
+
+def read_items( args ):
+    ''' Generate binpack.File objects from the input filelist.
+        Filenames are kept as bytes, exactly as they appear in the input.
+        Lines of multiply-linked files have a third, "DEV:INO:NLINK", field
+        (see scandir.py); their paths are held in args.links until all links
+        are seen and then packed together as one binpack.Hardlinks. Links
+        whose other paths are not in the input are packed at the end.
+        Also tracks args.bytes_read, the offset of the input consumed so far.
+    '''
+    args.bytes_read = args.infile.tell()
+    debug = logr.isEnabledFor( logging.DEBUG )
+    check_order = args.strategy == 'locality'
+    prev = b''
+    for line in args.infile:
+        args.bytes_read += len( line )
+        parts = line.rstrip( b'\n' ).split( args.field_sep, 1 )
+        if debug:
+            logr.debug( "Processing line: {0}".format( line ) )
+            logr.debug( pprint.pformat( parts ) )
+        filename, sep, link = parts[1].partition( b'\x00' )
+        if check_order:
+            if filename < prev:
+                logr.warning( "Input is not sorted by path, locality will suffer" )
+                check_order = False
+            prev = filename
+        if link:
+            group = add_link( args, filename, int( parts[0] ), link )
+            if group:
+                count_links( args, group )
+                yield group
+            continue
+        yield binpack.File( filename=filename, size=int( parts[0] ) )
+    for inode in list( args.links ):
+        group = args.links.pop( inode )
+        count_links( args, group )
+        yield group
+
+
+def write_bin( outdir, key, bin ):
+    with open( "{0}/{1}.filelist".format( outdir, key ), 'wb' ) as f:
+        f.writelines( fn + b'\n' for fn in bin.filenames() )
+    # size of each path, same order, for progress of running slices
+    # (see dar_status.py); extra links of an inode count 0, dar saves it once
+    with open( "{0}/{1}.sizes".format( outdir, key ), 'w' ) as f:
+        for item in bin.items:
+            f.write( '{0}\n'.format( item.size ) )
+            f.write( '0\n' * ( item.nfiles - 1 ) )
+
+
+class Manifest( object ):
+    ''' Map of directory to the set of bins holding files from that directory.
+        While packing, "DIR\\0BIN" records are appended to a journal next to
+        the manifest; save() aggregates them into the sorted manifest.
+    '''
+    def __init__( self, fn=None ):
+        self.fn = fn
+        self.journal = None
+
+    def _open( self, mode ):
+        if self.fn and not self.journal:
+            self.journal = open( self.fn + '.part', mode )
+
+    def resume( self, offset ):
+        ''' Continue an interrupted journal, dropping records after offset
+        '''
+        if self.fn:
+            os.truncate( self.fn + '.part', offset )
+            self._open( 'ab' )
+
+    def add_bin( self, key, bin ):
+        self._open( 'wb' )
+        if not self.journal:
+            return
+        name = str( key ).encode()
+        seen = set()
+        for fn in bin.filenames():
+            d = os.path.dirname( fn )
+            if d in seen:
+                continue
+            seen.add( d )
+            self.journal.write( d + b'\x00' + name + b'\n' )
+
+    def tell( self ):
+        self._open( 'wb' )
+        if not self.journal:
+            return 0
+        self.journal.flush()
+        return self.journal.tell()
+
+    def save( self ):
+        self._open( 'wb' )
+        if not self.journal:
+            return
+        self.journal.close()
+        dirs = {}
+        with open( self.journal.name, 'rb' ) as f:
+            for line in f:
+                d, name = line.rstrip( b'\n' ).split( b'\x00', 1 )
+                dirs.setdefault( d, set() ).add( name )
+        with open( self.fn, 'wb' ) as f:
+            for d in sorted( dirs ):
+                f.write( d + b'\x00' + b','.join( sorted( dirs[ d ] ) ) + b'\n' )
+        os.remove( self.journal.name )
+
+
+class Checkpoint( object ):
+    ''' Snapshot of a streaming split so an interrupted run can resume.
+        Holds the input offset, the state of the packer (including all items
+        in open bins), hardlinks still waiting for their other paths, stats of
+        closed bins and the manifest journal offset.
+        Bins are only written out right before a snapshot, and bin names are
+        derived from a saved namespace and the bin number, so after a resume
+        any bin written after the last snapshot is rewritten identically.
+    '''
+    def __init__( self, fn, interval, params ):
+        self.fn = fn
+        self.interval = interval
+        self.params = params
+        self.last_save = time.time()
+
+    def load( self ):
+        ''' Return saved state, or None if there is no checkpoint
+        '''
+        if not self.fn or not os.path.exists( self.fn ):
+            return None
+        with open( self.fn, 'rb' ) as f:
+            state = pickle.load( f )
+        if state[ 'params' ] != self.params:
+            raise UserWarning( "Checkpoint '{0}' was made with different parameters {1}".format(
+                self.fn, state[ 'params' ] ) )
+        return state
+
+    def is_due( self ):
+        return time.time() - self.last_save >= self.interval
+
+    def save( self, state ):
+        state[ 'params' ] = self.params
+        tmpfn = self.fn + '.tmp'
+        with open( tmpfn, 'wb' ) as f:
+            pickle.dump( state, f, protocol=pickle.HIGHEST_PROTOCOL )
+            f.flush()
+            os.fsync( f.fileno() )
+        os.rename( tmpfn, self.fn )
+        self.last_save = time.time()
+
+    def remove( self ):
+        if os.path.exists( self.fn ):
+            os.remove( self.fn )
+
+
+def pack( args, strategy, on_close=None, checkpoint=None, manifest=None ):
+    ''' Pack all items from infile into bins using the given strategy.
+        Every closed bin is passed to on_close( key, bin ).
+        With a checkpoint, closed bins are passed to on_close in batches
+        right before each snapshot.
+        Return tuple of ( list of BinStats, elapsed seconds )
+    '''
+    state = checkpoint.load() if checkpoint else None
+    if manifest is None:
+        manifest = Manifest()
+    if state:
+        manifest.resume( state[ 'manifest_offset' ] )
+        packer = state[ 'packer' ]
+        stats = state[ 'stats' ]
+        namespace = state[ 'namespace' ]
+        prior_elapsed = state[ 'elapsed' ]
+        args.links = state.get( 'links', collections.OrderedDict() )
+        args.link_stats = state.get( 'link_stats', collections.Counter() )
+        args.infile.seek( state[ 'offset' ] )
+        logr.warning( "Resuming split at input offset {0} with {1} bins done".format(
+            state[ 'offset' ], len( stats ) ) )
+    else:
+        packer = binpack.Packer(
+            strategy=strategy,
+            maxsize=args.size_max,
+            maxcount=args.numfiles_max,
+            maxcost=args.cost_max,
+            file_cost=args.cost_per_file,
+            byte_cost=args.cost_per_byte )
+        stats = []
+        namespace = uuid.uuid4()
+        prior_elapsed = 0
+        args.links = collections.OrderedDict()
+        args.link_stats = collections.Counter()
+    closed = []
+    def close_bin( key, bin ):
+        stats.append( binpack.BinStats( bin.size, len( bin ), bin.maxsize, key, bin.cost ) )
+        if checkpoint:
+            # hold until the next checkpoint, see Checkpoint
+            closed.append( ( key, bin ) )
+        elif on_close:
+            on_close( key, bin )
+    def commit():
+        for key, bin in closed:
+            on_close( key, bin )
+        del closed[:]
+    packer.on_close = close_bin
+    packer.mk_key = lambda n: uuid.uuid5( namespace, str( n ) )
+    def save_checkpoint():
+        commit()
+        checkpoint.save( {
+            'offset': args.bytes_read,
+            'packer': packer,
+            'stats': stats,
+            'namespace': namespace,
+            'links': args.links,
+            'link_stats': args.link_stats,
+            'manifest_offset': manifest.tell(),
+            'elapsed': prior_elapsed + time.time() - starttime,
+        } )
     linecount = 0
     starttime = time.time()
-    # count line in input
-    total_linecount = sum( 1 for line in args.infile )
-    args.infile.seek(0)
+    # progress is measured by position in the input, no need for a counting pass
+    start_bytes = args.infile.tell()
+    args.bytes_read = start_bytes
+    total_bytes = os.fstat( args.infile.fileno() ).st_size
+    if checkpoint and not state:
+        # fix the namespace before any bin is written
+        save_checkpoint()
     # PROCESS INPUT
-    for line in args.infile:
-        logr.debug( "Processing line: {0}".format( line ) )
-        parts = line.strip().split( args.field_sep, 1 )
-        logr.debug( pprint.pformat( parts ) )
-        item = binpack.File( filename=parts[1], size=int( parts[0] ) )
-        # Try to fit into an existing bin
-        for key, bin in active_bins.items():
-            if bin.insert( item ):
-                break
-            if bin.is_full():
-                final_bins[ key ] = bin
-                donelist.append( key )
-        else:
-            # Doesn't fit in any existing bins, make a new one
-            newbin = binpack.Bin( maxsize=args.size_max, maxcount=args.numfiles_max )
-            if not newbin.insert( item ):
-                raise UserWarning( 'Failed to insert item into bin: {0}'.format( item ) )
-            active_bins[ uuid.uuid4() ] = newbin
-            logr.debug( "New bin: {0}".format( newbin ) )
-        # Remove full bins from active list
-        for k in donelist:
-            logr.debug( "Full bin: {0}".format( active_bins[k] ) )
-            del active_bins[ k ]
-        donelist = []
+    for item in read_items( args ):
+        packer.add( item )
         # Progress report
         linecount += 1
+        if checkpoint and linecount % 10000 == 0 and checkpoint.is_due():
+            save_checkpoint()
         if linecount % 100000 == 0:
             elapsed = time.time() - starttime
-            line_rate = linecount / elapsed
-            eta = ( total_linecount - linecount ) / line_rate
-            bincount = len( active_bins )
-            logr.info( "Lines:{L} ActiveBins:{B} Secs:{S:2.0f} Rate:{R:5.0f} ETA:{E:3.1f}".format(
-                L=linecount, 
-                S=elapsed, 
-                R=line_rate, 
-                E=eta, 
+            byte_rate = ( args.bytes_read - start_bytes ) / elapsed
+            eta = ( total_bytes - args.bytes_read ) / byte_rate
+            bincount = len( packer.open_bins )
+            logr.info( "Lines:{L} Pct:{P:3.1f} ActiveBins:{B} Secs:{S:2.0f} Rate:{R:5.0f} ETA:{E:3.1f}".format(
+                L=linecount,
+                P=args.bytes_read * 100.0 / total_bytes,
+                S=elapsed,
+                R=linecount / elapsed,
+                E=eta,
                 B=bincount ) )
-
-    # Create final bin dict
+    packer.finish()
+    if checkpoint:
+        commit()
     endtime = time.time()
-    final_bins.update( active_bins )
-    bins = final_bins
-
-    # SAVE BINS TO FILES and SUMMARIZE BINS
-    sizes = []
-    lengths = []
-    percents_full = []
-    for key, bin in bins.items():
-        sizes.append( bin.size )
-        lengths.append( len( bin.items ) )
-        percents_full.append( float( bin.size ) / bin.maxsize * 100 )
-        with open( "{0}/{1}.filelist".format( args.outdir, key ), 'w' ) as f:
-            for fn in bin:
-                f.write( "{0}\n".format( fn ) )
-    totalbins = len( bins )
-    if len( sizes ) != totalbins:
-        raise UserWarning( "num sizes doesn't match num bins" )
-    if len( lengths ) != totalbins:
-        raise UserWarning( "num lengths doesn't match num bins" )
-    if args.with_summary:
-        print( "Runtime: {0:2.0f} secs".format( endtime - starttime ) )
-        print( "Total number of bins: {0}".format( totalbins ) )
-        # Sizes
-        print( "SIZES" )
-        print( "Max: {0}".format( max( sizes ) ) )
-        print( "Min: {0}".format( min( sizes ) ) )
-        print( "PERCENT FULL STATS" )
-        for stat in [ "mean", "median", "pstdev", "pvariance" ]:
-            f = getattr( statistics, stat )
-            print( "{0}: {1:3.2f}".format( stat.title(), f( percents_full ) ) )
-        # Lenths
-        print( "LENGTH STATS" )
-        print( "Max: {0}".format( max( lengths ) ) )
-        print( "Min: {0}".format( min( lengths ) ) )
+    return ( stats, prior_elapsed + endtime - starttime )
+
+
+def write_bins( fn, stats ):
+    tmpfn = fn + '.tmp'
+    with open( tmpfn, 'w' ) as f:
+        for s in stats:
+            f.write( '{0} {1} {2}\n'.format( s.key, s.length, s.size ) )
+    os.rename( tmpfn, fn )
+
+
+def print_summary( stats, runtime, strategy, link_stats=None ):
+    sizes = [ s.size for s in stats ]
+    lengths = [ s.length for s in stats ]
+    percents_full = [ float( s.size ) / s.maxsize * 100 for s in stats ]
+    totalbins = len( stats )
+    print( "Strategy: {0}".format( strategy ) )
+    if totalbins < 1:
+        print( "Total number of bins: 0" )
+        return
+    print( "Runtime: {0:2.0f} secs".format( runtime ) )
+    print( "Total number of bins: {0}".format( totalbins ) )
+    # Sizes
+    print( "SIZES" )
+    print( "Max: {0}".format( max( sizes ) ) )
+    print( "Min: {0}".format( min( sizes ) ) )
+    print( "PERCENT FULL STATS" )
+    for stat in [ "mean", "median", "pstdev", "pvariance" ]:
+        f = getattr( statistics, stat )
+        print( "{0}: {1:3.2f}".format( stat.title(), f( percents_full ) ) )
+    # Lenths
+    print( "LENGTH STATS" )
+    print( "Max: {0}".format( max( lengths ) ) )
+    print( "Min: {0}".format( min( lengths ) ) )
+    for stat in [ "mean", "median", "pstdev", "pvariance" ]:
+        f = getattr( statistics, stat )
+        print( "{0}: {1:3.2f}".format( stat.title(), f( lengths ) ) )
+    print( "Num 1-length bins: {0}".format( lengths.count(1) ) )
+    costs = [ s.cost for s in stats ]
+    if max( costs ) > 0:
+        print( "COST STATS" )
+        print( "Max: {0:3.2f}".format( max( costs ) ) )
+        print( "Min: {0:3.2f}".format( min( costs ) ) )
         for stat in [ "mean", "median", "pstdev", "pvariance" ]:
             f = getattr( statistics, stat )
-            print( "{0}: {1:3.2f}".format( stat.title(), f( lengths ) ) )
-        print( "Num 1-length bins: {0}".format( lengths.count(1) ) )
+            print( "{0}: {1:3.2f}".format( stat.title(), f( costs ) ) )
+    if link_stats:
+        print( "HARDLINK STATS" )
+        print( "Inodes: {0}".format( link_stats[ 'inodes' ] ) )
+        print( "Extra links: {0}".format( link_stats[ 'links' ] ) )
+        print( "Bytes saved: {0}".format( link_stats[ 'bytes_saved' ] ) )
+
+
+def run():
+    args = process_cmdline()
+    if args.compare:
+        # Dry run of every strategy, no filelists are written
+        for strategy in binpack.STRATEGIES:
+            args.infile.seek(0)
+            stats, runtime = pack( args, strategy )
+            print_summary( stats, runtime, strategy, args.link_stats )
+            print()
+        return
+
+    manifest = Manifest( args.manifest )
+    if args.stream:
+        # SAVE EACH BIN TO FILE AS SOON AS IT CLOSES
+        def save_bin( key, bin ):
+            write_bin( args.outdir, key, bin )
+            manifest.add_bin( key, bin )
+        checkpoint = None
+        if args.checkpoint:
+            params = ( args.strategy, args.size_max, args.numfiles_max,
+                       args.cost_max, args.cost_per_file, args.cost_per_byte,
+                       os.fstat( args.infile.fileno() ).st_size )
+            checkpoint = Checkpoint( args.checkpoint, args.checkpoint_interval, params )
+        stats, runtime = pack( args, args.strategy, on_close=save_bin,
+                               checkpoint=checkpoint, manifest=manifest )
+    else:
+        # SAVE BINS TO FILES AFTER ALL INPUT IS PACKED
+        bins = {}
+        stats, runtime = pack( args, args.strategy,
+            on_close=lambda key, bin: bins.__setitem__( key, bin ) )
+        for key, bin in bins.items():
+            write_bin( args.outdir, key, bin )
+            manifest.add_bin( key, bin )
+    manifest.save()
+    if args.bins:
+        write_bins( args.bins, stats )
+    if args.stream and args.checkpoint:
+        checkpoint.remove()
+    if args.with_summary:
+        print_summary( stats, runtime, args.strategy, args.link_stats )
 
 
 if __name__ == '__main__':
@@ -1,22 +1,134 @@
 #!/usr/bin/env python3
 
 import os
+import array
+import concurrent.futures
 import configparser
 import pathlib
 import pprint
 import collections
+import sqlite3
 import statistics
 import datetime
 import argparse
 
 
+# Values kept from the DAR section of each slice ini
+INT_FIELDS = ( 'START', 'END', 'ELAPSED', 'EXITCODE', 'FILES', 'BYTES', 'PREDICTED_ELAPSED',
+               'ARCHIVE_BYTES', 'CATALOG_BYTES', 'RATE_BPS', 'VERIFY_ELAPSED', 'VERIFY_EXITCODE',
+               'THROTTLED_SECS', 'EST_ARCHIVE_BYTES' )
+FLOAT_FIELDS = ( 'RATE_FPS', 'LOADAVG_START', 'LOADAVG_END' )
+STR_FIELDS = ( 'HOSTNAME', 'COMPRESSION' )
+SliceStatus = collections.namedtuple( 'SliceStatus',
+    [ f.lower() for f in INT_FIELDS + FLOAT_FIELDS + STR_FIELDS ] )
+
+# Below this many changed ini files, parse them in this process
+PARALLEL_PARSE_MIN = 64
+
+
+def _to_int( val ):
+    try:
+        return int( val )
+    except ( TypeError, ValueError ):
+        return None
+
+
+def _to_float( val ):
+    try:
+        return float( val )
+    except ( TypeError, ValueError ):
+        return None
+
+
+def parse_slice_ini( fn ):
+    ''' Return SliceStatus from the DAR section of a slice ini file.
+        Missing values are None.
+    '''
+    c = configparser.ConfigParser( interpolation=None )
+    c.optionxform = lambda option: option
+    c.read( fn )
+    dar = c[ 'DAR' ] if c.has_section( 'DAR' ) else {}
+    return SliceStatus( *( [ _to_int( dar.get( k ) ) for k in INT_FIELDS ]
+                         + [ _to_float( dar.get( k ) ) for k in FLOAT_FIELDS ]
+                         + [ dar.get( k ) for k in STR_FIELDS ] ) )
+
+
+def dar_secs( status ):
+    ''' Return seconds dar ran of a finished slice, ELAPSED less the
+        THROTTLED_SECS it waited for a slot or was paused. None if not finished.
+    '''
+    if status.elapsed is None:
+        return None
+    return max( status.elapsed - ( status.throttled_secs or 0 ), 0 )
+
+
+class StatusCache( object ):
+    ''' Per infodir sqlite cache of parsed slice ini values.
+        Rows are keyed on slice name and remember the mtime and size of the
+        ini they came from, so only new or changed inis are parsed again.
+        If the infodir is not writable the cache lives in memory.
+    '''
+    VERSION = 5
+    FILENAME = '.summary.cache'
+
+    def __init__( self, path ):
+        try:
+            self.db = sqlite3.connect( str( path / self.FILENAME ), timeout=30 )
+            self._setup()
+        except sqlite3.Error:
+            self.db = sqlite3.connect( ':memory:' )
+            self._setup()
+
+    def _setup( self ):
+        version = self.db.execute( 'PRAGMA user_version' ).fetchone()[0]
+        if version != self.VERSION:
+            self.db.execute( 'DROP TABLE IF EXISTS slices' )
+        cols = ', '.join( [ '{0} INTEGER'.format( f ) for f in INT_FIELDS ]
+                        + [ '{0} REAL'.format( f ) for f in FLOAT_FIELDS ]
+                        + [ '{0} TEXT'.format( f ) for f in STR_FIELDS ] )
+        self.db.execute( 'CREATE TABLE IF NOT EXISTS slices ( '
+            'name TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, {0} )'.format( cols ) )
+        self.db.execute( 'PRAGMA user_version = {0}'.format( self.VERSION ) )
+        self.db.commit()
+
+    def stamps( self ):
+        ''' Return dict of slice name -> ( mtime_ns, size )
+        '''
+        return { name: ( mtime, size ) for name, mtime, size in
+                 self.db.execute( 'SELECT name, mtime_ns, size FROM slices' ) }
+
+    def update( self, rows, removed ):
+        ''' Save rows of ( name, mtime_ns, size, SliceStatus ), drop removed names
+        '''
+        with self.db:
+            self.db.executemany( 'DELETE FROM slices WHERE name = ?',
+                                 [ ( name, ) for name in removed ] )
+            self.db.executemany(
+                'INSERT OR REPLACE INTO slices VALUES ( ?, ?, ?, {0} )'.format(
+                    ', '.join( '?' * len( SliceStatus._fields ) ) ),
+                [ ( name, mtime, size ) + tuple( status )
+                  for name, mtime, size, status in rows ] )
+
+    def slices( self ):
+        ''' Return dict of slice name -> SliceStatus
+        '''
+        cols = ', '.join( INT_FIELDS + FLOAT_FIELDS + STR_FIELDS )
+        return { r[0]: SliceStatus( *r[1:] ) for r in
+                 self.db.execute( 'SELECT name, {0} FROM slices'.format( cols ) ) }
+
+
 class BkupDir( object ):
+    ''' Status of all dar slices of one backup.
+        Slice ini values come from a StatusCache, see load().
+    '''
     def __init__( self, path ):
         self.path = path
         self.filelist = []
         self.scandir_joblog = None
         self.num_expected_slices = 0
+        self.num_dar_optfiles = 0
         self.slices = {}
+        self._columns = None
         self._is_loaded = False
         self.load()
 
@@ -25,56 +137,98 @@ class BkupDir( object ):
     __repr__ = __str__
 
     def load( self ):
+        ''' Read slice status, parsing only ini files that changed since the
+            last load (by this or any earlier process).
+        '''
         if self._is_loaded:
             return
-        for x in self.path.iterdir():
-            if x.is_file():
-                if x.suffix == '.ini' and x.name != 'settings.ini':
-                    self.filelist.append( x )
-                elif x.suffix == '.filelist':
+        self.filelist = []
+        self.num_expected_slices = 0
+        self.num_dar_optfiles = 0
+        stamps = {}
+        with os.scandir( str( self.path ) ) as it:
+            for x in it:
+                if not x.is_file():
+                    continue
+                if x.name.endswith( '.ini' ) and x.name != 'settings.ini':
+                    # slice files are named KEY_TIMESTAMP_TYPE_NNNN.ini
+                    name = x.name[ :-len( '.ini' ) ].rsplit( '_', 1 )[-1]
+                    if not name.isdigit():
+                        continue
+                    self.filelist.append( pathlib.Path( x.path ) )
+                    st = x.stat()
+                    stamps[ name ] = ( x.path, st.st_mtime_ns, st.st_size )
+                elif x.name.endswith( '.filelist' ):
                     self.num_expected_slices += 1
-        self.slices = {}
-        for f in self.filelist:
-            name = f.stem.split( '_' )[3]
-            c = configparser.ConfigParser()
-            c.optionxform = lambda option: option
-            c.read( str( f ) )
-            self.slices[ name ] = c
+                elif x.name.endswith( '.dcf' ):
+                    self.num_dar_optfiles += 1
+        cache = StatusCache( self.path )
+        cached = cache.stamps()
+        changed = [ ( name, fn, mtime, size ) for name, ( fn, mtime, size ) in stamps.items()
+                    if cached.get( name ) != ( mtime, size ) ]
+        removed = [ name for name in cached if name not in stamps ]
+        fns = [ fn for name, fn, mtime, size in changed ]
+        if len( changed ) >= PARALLEL_PARSE_MIN:
+            with concurrent.futures.ProcessPoolExecutor() as pool:
+                statuses = list( pool.map( parse_slice_ini, fns, chunksize=64 ) )
+        else:
+            statuses = [ parse_slice_ini( fn ) for fn in fns ]
+        cache.update( [ ( name, mtime, size, status ) for ( name, fn, mtime, size ), status
+                        in zip( changed, statuses ) ], removed )
+        self.slices = cache.slices()
+        cache.db.close()
+        self._columns = None
         self.scandir_joblog = pathlib.Path( self.path / 'scandir.joblog' )
+        self.scandir_stats = pathlib.Path( self.path / 'scandir.stats' )
         self._is_loaded = True
 
     def reload( self ):
         self._is_loaded = False
         self.load()
 
+    def columns( self ):
+        ''' Return dict of INT_FIELDS name -> array of the values that are set,
+            plus 'COMPLETED_EXITCODE', the exit codes of slices with an ELAPSED,
+            and 'ACTIVE_START', the start times of slices still running.
+            Built once per load.
+        '''
+        if self._columns is None:
+            cols = { k: array.array( 'q' ) for k in INT_FIELDS }
+            cols[ 'COMPLETED_EXITCODE' ] = array.array( 'q' )
+            cols[ 'ACTIVE_START' ] = array.array( 'q' )
+            for status in self.slices.values():
+                for k, v in zip( INT_FIELDS, status ):
+                    if v is not None:
+                        cols[ k ].append( v )
+                if status.elapsed is not None:
+                    cols[ 'COMPLETED_EXITCODE' ].append(
+                        -1 if status.exitcode is None else status.exitcode )
+                elif status.start is not None:
+                    cols[ 'ACTIVE_START' ].append( status.start )
+            self._columns = cols
+        return self._columns
+
     def as_list( self, section, key, formatter=str ):
-        #return [ cfg[section][key] for s,cfg in self.slices.items() ]
-        return [ formatter( cfg[ section ][ key ] ) for name, cfg in
-            self.slices.items() if key in cfg[ section ] ]
+        if section != 'DAR' or key not in INT_FIELDS + FLOAT_FIELDS + STR_FIELDS:
+            raise UserWarning( 'value not cached: {0} {1}'.format( section, key ) )
+        if key in INT_FIELDS:
+            return [ formatter( v ) for v in self.columns()[ key ] ]
+        i = SliceStatus._fields.index( key.lower() )
+        return [ formatter( s[ i ] ) for s in self.slices.values() if s[ i ] is not None ]
 
     def dar_status( self ):
-        failed = 0
-        succeeded = 0
-        completed = 0
-        active = 0
+        cols = self.columns()
+        completed = len( cols[ 'COMPLETED_EXITCODE' ] )
+        succeeded = cols[ 'COMPLETED_EXITCODE' ].count( 0 )
+        failed = completed - succeeded
+        active = len( cols[ 'ACTIVE_START' ] )
         pending = self.num_expected_slices - len( self.slices )
         total = self.num_expected_slices
-        for name, cfg in self.slices.items():
-            if 'ELAPSED' in cfg[ 'DAR' ]:
-                completed += 1
-                if int( cfg[ 'DAR' ][ 'EXITCODE' ] ) == 0:
-                    succeeded += 1
-                else:
-                    failed += 1
-            elif 'START' in cfg[ 'DAR' ]:
-                active += 1
         nt = collections.namedtuple( 'DarStatus', 'failed succeeded completed active pending total' )
         return nt( failed, succeeded, completed, active, pending, total )
 
     def dar_runtime_stats( self ):
-#        times = [ int( cfg[ 'DAR' ][ 'ELAPSED' ] ) for name, cfg 
-#            in self.slices.items() if 'ELAPSED' in cfg[ 'DAR' ] ]
-        times = self.as_list( 'DAR', 'ELAPSED', formatter=int )
+        times = self.columns()[ 'ELAPSED' ]
         if len( times ) < 1:
             raise UserWarning( 'insufficient stats data' )
         nt = collections.namedtuple( 'DarTimes', 'min max median mean stdev' )
@@ -84,12 +238,54 @@ class BkupDir( object ):
                    statistics.mean( times ),
                    statistics.pstdev( times ) )
 
+    def dar_prediction_stats( self ):
+        """ Compare dar seconds (see dar_secs) of completed slices with the
+            PREDICTED_ELAPSED saved by mk_bkup_tasks (see runtime_model.py)
+            Returns: namedtuple( count, mean_error, mean_abs_error, median_ratio )
+            where error is actual - predicted and ratio is actual / predicted
+        """
+        pairs = [ ( dar_secs( s ), s.predicted_elapsed ) for s in self.slices.values()
+                  if s.elapsed is not None and s.predicted_elapsed is not None ]
+        if len( pairs ) < 1:
+            raise UserWarning( 'insufficient prediction data' )
+        errors = [ a - p for a, p in pairs ]
+        nt = collections.namedtuple( 'DarPrediction',
+            'count mean_error mean_abs_error median_ratio' )
+        return nt( len( pairs ),
+                   statistics.mean( errors ),
+                   statistics.mean( abs( e ) for e in errors ),
+                   statistics.median( a / max( p, 1 ) for a, p in pairs ) )
+
+    def dar_compression_stats( self ):
+        """ Compare the archive bytes of successful slices with their input
+            bytes and with the EST_ARCHIVE_BYTES saved by mk_bkup_tasks
+            (see compress_probe.py)
+            Returns: namedtuple( count, compressed, bytes, archive_bytes,
+                                 est_archive_bytes, saved_bytes )
+            where est_archive_bytes is summed over the slices that have one
+        """
+        done = [ s for s in self.slices.values()
+                 if s.exitcode == 0 and s.bytes is not None and s.archive_bytes is not None ]
+        if len( done ) < 1:
+            raise UserWarning( 'insufficient compression data' )
+        nbytes = sum( s.bytes for s in done )
+        archive = sum( s.archive_bytes for s in done )
+        nt = collections.namedtuple( 'DarCompression',
+            'count compressed bytes archive_bytes est_archive_bytes saved_bytes' )
+        return nt( len( done ),
+                   sum( 1 for s in done if s.compression not in ( None, 'none' ) ),
+                   nbytes,
+                   archive,
+                   sum( s.est_archive_bytes for s in done if s.est_archive_bytes is not None ),
+                   nbytes - archive )
+
     def dar_elapsed_total( self ):
         """ Total runtime for all dars to complete
             Returns: namedtuple( total_runtime )
         """
-        start = min( self.as_list( 'DAR', 'START', formatter=int ), default=0 )
-        end = max (self.as_list( 'DAR', 'END', formatter=int ), default=0 )
+        cols = self.columns()
+        start = min( cols[ 'START' ], default=0 )
+        end = max( cols[ 'END' ], default=0 )
         if end < 1 or start < 1:
             raise UserWarning( 'insufficient time data' )
         runtime = end - start
@@ -100,6 +296,12 @@ class BkupDir( object ):
         """ Total runtime for scandir task
             Returns: datetime.timedelta
         """
+        if self.scandir_stats.exists():
+            # written by scandir.py
+            c = configparser.ConfigParser()
+            c.optionxform = lambda option: option
+            c.read( str( self.scandir_stats ) )
+            return datetime.timedelta( seconds=int( c[ 'SCANDIR' ][ 'ELAPSED' ] ) )
         min_start = datetime.datetime.now()
         max_end = datetime.datetime.fromtimestamp( 0 )
         with self.scandir_joblog.open() as f:
@@ -204,6 +406,26 @@ def print_dar_summary( bkupdir ):
         for i,k in enumerate( tdata._fields ):
             print( '    {k}: {s} ({t})'.format( 
                 k=k.capitalize(), s=tdata[i], t=datetime.timedelta( seconds=tdata[i] ) ) )
+    print( 'Dar Runtime Prediction' )
+    try:
+        pdata = bkupdir.dar_prediction_stats()
+    except ( UserWarning ) as e:
+        print( e )
+    else:
+        print( '    Count: {0}'.format( pdata.count ) )
+        # positive when slices ran longer than predicted
+        print( '    Mean_error: {0:+.0f}'.format( pdata.mean_error ) )
+        print( '    Mean_abs_error: {s:.0f} ({t})'.format( s=pdata.mean_abs_error,
+            t=datetime.timedelta( seconds=round( pdata.mean_abs_error ) ) ) )
+        print( '    Median_ratio: {0:.2f}'.format( pdata.median_ratio ) )
+    print( 'Dar Compression' )
+    try:
+        cdata = bkupdir.dar_compression_stats()
+    except ( UserWarning ) as e:
+        print( e )
+    else:
+        for i,k in enumerate( cdata._fields ):
+            print( '    {k}: {v}'.format( k=k.capitalize(), v=cdata[i] ) )
     print( 'Dar Runtime' )
     try:
         rdata = bkupdir.dar_elapsed_total()
@@ -231,7 +453,7 @@ def run():
         print_dar_summary( bkupdir )
 
     if args.dar_histogram:
-        histogram( intlist = bkupdir.as_list( 'DAR', 'ELAPSED', formatter=int ),
+        histogram( intlist = bkupdir.columns()[ 'ELAPSED' ],
                    title = 'Dar Slice Elapsed Time',
                    x_key = 'Num Seconds',
                    max_height = 40 )
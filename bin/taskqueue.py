@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+
+import argparse
+import collections
+import logging
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import urllib.parse
+
+logr = logging.getLogger()
+console_handler = logging.StreamHandler()
+formatter = logging.Formatter( '%(levelname)s [%(filename)s %(lineno)d] %(message)s' )
+console_handler.setFormatter( formatter )
+logr.addHandler( console_handler )
+logr.setLevel( logging.WARNING )
+
+DESCRIPTION = '''
+    Query GNU parallel sqlmaster task queues.
+    sqlite3 queues are read directly, one aggregated query per queue;
+    other DB vendors are queried through the GNU "sql" command, also once
+    per queue.
+'''
+
+# Exitval values that GNU parallel uses for tasks that have not finished
+EXITVAL_READY = -1000
+EXITVAL_ACTIVE = -1220
+
+TaskCounts = collections.namedtuple( 'TaskCounts', 'ready active succeeded failed' )
+
+QNAME_RE = re.compile( r'^QNAME="?([^"\n]*)"?', re.MULTILINE )
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser( description=DESCRIPTION )
+    parser.add_argument( '-t', '--table',
+        help='Task table name, PARALLEL::DB_TABLE (default: %(default)s)' )
+    parser.add_argument( '-w', '--workdir',
+        help='Directory holding *.sqlworker.cmd files (GENERAL::DATADIR/PARALLEL::WORKDIR)' )
+    parser.add_argument( '-v', '--verbose', action='store_true' )
+    parser.add_argument( '-d', '--debug', action='store_true' )
+    subparsers = parser.add_subparsers( dest='action' )
+    p_counts = subparsers.add_parser( 'counts',
+        help=( 'Print "READY ACTIVE SUCCEEDED FAILED DBURL [CMDFILE]" for each queue; '
+               'queues that cannot be read are left out' ) )
+    p_counts.add_argument( 'dburls', metavar='DBURL', nargs='*' )
+    p_counts.add_argument( '-a', '--all', action='store_true',
+        help='every queue with a sqlworker cmdfile in workdir, oldest first' )
+    subparsers.add_parser( 'next',
+        help=( 'Print the sqlworker cmdfile a worker should run: the oldest queue that '
+               'has both started and ready tasks, else the oldest with ready tasks' ) )
+    p_hosts = subparsers.add_parser( 'hosts',
+        help='Print "HOST EXITVAL COUNT" for a queue' )
+    p_hosts.add_argument( 'dburl', metavar='DBURL' )
+    parser.set_defaults(
+        table = 'tasks',
+    )
+    args = parser.parse_args()
+    if args.verbose:
+        logr.setLevel( logging.INFO )
+    if args.debug:
+        logr.setLevel( logging.DEBUG )
+    if not args.action:
+        parser.error( 'missing action' )
+    if ( args.action == 'next' or getattr( args, 'all', False ) ) and not args.workdir:
+        parser.error( '--workdir is required' )
+    return args
+
+
+def dburl_vendor( dburl ):
+    return dburl.split( ':', 1 )[0]
+
+
+def dburl2filename( dburl ):
+    ''' Return the database file of a sqlite3 or csv dburl (see mk_dburl),
+        None for other vendors
+    '''
+    if dburl_vendor( dburl ) not in ( 'sqlite3', 'csv' ):
+        return None
+    return urllib.parse.unquote( dburl.rsplit( '/', 1 )[-1] )
+
+
+def _query( dburl, sql ):
+    ''' Return rows of a select as a list of tuples of strings or numbers.
+        Raise OSError if the queue cannot be read.
+    '''
+    if dburl_vendor( dburl ) == 'sqlite3':
+        fn = dburl2filename( dburl )
+        try:
+            # read-only, never create a missing queue
+            db = sqlite3.connect( 'file:{0}?mode=ro'.format( urllib.parse.quote( fn ) ),
+                                  uri=True, timeout=30 )
+            try:
+                return db.execute( sql ).fetchall()
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            raise OSError( "{0}: {1}".format( fn, e ) )
+    proc = subprocess.run( [ 'sql', '-n', dburl, sql + ';' ],
+                           stdout=subprocess.PIPE,
+                           universal_newlines=True )
+    if proc.returncode != 0:
+        raise OSError( "sql exited with code {0} for '{1}'".format( proc.returncode, dburl ) )
+    return [ tuple( line.split() ) for line in proc.stdout.splitlines() if line.strip() ]
+
+
+def task_counts( dburl, table='tasks' ):
+    ''' Return TaskCounts for one queue
+    '''
+    rows = _query( dburl, 'SELECT Exitval, count(*) FROM {0} GROUP BY Exitval'.format( table ) )
+    ready = active = succeeded = failed = 0
+    for exitval, count in rows:
+        exitval = int( exitval )
+        count = int( count )
+        if exitval == EXITVAL_READY:
+            ready += count
+        elif exitval == EXITVAL_ACTIVE:
+            active += count
+        elif exitval == 0:
+            succeeded += count
+        elif exitval > 0:
+            failed += count
+    return TaskCounts( ready, active, succeeded, failed )
+
+
+def host_counts( dburl, table='tasks' ):
+    return _query( dburl,
+        'SELECT Host, Exitval, count(*) FROM {0} GROUP BY Host, Exitval'.format( table ) )
+
+
+def dburl_from_cmdfile( fn ):
+    with open( fn ) as f:
+        match = QNAME_RE.search( f.read() )
+    return match.group( 1 ) if match else None
+
+
+def sqlworker_cmdfiles( workdir ):
+    ''' Return list of ( cmdfile, dburl ), oldest cmdfile first
+    '''
+    entries = []
+    with os.scandir( workdir ) as it:
+        for e in it:
+            if e.name.endswith( '.sqlworker.cmd' ) and e.is_file():
+                entries.append( ( e.stat().st_mtime, e.path ) )
+    rv = []
+    for mtime, fn in sorted( entries ):
+        dburl = dburl_from_cmdfile( fn )
+        if dburl:
+            rv.append( ( fn, dburl ) )
+        else:
+            logr.warning( "No QNAME in '{0}'".format( fn ) )
+    return rv
+
+
+def all_task_counts( workdir, table='tasks' ):
+    ''' Generate ( cmdfile, dburl, TaskCounts ) for every queue in workdir, oldest first.
+        Queues that cannot be read are skipped.
+    '''
+    for fn, dburl in sqlworker_cmdfiles( workdir ):
+        try:
+            counts = task_counts( dburl, table )
+        except OSError as e:
+            logr.warning( e )
+            continue
+        logr.debug( "{0} {1}".format( fn, counts ) )
+        yield ( fn, dburl, counts )
+
+
+def next_cmdfile( workdir, table='tasks' ):
+    ''' Return the sqlworker cmdfile of the oldest queue that has ready tasks
+        and is already started, or else of the oldest queue with ready tasks.
+        Return None if no queue has ready tasks.
+    '''
+    first_ready = None
+    for fn, dburl, counts in all_task_counts( workdir, table ):
+        if counts.ready < 1:
+            continue
+        if counts.active > 0:
+            return fn
+        if first_ready is None:
+            first_ready = fn
+    return first_ready
+
+
+def run():
+    args = process_cmdline()
+    rv = 0
+    if args.action == 'counts':
+        if args.all:
+            for fn, dburl, counts in all_task_counts( args.workdir, args.table ):
+                print( ' '.join( map( str, counts ) ), dburl, fn )
+        for dburl in args.dburls:
+            try:
+                counts = task_counts( dburl, args.table )
+            except OSError as e:
+                logr.warning( e )
+                rv = 1
+                continue
+            print( ' '.join( map( str, counts ) ), dburl )
+    elif args.action == 'next':
+        fn = next_cmdfile( args.workdir, args.table )
+        if fn:
+            print( fn )
+    elif args.action == 'hosts':
+        for row in host_counts( args.dburl, args.table ):
+            # tasks not yet taken by a worker have no host
+            print( ' '.join( '-' if v in ( None, '' ) else str( v ) for v in row ) )
+    sys.exit( rv )
+
+
+if __name__ == '__main__':
+    try:
+        run()
+    except ( UserWarning, OSError ) as e:
+        logr.error( e )
+        sys.exit( 1 )
@@ -0,0 +1,270 @@
+import collections
+import datetime
+import fcntl
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+logr = logging.getLogger( __name__ )
+
+# Limits of a [THROTTLE_<NAME>] section, None means no limit
+Profile = collections.namedtuple( 'Profile',
+    'name meta_ops_per_sec read_bytes_per_sec max_dar_per_node max_dar_total' )
+LIMIT_KEYS = ( 'META_OPS_PER_SEC', 'READ_BYTES_PER_SEC', 'MAX_DAR_PER_NODE', 'MAX_DAR_TOTAL' )
+NO_LIMITS = Profile( 'NONE', None, None, None, None )
+
+DAYS = ( 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun' )
+
+DEFAULT_STATE_DIR = '/dev/shm/pdbkup_throttle'
+
+# Secs between checks of which profile applies
+PROFILE_CHECK = 60
+
+# Secs after which a dar slot that was not updated is taken as dead
+SLOT_STALE = 300
+
+
+def is_enabled( cfg ):
+    if not cfg.has_section( 'THROTTLE' ):
+        return False
+    sec = cfg[ 'THROTTLE' ]
+    return bool( sec.get( 'PROFILES', '' ).split() or sec.get( 'DEFAULT_PROFILE', '' ).strip() )
+
+
+def _limit( val ):
+    val = ( val or '' ).strip()
+    if not val or int( val ) <= 0:
+        return None
+    return int( val )
+
+
+def _minutes( hhmm ):
+    h, m = hhmm.split( ':' )
+    return int( h ) * 60 + int( m )
+
+
+def profile_matches( section, now ):
+    ''' True if DAYS and HOURS of a profile section include now.
+        HOURS may wrap past midnight, eg. 22:00-06:00.
+    '''
+    days = section.get( 'DAYS', '' ).split()
+    if days and DAYS[ now.weekday() ] not in days:
+        return False
+    hours = section.get( 'HOURS', '' ).strip()
+    if not hours:
+        return True
+    start, end = ( _minutes( t ) for t in hours.split( '-' ) )
+    t = now.hour * 60 + now.minute
+    if start <= end:
+        return start <= t < end
+    return t >= start or t < end
+
+
+def mk_profile( cfg, name ):
+    secname = 'THROTTLE_{0}'.format( name )
+    if not cfg.has_section( secname ):
+        raise UserWarning( "No section [{0}] for throttle profile '{1}'".format( secname, name ) )
+    sec = cfg[ secname ]
+    return Profile( name, *[ _limit( sec.get( k ) ) for k in LIMIT_KEYS ] )
+
+
+def current_profile( cfg, now=None ):
+    ''' Return the Profile for now: the first of THROTTLE::PROFILES that
+        matches, else DEFAULT_PROFILE, else NO_LIMITS
+    '''
+    if not is_enabled( cfg ):
+        return NO_LIMITS
+    if now is None:
+        now = datetime.datetime.now()
+    sec = cfg[ 'THROTTLE' ]
+    for name in sec.get( 'PROFILES', '' ).split():
+        # checks the section exists
+        profile = mk_profile( cfg, name )
+        if profile_matches( cfg[ 'THROTTLE_{0}'.format( name ) ], now ):
+            return profile
+    default = sec.get( 'DEFAULT_PROFILE', '' ).strip()
+    if default:
+        return mk_profile( cfg, default )
+    return NO_LIMITS
+
+
+class TokenBucket( object ):
+    ''' Token bucket shared by every process on a node through a small state
+        file ("TOKENS TIMESTAMP"), updated under flock. It holds at most one
+        second of tokens. take() may leave the bucket in debt; the caller
+        waits that off without holding the lock, so all callers get their
+        share of the rate in the order they asked.
+    '''
+    def __init__( self, fn ):
+        self.fn = fn
+
+    def take( self, n, rate ):
+        ''' Take n tokens at rate per second.
+            Return seconds the caller must wait before going on.
+        '''
+        if not rate:
+            return 0.0
+        with open( self.fn, 'a+' ) as f:
+            fcntl.flock( f, fcntl.LOCK_EX )
+            f.seek( 0 )
+            now = time.time()
+            try:
+                tokens, last = ( float( x ) for x in f.read().split() )
+            except ValueError:
+                tokens, last = rate, now
+            tokens = min( rate, tokens + ( now - last ) * rate ) - n
+            f.seek( 0 )
+            f.truncate()
+            f.write( '{0:.3f} {1:.6f}\n'.format( tokens, now ) )
+        return max( 0.0, -tokens / rate )
+
+    def level( self ):
+        ''' Return tokens as of the last take, None if never used
+        '''
+        try:
+            with open( self.fn ) as f:
+                return float( f.read().split()[0] )
+        except ( OSError, IndexError, ValueError ):
+            return None
+
+
+class Governor( object ):
+    ''' Throttle of one process: the current profile and the node's token
+        buckets, one for metadata operations and one for bytes read.
+        Profile changes are picked up within PROFILE_CHECK seconds.
+    '''
+    def __init__( self, cfg ):
+        self.cfg = cfg
+        statedir = DEFAULT_STATE_DIR
+        if cfg.has_section( 'THROTTLE' ):
+            statedir = cfg[ 'THROTTLE' ].get( 'STATE_DIR', '' ).strip() or statedir
+        os.makedirs( statedir, exist_ok=True )
+        self.meta_bucket = TokenBucket( os.path.join( statedir, 'meta_ops' ) )
+        self.read_bucket = TokenBucket( os.path.join( statedir, 'read_bytes' ) )
+        self.profile = None
+        self.checked = 0
+
+    def limits( self ):
+        now = time.time()
+        if now - self.checked >= PROFILE_CHECK:
+            profile = current_profile( self.cfg )
+            if self.profile is not None and profile != self.profile:
+                logr.info( "Throttle profile changed to '{0}'".format( profile.name ) )
+            self.profile = profile
+            self.checked = now
+        return self.profile
+
+    def meta( self, n ):
+        ''' Account for n readdir / stat calls, sleeping if over the limit.
+            Return seconds slept.
+        '''
+        wait = self.meta_bucket.take( n, self.limits().meta_ops_per_sec )
+        if wait > 0:
+            time.sleep( wait )
+        return wait
+
+    def read( self, n ):
+        ''' Account for n bytes read. Return seconds the reader must pause.
+        '''
+        return self.read_bucket.take( n, self.limits().read_bytes_per_sec )
+
+
+def slots_db( cfg ):
+    ''' Dar slot db lives with the task queues, where every node sees it
+    '''
+    return os.path.join( cfg[ 'GENERAL' ][ 'DATADIR' ], cfg[ 'PARALLEL' ][ 'WORKDIR' ],
+                         'throttle.sqlite3' )
+
+
+def _alive( pid ):
+    try:
+        os.kill( pid, 0 )
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class DarSlots( object ):
+    ''' Running dar tasks of all nodes, one row per task, in a sqlite db.
+        Tasks update a heartbeat; rows of tasks that stopped updating, or
+        whose process is gone, are dropped. The oldest tasks keep running
+        when a profile allows fewer than are running.
+    '''
+    SCHEMA = ( 'CREATE TABLE IF NOT EXISTS slots ( '
+               'id INTEGER PRIMARY KEY AUTOINCREMENT, host TEXT, pid INTEGER, '
+               'start REAL, heartbeat REAL, paused REAL )' )
+
+    def __init__( self, fn ):
+        self.db = sqlite3.connect( fn, timeout=60, isolation_level=None )
+        self.db.execute( self.SCHEMA )
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self.id = None
+
+    def _prune( self, now ):
+        self.db.execute( 'DELETE FROM slots WHERE heartbeat < ?', ( now - SLOT_STALE, ) )
+        rows = self.db.execute( 'SELECT id, pid FROM slots WHERE host = ?', ( self.host, ) ).fetchall()
+        for rowid, pid in rows:
+            if not _alive( pid ):
+                self.db.execute( 'DELETE FROM slots WHERE id = ?', ( rowid, ) )
+
+    def _over( self, profile, node, total ):
+        return ( ( profile.max_dar_per_node is not None and node >= profile.max_dar_per_node )
+                 or ( profile.max_dar_total is not None and total >= profile.max_dar_total ) )
+
+    def try_acquire( self, profile ):
+        ''' Take a slot if the profile allows one more task. Return True if taken.
+        '''
+        now = time.time()
+        self.db.execute( 'BEGIN IMMEDIATE' )
+        try:
+            self._prune( now )
+            node, = self.db.execute( 'SELECT count(*) FROM slots WHERE host = ?',
+                                     ( self.host, ) ).fetchone()
+            total, = self.db.execute( 'SELECT count(*) FROM slots' ).fetchone()
+            if self._over( profile, node, total ):
+                return False
+            cur = self.db.execute(
+                'INSERT INTO slots ( host, pid, start, heartbeat, paused ) VALUES ( ?, ?, ?, ?, 0 )',
+                ( self.host, self.pid, now, now ) )
+            self.id = cur.lastrowid
+            return True
+        finally:
+            self.db.execute( 'COMMIT' )
+
+    def acquire( self, governor, poll=10 ):
+        ''' Wait for a slot. Return seconds waited.
+        '''
+        start = time.time()
+        while not self.try_acquire( governor.limits() ):
+            time.sleep( poll )
+        return time.time() - start
+
+    def heartbeat( self, profile, paused ):
+        ''' Record liveness and paused seconds. Return False if this task is
+            beyond what the profile allows (newer tasks are paused first).
+        '''
+        now = time.time()
+        self.db.execute( 'UPDATE slots SET heartbeat = ?, paused = ? WHERE id = ?',
+                         ( now, paused, self.id ) )
+        stale = now - SLOT_STALE
+        node, = self.db.execute(
+            'SELECT count(*) FROM slots WHERE host = ? AND id < ? AND heartbeat >= ?',
+            ( self.host, self.id, stale ) ).fetchone()
+        total, = self.db.execute(
+            'SELECT count(*) FROM slots WHERE id < ? AND heartbeat >= ?',
+            ( self.id, stale ) ).fetchone()
+        return not self._over( profile, node, total )
+
+    def release( self ):
+        if self.id is not None:
+            self.db.execute( 'DELETE FROM slots WHERE id = ?', ( self.id, ) )
+            self.id = None
+
+    def rows( self ):
+        return self.db.execute(
+            'SELECT host, pid, start, heartbeat, paused FROM slots ORDER BY id' ).fetchall()
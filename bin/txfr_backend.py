@@ -0,0 +1,279 @@
+import abc
+import collections
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+import uuid
+
+logr = logging.getLogger( __name__ )
+
+# Task states, same names as globus uses
+ACTIVE = 'ACTIVE'
+INACTIVE = 'INACTIVE'
+SUCCEEDED = 'SUCCEEDED'
+FAILED = 'FAILED'
+# Tasks in these states still hold a slot, see txfr_batch.py
+IN_FLIGHT = ( ACTIVE, INACTIVE )
+# Tasks in these states never change again
+DONE = ( SUCCEEDED, FAILED )
+
+# What is known about a task, field names as in globus task documents
+TaskInfo = collections.namedtuple( 'TaskInfo',
+    'task_id status files files_transferred bytes_transferred '
+    'effective_bytes_per_second source_endpoint_id destination_endpoint_id' )
+
+
+def task_info( doc ):
+    ''' Return TaskInfo from a dict with (some of) its fields
+    '''
+    return TaskInfo( *( doc.get( f ) for f in TaskInfo._fields ) )
+
+
+class TransferBackend( abc.ABC ):
+    ''' Moves files to long term storage
+    '''
+    @abc.abstractmethod
+    def submit( self, pairs, label ):
+        ''' Start one transfer task for the ( source path, target path ) pairs.
+            Return the task id.
+            Raise OSError if the task could not be submitted.
+        '''
+
+    @abc.abstractmethod
+    def status( self, taskid ):
+        ''' Return the state of a task, one of ACTIVE, INACTIVE, SUCCEEDED, FAILED.
+            Raise OSError if the task cannot be looked up.
+        '''
+
+    def tasks( self, taskids ):
+        ''' Return dict of task id -> TaskInfo for the tasks that could be
+            looked up. Backends that can should look them all up at once;
+            this one asks status() for each.
+        '''
+        rv = {}
+        for taskid in taskids:
+            try:
+                rv[ taskid ] = task_info( { 'task_id': taskid, 'status': self.status( taskid ) } )
+            except OSError as e:
+                logr.warning( e )
+        return rv
+
+    @abc.abstractmethod
+    def succeeded_files( self, taskid ):
+        ''' Return set of the source paths that the task transferred.
+            Raise OSError if the task cannot be looked up.
+        '''
+
+    def set_label( self, taskid, label ):
+        pass
+
+
+class GlobusBackend( TransferBackend ):
+    ''' Transfers through the globus cli
+    '''
+    # globus task list takes at most this many --filter-task-id
+    LIST_MAX_IDS = 50
+
+    def __init__( self, cli, src_endpoint, dst_endpoint ):
+        self.cli = cli
+        self.src_endpoint = src_endpoint
+        self.dst_endpoint = dst_endpoint
+
+    def _run( self, args, input=None ):
+        cmd = [ self.cli ] + args
+        logr.debug( ' '.join( cmd ) )
+        proc = subprocess.run( cmd,
+                               input=input,
+                               stdout=subprocess.PIPE,
+                               universal_newlines=True )
+        if proc.returncode != 0:
+            raise OSError( "'{0}' exited with code {1}".format( ' '.join( cmd ), proc.returncode ) )
+        return proc.stdout
+
+    def submit( self, pairs, label ):
+        subm_id = self._run( [ 'task', 'generate-submission-id' ] ).strip()
+        logr.info( "SUBMISSION ID: '{0}'".format( subm_id ) )
+        out = self._run( [ 'transfer', self.src_endpoint, self.dst_endpoint,
+                           '--submission-id', subm_id,
+                           '--label', label,
+                           '--batch',
+                           '-F', 'json' ],
+                         input=''.join( '{0} {1}\n'.format( s, t ) for s, t in pairs ) )
+        try:
+            return json.loads( out )[ 'task_id' ]
+        except ( ValueError, KeyError ):
+            raise OSError( "No task_id in globus transfer output: {0}".format( out ) )
+
+    def status( self, taskid ):
+        out = self._run( [ 'task', 'show', '-F', 'json', taskid ] )
+        try:
+            return json.loads( out )[ 'status' ]
+        except ( ValueError, KeyError ):
+            raise OSError( "No status in globus task output: {0}".format( out ) )
+
+    def tasks( self, taskids ):
+        taskids = list( taskids )
+        rv = {}
+        for i in range( 0, len( taskids ), self.LIST_MAX_IDS ):
+            args = [ 'task', 'list', '-F', 'json', '--limit', str( self.LIST_MAX_IDS ) ]
+            for taskid in taskids[ i:i + self.LIST_MAX_IDS ]:
+                args.extend( [ '--filter-task-id', taskid ] )
+            out = self._run( args )
+            try:
+                docs = json.loads( out )[ 'DATA' ]
+            except ( ValueError, KeyError ):
+                raise OSError( "No DATA in globus task list output: {0}".format( out ) )
+            for doc in docs:
+                rv[ doc[ 'task_id' ] ] = task_info( doc )
+        return rv
+
+    def succeeded_files( self, taskid ):
+        out = self._run( [ 'task', 'show', '--successful-transfers', '-F', 'json', taskid ] )
+        try:
+            return set( e[ 'source_path' ] for e in json.loads( out )[ 'DATA' ]
+                        if e.get( 'DATA_TYPE' ) == 'successful_transfer' )
+        except ( ValueError, KeyError ):
+            raise OSError( "No DATA in globus successful transfers output: {0}".format( out ) )
+
+    def set_label( self, taskid, label ):
+        self._run( [ 'task', 'update', '--label', label, taskid ] )
+
+
+class LocalCopyBackend( TransferBackend ):
+    ''' Stand-in for the remote endpoint: copies files below a local directory
+        before submit returns. Task states are kept in a json file there.
+    '''
+    STATEFILE = '.txfr_tasks.json'
+
+    def __init__( self, destdir ):
+        if not os.path.isdir( destdir ):
+            raise OSError( "Local transfer destination '{0}' is not a directory".format( destdir ) )
+        self.destdir = destdir
+        self.statefile = os.path.join( destdir, self.STATEFILE )
+
+    def _load( self ):
+        if not os.path.exists( self.statefile ):
+            return {}
+        with open( self.statefile ) as f:
+            return json.load( f )
+
+    def _save( self, tasks ):
+        tmpfn = self.statefile + '.tmp'
+        with open( tmpfn, 'w' ) as f:
+            json.dump( tasks, f )
+        os.rename( tmpfn, self.statefile )
+
+    def submit( self, pairs, label ):
+        taskid = str( uuid.uuid4() )
+        status = SUCCEEDED
+        succeeded = []
+        nbytes = 0
+        for src, tgt in pairs:
+            dst = os.path.join( self.destdir, tgt.lstrip( '/' ) )
+            try:
+                os.makedirs( os.path.dirname( dst ), exist_ok=True )
+                shutil.copy2( src, dst )
+            except OSError as e:
+                logr.warning( e )
+                status = FAILED
+                continue
+            succeeded.append( src )
+            nbytes += os.path.getsize( dst )
+        tasks = self._load()
+        tasks[ taskid ] = { 'status': status, 'label': label,
+                            'files': len( pairs ), 'files_transferred': len( succeeded ),
+                            'bytes_transferred': nbytes, 'effective_bytes_per_second': 0,
+                            'source_endpoint_id': 'local', 'destination_endpoint_id': 'local',
+                            'succeeded': succeeded }
+        self._save( tasks )
+        return taskid
+
+    def status( self, taskid ):
+        try:
+            return self._load()[ taskid ][ 'status' ]
+        except KeyError:
+            raise OSError( "Unknown task '{0}'".format( taskid ) )
+
+    def tasks( self, taskids ):
+        tasks = self._load()
+        return { t: task_info( dict( tasks[ t ], task_id=t ) ) for t in taskids if t in tasks }
+
+    def succeeded_files( self, taskid ):
+        try:
+            return set( self._load()[ taskid ].get( 'succeeded', [] ) )
+        except KeyError:
+            raise OSError( "Unknown task '{0}'".format( taskid ) )
+
+
+class TaskCache( object ):
+    ''' Task states of a backend, looked up in one batched call for all the
+        tasks that are not cached, or whose entry is older than ttl seconds.
+        Tasks that are done never change, so they stay cached until they
+        are dropped. Entries are kept in cachefile between runs.
+    '''
+    def __init__( self, backend, ttl, cachefile=None ):
+        self.backend = backend
+        self.ttl = ttl
+        self.cachefile = cachefile
+        self.entries = {}
+        self.dirty = False
+        if cachefile and os.path.exists( cachefile ):
+            try:
+                with open( cachefile ) as f:
+                    self.entries = { k: ( t, task_info( doc ) ) for k, ( t, doc ) in json.load( f ).items() }
+            except ( OSError, ValueError, TypeError ) as e:
+                logr.warning( "Ignoring unreadable cache '{0}': {1}".format( cachefile, e ) )
+
+    def _fresh( self, entry, now ):
+        return entry[1].status in DONE or now - entry[0] < self.ttl
+
+    def get( self, taskids ):
+        ''' Return dict of task id -> TaskInfo for the tasks that could be looked up
+        '''
+        now = time.time()
+        stale = [ t for t in taskids
+                  if t not in self.entries or not self._fresh( self.entries[ t ], now ) ]
+        if stale:
+            logr.debug( "Looking up {0} of {1} tasks".format( len( stale ), len( taskids ) ) )
+            for taskid, info in self.backend.tasks( stale ).items():
+                self.entries[ taskid ] = ( now, info )
+            self.dirty = True
+        return { t: self.entries[ t ][1] for t in taskids if t in self.entries }
+
+    def drop( self, taskid ):
+        if self.entries.pop( taskid, None ):
+            self.dirty = True
+
+    def save( self, keep=None ):
+        ''' Write cachefile, keeping only the task ids in keep (if given)
+        '''
+        if keep is not None:
+            keep = set( keep )
+            for taskid in list( self.entries ):
+                if taskid not in keep:
+                    self.drop( taskid )
+        if not ( self.cachefile and self.dirty ):
+            return
+        tmpfn = self.cachefile + '.tmp'
+        try:
+            with open( tmpfn, 'w' ) as f:
+                json.dump( { k: ( t, info._asdict() ) for k, ( t, info ) in self.entries.items() }, f )
+            os.rename( tmpfn, self.cachefile )
+        except OSError as e:
+            logr.warning( "Unable to save cache '{0}': {1}".format( self.cachefile, e ) )
+        self.dirty = False
+
+
+def from_cfg( cfg ):
+    ''' Return the TransferBackend selected by TXFR::BACKEND
+    '''
+    name = cfg[ 'TXFR' ].get( 'BACKEND', 'globus' ) or 'globus'
+    if name == 'globus':
+        globus = cfg[ 'GLOBUS' ]
+        return GlobusBackend( globus[ 'CLI' ], globus[ 'ENDPOINT_LOCAL' ], globus[ 'ENDPOINT_REMOTE' ] )
+    elif name == 'local':
+        return LocalCopyBackend( cfg[ 'TXFR' ][ 'LOCAL_DESTDIR' ] )
+    raise UserWarning( "Unknown TXFR::BACKEND '{0}'".format( name ) )
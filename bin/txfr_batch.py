@@ -0,0 +1,264 @@
+#!/usr/bin/python3
+
+import argparse
+import collections
+import logging
+import os
+import re
+import sys
+import time
+
+import summary
+import txfr_backend
+
+logr = logging.getLogger()
+# txfr_status.py imports this module and sets up its own handler
+if __name__ == '__main__':
+    console_handler = logging.StreamHandler()
+    formatter = logging.Formatter( '%(levelname)s [%(filename)s %(lineno)d] %(message)s' )
+    console_handler.setFormatter( formatter )
+    logr.addHandler( console_handler )
+    logr.setLevel( logging.WARNING )
+
+DESCRIPTION = '''
+    Start transfer tasks for the archives in TXFR::SRCDIR_OUTBOUND (txfr startnew).
+    Archives are grouped into tasks of up to BATCH_MAX_BYTES and
+    BATCH_MAX_FILES, backups that already have files in flight go first,
+    then the oldest backup, and each backup's INFO archive goes last.
+    No more than MAX_ACTIVE_TASKS tasks are in flight at once. A batch that
+    is not full waits up to BATCH_MAX_WAIT seconds for more archives.
+    The total size of each task is saved in its filelist.
+'''
+
+# Filelist header lines, so status never has to stat the files again
+HDR_BYTES = '# TOTAL_BYTES '
+HDR_FILES = '# TOTAL_FILES '
+
+KEY_TS_RE = re.compile( r'_[0-9]+' )
+
+# Task states cache in INFODIR, see txfr_backend.TaskCache
+STATUS_CACHE = '.txfr_status.cache'
+
+Archive = collections.namedtuple( 'Archive', 'name size mtime backup tgt' )
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser( description=DESCRIPTION )
+    parser.add_argument( '--max_bytes', type=int,
+        help='Target bytes per task (default: TXFR::BATCH_MAX_BYTES)' )
+    parser.add_argument( '--max_files', type=int,
+        help='Max files per task (default: TXFR::BATCH_MAX_FILES)' )
+    parser.add_argument( '--max_tasks', type=int,
+        help='Max tasks in flight (default: TXFR::MAX_ACTIVE_TASKS)' )
+    parser.add_argument( '--max_wait', type=int,
+        help='Seconds a batch that is not full waits (default: TXFR::BATCH_MAX_WAIT)' )
+    parser.add_argument( '-f', '--flush', action='store_true',
+        help='Send a batch that is not full without waiting' )
+    parser.add_argument( '-n', '--dry_run', action='store_true',
+        help='Print the batches that would be sent, change nothing' )
+    parser.add_argument( '-v', '--verbose', action='store_true' )
+    parser.add_argument( '-d', '--debug', action='store_true' )
+    args = parser.parse_args()
+    if args.verbose:
+        logr.setLevel( logging.INFO )
+    if args.debug:
+        logr.setLevel( logging.DEBUG )
+    return args
+
+
+def filename2key_ts( name ):
+    ''' Same as filename2key_ts in lib/funcs_archive.sh.
+        Return tuple of ( key, ts, backup ) where ts is everything after the
+        key (and is the remote directory of the file) and backup is
+        KEY_TIMESTAMP, the backup the file belongs to.
+    '''
+    base = name.split( '.', 1 )[0].split( '_INFO', 1 )[0]
+    m = KEY_TS_RE.search( base )
+    if not m:
+        return ( '', base, base )
+    return ( base[ :m.start() ], base[ m.start() + 1: ], base[ :m.end() ] )
+
+
+def ready_archives( srcdir, remote_basedir ):
+    ''' Return list of Archive for the files in srcdir
+    '''
+    rv = []
+    with os.scandir( srcdir ) as it:
+        for e in it:
+            if not e.is_file():
+                continue
+            key, ts, backup = filename2key_ts( e.name )
+            st = e.stat()
+            tgt = '{0}/{1}/{2}/{3}'.format( remote_basedir, key, ts, e.name )
+            rv.append( Archive( e.name, st.st_size, st.st_mtime, backup, tgt ) )
+    return rv
+
+
+def task_files( workdir ):
+    return [ e.path for e in os.scandir( workdir )
+             if e.name.endswith( '.filelist' ) and e.is_file() ]
+
+
+def taskfile2taskid( fn ):
+    return os.path.basename( fn )[ :-len( '.filelist' ) ]
+
+
+def task_cache( cfg, backend, ttl=None ):
+    ''' Return TaskCache with entries reused for TXFR::STATUS_CACHE_TTL secs
+    '''
+    if ttl is None:
+        ttl = int( cfg[ 'TXFR' ].get( 'STATUS_CACHE_TTL', 60 ) or 60 )
+    return txfr_backend.TaskCache( backend, ttl,
+        os.path.join( cfg[ 'GENERAL' ][ 'INFODIR' ], STATUS_CACHE ) )
+
+
+def tasks_in_flight( workdir, cache ):
+    ''' Return number of tasks in workdir that still hold a slot.
+        A task that cannot be looked up is assumed to be in flight.
+    '''
+    taskids = [ taskfile2taskid( fn ) for fn in task_files( workdir ) ]
+    try:
+        infos = cache.get( taskids )
+    except OSError as e:
+        logr.warning( e )
+        infos = {}
+    n = 0
+    for taskid in taskids:
+        info = infos.get( taskid )
+        status = info.status if info else txfr_backend.ACTIVE
+        logr.debug( "Task {0}: {1}".format( taskid, status ) )
+        if status in txfr_backend.IN_FLIGHT:
+            n += 1
+    return n
+
+
+def started_backups( workdir ):
+    ''' Return set of backups that have archives in flight
+    '''
+    return set( filename2key_ts( e.name )[2] for e in os.scandir( workdir )
+                if e.is_file() and not e.name.endswith( '.filelist' ) )
+
+
+def _backup_order( backup ):
+    key, ts, backup = filename2key_ts( backup )
+    return ( int( ts ) if ts.isdigit() else 0, key )
+
+
+def mk_batches( archives, started, max_bytes, max_files ):
+    ''' Return list of batches (lists of Archive).
+        Backups in started go first, then the oldest; a backup is not started
+        until all archives of the backups before it are in a batch.
+    '''
+    ordered = sorted( archives, key=lambda a: (
+        a.backup not in started,
+        _backup_order( a.backup ),
+        a.backup,
+        '_INFO' in a.name,
+        a.name ) )
+    batches = []
+    batch = []
+    size = 0
+    for a in ordered:
+        if batch and ( size + a.size > max_bytes or len( batch ) >= max_files ):
+            batches.append( batch )
+            batch = []
+            size = 0
+        batch.append( a )
+        size += a.size
+    if batch:
+        batches.append( batch )
+    return batches
+
+
+def is_ready( batch, max_bytes, max_files, max_wait, now ):
+    ''' A batch is sent when it is full or its oldest archive waited max_wait
+    '''
+    return ( sum( a.size for a in batch ) >= max_bytes
+             or len( batch ) >= max_files
+             or now - min( a.mtime for a in batch ) >= max_wait )
+
+
+def write_taskfile( fn, pairs, total_bytes ):
+    tmpfn = fn + '.tmp'
+    with open( tmpfn, 'w' ) as f:
+        f.write( '{0}{1}\n'.format( HDR_BYTES, total_bytes ) )
+        f.write( '{0}{1}\n'.format( HDR_FILES, len( pairs ) ) )
+        f.writelines( '{0} {1}\n'.format( s, t ) for s, t in pairs )
+    os.rename( tmpfn, fn )
+
+
+def submit( batch, srcdir, workdir, backend ):
+    ''' Move the archives of batch to workdir and start a task for them.
+        If an archive cannot be moved or the task cannot be started, the
+        archives moved so far are moved back.
+        Return the task id.
+    '''
+    pairs = []
+    moved = []
+    try:
+        for a in batch:
+            os.rename( os.path.join( srcdir, a.name ), os.path.join( workdir, a.name ) )
+            moved.append( a )
+            pairs.append( ( os.path.join( workdir, a.name ), a.tgt ) )
+        taskid = backend.submit( pairs, 'pdbkup__{0}__{1}'.format( batch[0].backup, len( batch ) ) )
+    except OSError:
+        for a in moved:
+            try:
+                os.rename( os.path.join( workdir, a.name ), os.path.join( srcdir, a.name ) )
+            except OSError as e:
+                logr.warning( e )
+        raise
+    taskfile = os.path.join( workdir, '{0}.filelist'.format( taskid ) )
+    write_taskfile( taskfile, pairs, sum( a.size for a in batch ) )
+    try:
+        # label the task with its filelist, same as before batching
+        backend.set_label( taskid, re.sub( r'[^a-zA-Z0-9_,-]', '__', taskfile ) )
+    except OSError as e:
+        logr.warning( e )
+    return taskid
+
+
+def run():
+    args = process_cmdline()
+    cfg = summary.load_cfg()
+    txfr = cfg[ 'TXFR' ]
+    datadir = cfg[ 'GENERAL' ][ 'DATADIR' ]
+    srcdir = os.path.join( datadir, txfr[ 'SRCDIR_OUTBOUND' ] )
+    workdir = os.path.join( datadir, txfr[ 'WORKDIR_OUTBOUND' ] )
+    max_bytes = args.max_bytes or int( txfr.get( 'BATCH_MAX_BYTES', 10995116277760 ) )
+    max_files = args.max_files or int( txfr.get( 'BATCH_MAX_FILES', 1000 ) )
+    max_tasks = args.max_tasks or int( txfr.get( 'MAX_ACTIVE_TASKS', 4 ) )
+    max_wait = args.max_wait
+    if max_wait is None:
+        max_wait = int( txfr.get( 'BATCH_MAX_WAIT', 3600 ) )
+
+    archives = ready_archives( srcdir, cfg[ 'GLOBUS' ][ 'BASEDIR_REMOTE' ] )
+    if not archives:
+        logr.info( "No files ready to transfer" )
+        return
+    backend = txfr_backend.from_cfg( cfg )
+    cache = task_cache( cfg, backend )
+    slots = max_tasks - tasks_in_flight( workdir, cache )
+    cache.save()
+    logr.info( "{0} archives ready, {1} task slots free".format( len( archives ), slots ) )
+    batches = mk_batches( archives, started_backups( workdir ), max_bytes, max_files )
+    now = time.time()
+    if not ( args.flush or is_ready( batches[-1], max_bytes, max_files, max_wait, now ) ):
+        logr.info( "Holding {0} archives until the batch fills or waited {1} secs".format(
+            len( batches[-1] ), max_wait ) )
+        batches.pop()
+    for batch in batches[ :max( slots, 0 ) ]:
+        total = sum( a.size for a in batch )
+        if args.dry_run:
+            print( 'BATCH', len( batch ), total, ' '.join( a.name for a in batch ) )
+            continue
+        taskid = submit( batch, srcdir, workdir, backend )
+        print( 'TASK', taskid, len( batch ), total )
+
+
+if __name__ == '__main__':
+    try:
+        run()
+    except ( UserWarning, OSError ) as e:
+        logr.error( e )
+        sys.exit( 1 )
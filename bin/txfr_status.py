@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+
+import argparse
+import datetime
+import logging
+import os
+import sys
+
+import summary
+import txfr_backend
+import txfr_batch
+
+logr = logging.getLogger()
+console_handler = logging.StreamHandler()
+formatter = logging.Formatter( '%(levelname)s [%(filename)s %(lineno)d] %(message)s' )
+console_handler.setFormatter( formatter )
+logr.addHandler( console_handler )
+logr.setLevel( logging.WARNING )
+
+DESCRIPTION = '''
+    Status of the outbound transfer tasks in TXFR::WORKDIR_OUTBOUND.
+    The states of all tasks are looked up in one batched call and reused
+    for --ttl seconds (see txfr_backend.TaskCache); finished tasks are not
+    looked up again.
+    ls        - start time, task id and state of each task
+    status    - rate, percent complete and ETA of each task (or the given ones)
+    clean     - for every finished task, move the files it transferred to
+                ENDDIR_OUTBOUND and the others to ERRDIR_OUTBOUND, then move
+                its filelist along with them
+    endpoints - endpoint ids of the tasks in flight, one per line
+'''
+
+MiB = 1048576
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser( description=DESCRIPTION,
+        formatter_class=argparse.RawDescriptionHelpFormatter )
+    parser.add_argument( '--ttl', type=int,
+        help='Seconds to reuse task states (default: TXFR::STATUS_CACHE_TTL or 60)' )
+    parser.add_argument( '-v', '--verbose', action='store_true' )
+    parser.add_argument( '-d', '--debug', action='store_true' )
+    subparsers = parser.add_subparsers( dest='action' )
+    subparsers.add_parser( 'ls', help='list tasks' )
+    p_status = subparsers.add_parser( 'status', help='progress of tasks' )
+    p_status.add_argument( 'taskids', metavar='TASKID', nargs='*' )
+    subparsers.add_parser( 'clean', help='move the files of finished tasks' )
+    subparsers.add_parser( 'endpoints', help='endpoints of tasks in flight' )
+    args = parser.parse_args()
+    if args.verbose:
+        logr.setLevel( logging.INFO )
+    if args.debug:
+        logr.setLevel( logging.DEBUG )
+    if not args.action:
+        parser.error( 'missing action' )
+    return args
+
+
+def read_taskfile( fn ):
+    ''' Return tuple of ( total bytes, list of source paths ) of a task filelist.
+        Filelists written before txfr_batch.py have no TOTAL_BYTES header,
+        the files that are still there are summed up instead.
+    '''
+    total = None
+    srcs = []
+    with open( fn ) as f:
+        for line in f:
+            if line.startswith( txfr_batch.HDR_BYTES ):
+                total = int( line[ len( txfr_batch.HDR_BYTES ): ] )
+            elif line.strip() and not line.startswith( '#' ):
+                srcs.append( line.split()[0] )
+    if total is None:
+        total = sum( os.path.getsize( s ) for s in srcs if os.path.exists( s ) )
+    return ( total, srcs )
+
+
+def task_progress( info, total_bytes ):
+    ''' Return tuple of ( MiB/s, % bytes, % files, ETA hours ), None where unknown
+    '''
+    cur_bytes = info.bytes_transferred or 0
+    if info.status == txfr_backend.SUCCEEDED:
+        total_bytes = cur_bytes
+    bps = info.effective_bytes_per_second or 0
+    pct_bytes = 100.0 * cur_bytes / total_bytes if total_bytes else None
+    pct_files = 100.0 * ( info.files_transferred or 0 ) / info.files if info.files else None
+    eta = ( total_bytes - cur_bytes ) / bps / 3600 if bps and total_bytes else None
+    return ( bps / MiB, pct_bytes, pct_files, eta )
+
+
+def _num( v ):
+    return '{0:9s}'.format( '?' ) if v is None else '{0:9.2f}'.format( v )
+
+
+def print_status( taskfiles, infos ):
+    hdrfmt = '{0:37s} {1:9s} {2:9s} {3:9s} {4:9s} {5}'
+    print( hdrfmt.format( '', 'Rate', '%complete', '%complete', 'ETA', '' ) )
+    print( hdrfmt.format( 'TaskID', '(MBS)', '(bytes)', '(files)', '(hours)', 'Status' ) )
+    for fn in taskfiles:
+        taskid = txfr_batch.taskfile2taskid( fn )
+        info = infos.get( taskid )
+        if info is None:
+            print( '{0:37s} {1}'.format( taskid, 'UNKNOWN' ) )
+            continue
+        total_bytes, srcs = read_taskfile( fn )
+        values = task_progress( info, total_bytes )
+        print( '{0:37s} {1} {2}'.format( taskid, ' '.join( _num( v ) for v in values ), info.status ) )
+        if info.status == txfr_backend.FAILED:
+            print( '    Transfer Failed. Check for errors and resolve or restart' )
+
+
+def print_ls( taskfiles, infos ):
+    for fn in taskfiles:
+        taskid = txfr_batch.taskfile2taskid( fn )
+        info = infos.get( taskid )
+        dt = datetime.datetime.fromtimestamp( os.path.getmtime( fn ) )
+        print( '{0}  {1}  {2}'.format( dt.strftime( '%Y-%m-%d %H:%M:%S' ), taskid,
+                                       info.status if info else 'UNKNOWN' ) )
+
+
+def clean( taskfiles, infos, backend, okdir, faildir ):
+    ''' Move the files and filelist of every finished task.
+        Return list of task ids that were cleaned.
+    '''
+    cleaned = []
+    for fn in taskfiles:
+        taskid = txfr_batch.taskfile2taskid( fn )
+        info = infos.get( taskid )
+        if info is None or info.status not in txfr_backend.DONE:
+            logr.warning( "Not complete: {0}".format( taskid ) )
+            continue
+        # every file of a task that succeeded was transferred
+        ok = None
+        if info.status != txfr_backend.SUCCEEDED:
+            ok = backend.succeeded_files( taskid )
+        total_bytes, srcs = read_taskfile( fn )
+        moved = [ 0, 0 ]
+        for src in srcs:
+            if not os.path.exists( src ):
+                continue
+            good = ok is None or src in ok
+            os.rename( src, os.path.join( okdir if good else faildir, os.path.basename( src ) ) )
+            moved[ 0 if good else 1 ] += 1
+        if info.status == txfr_backend.SUCCEEDED:
+            logr.info( "TaskID '{0}' was successful. Cleaning transfer filelist.".format( taskid ) )
+        else:
+            logr.warning( "TaskID '{0}' had failures. Saving transfer filelist to '{1}'".format(
+                taskid, faildir ) )
+        os.rename( fn, os.path.join( okdir if ok is None else faildir, os.path.basename( fn ) ) )
+        print( 'CLEAN {0} {1} ok {2} failed {3}'.format( taskid, info.status, *moved ) )
+        cleaned.append( taskid )
+    return cleaned
+
+
+def endpoints( infos ):
+    rv = set()
+    for info in infos.values():
+        if info.status in txfr_backend.IN_FLIGHT:
+            rv.update( e for e in ( info.source_endpoint_id, info.destination_endpoint_id ) if e )
+    return sorted( rv )
+
+
+def run():
+    args = process_cmdline()
+    cfg = summary.load_cfg()
+    datadir = cfg[ 'GENERAL' ][ 'DATADIR' ]
+    txfr = cfg[ 'TXFR' ]
+    workdir = os.path.join( datadir, txfr[ 'WORKDIR_OUTBOUND' ] )
+    taskfiles = sorted( txfr_batch.task_files( workdir ), key=os.path.getmtime )
+    if args.action == 'status' and args.taskids:
+        wanted = set( args.taskids )
+        taskfiles = [ fn for fn in taskfiles if txfr_batch.taskfile2taskid( fn ) in wanted ]
+    taskids = [ txfr_batch.taskfile2taskid( fn ) for fn in taskfiles ]
+    backend = txfr_backend.from_cfg( cfg )
+    cache = txfr_batch.task_cache( cfg, backend, ttl=args.ttl )
+    infos = cache.get( taskids )
+    keep = None if args.action == 'status' and args.taskids else taskids
+    if args.action == 'ls':
+        print_ls( taskfiles, infos )
+    elif args.action == 'status':
+        print_status( taskfiles, infos )
+    elif args.action == 'clean':
+        cleaned = clean( taskfiles, infos, backend,
+                         os.path.join( datadir, txfr[ 'ENDDIR_OUTBOUND' ] ),
+                         os.path.join( datadir, txfr[ 'ERRDIR_OUTBOUND' ] ) )
+        keep = [ t for t in taskids if t not in cleaned ]
+    elif args.action == 'endpoints':
+        for e in endpoints( infos ):
+            print( e )
+    cache.save( keep=keep )
+
+
+if __name__ == '__main__':
+    try:
+        run()
+    except ( UserWarning, OSError ) as e:
+        logr.error( e )
+        sys.exit( 1 )
@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+
+import argparse
+import collections
+import concurrent.futures
+import configparser
+import heapq
+import itertools
+import logging
+import os
+import stat
+import sys
+import zlib
+
+import verify_slice
+
+logr = logging.getLogger()
+console_handler = logging.StreamHandler()
+formatter = logging.Formatter( '%(levelname)s [%(filename)s %(lineno)d] %(message)s' )
+console_handler.setFormatter( formatter )
+logr.addHandler( console_handler )
+logr.setLevel( logging.WARNING )
+
+DESCRIPTION = '''
+    Compare a restore against the source it was backed up from.
+    The work is split along the backup's own slice filelists, which
+    split_filelist.py already balanced, into chunks that are compared by
+    a pool of worker processes. Each path is compared on type, size, mtime,
+    mode, owner, group, link count, symlink target and xattrs; with
+    --content, files are also compared byte by byte, all of them or a
+    repeatable sample. Differences are merged into one report, sorted by
+    path: PATH <tab> FIELD <tab> SOURCE VALUE <tab> RESTORED VALUE
+    Exit code is 0 if nothing differs, 1 if the report is not empty and 99
+    if the restore could not be checked (same as verify_slice.py).
+'''
+
+EXIT_OK = verify_slice.EXIT_OK
+EXIT_DIFF = verify_slice.EXIT_DIFF
+EXIT_FATAL = verify_slice.EXIT_FATAL
+
+# Paths compared per task
+CHUNK_SIZE = 5000
+
+# Bytes read per file per step when comparing content
+READ_SIZE = 1024**2
+
+STAT_FIELDS = (
+    ( 'type', lambda st: stat.S_IFMT( st.st_mode ) ),
+    ( 'mode', lambda st: oct( stat.S_IMODE( st.st_mode ) ) ),
+    ( 'uid', lambda st: st.st_uid ),
+    ( 'gid', lambda st: st.st_gid ),
+    ( 'nlink', lambda st: st.st_nlink ),
+)
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser( description=DESCRIPTION )
+    parser.add_argument( 'infodir', help='bkup infodir with the slice ini files and filelists' )
+    parser.add_argument( '-r', '--root',
+        help='restore root (default: ROOT from restore.ini in infodir)' )
+    parser.add_argument( '-o', '--outfile',
+        help='differences report (default: infodir/restore.diff)' )
+    parser.add_argument( '-p', '--procs', type=int,
+        help='worker processes (default: number of cores)' )
+    parser.add_argument( '-c', '--content', choices=( 'none', 'sample', 'full' ),
+        help='compare file content too (default: %(default)s)' )
+    parser.add_argument( '--sample_rate', type=float,
+        help='fraction of files compared with --content sample (default: %(default)s)' )
+    parser.add_argument( '--no_xattrs', action='store_true',
+        help='skip xattrs, for restores to a filesystem without them' )
+    parser.add_argument( '-v', '--verbose', action='store_true' )
+    parser.add_argument( '-d', '--debug', action='store_true' )
+    parser.set_defaults(
+        procs = os.cpu_count() or 1,
+        content = 'none',
+        sample_rate = 0.01,
+    )
+    args = parser.parse_args()
+    if args.verbose:
+        logr.setLevel( logging.INFO )
+    if args.debug:
+        logr.setLevel( logging.DEBUG )
+    if not 0 < args.sample_rate <= 1:
+        parser.error( 'sample_rate must be in (0, 1]' )
+    return args
+
+
+def restore_root( infodir ):
+    ''' Return ROOT from restore.ini (written by restore_dar.py)
+    '''
+    fn = os.path.join( infodir, 'restore.ini' )
+    cfg = configparser.ConfigParser( interpolation=None )
+    if not cfg.read( fn ):
+        raise UserWarning( "Can't find restore.ini file in '{0}'".format( infodir ) )
+    root = cfg.get( 'RESTORE', 'ROOT', fallback=None )
+    if not root:
+        raise UserWarning( "Could not find RESTORE ROOT in ini file '{0}'".format( fn ) )
+    return root
+
+
+def partitions( infodir ):
+    ''' Generate ( fsroot, filelist ) of each slice, largest filelist first
+    '''
+    parts = []
+    for inifile in verify_slice.slice_inifiles( infodir ):
+        dar = verify_slice.read_slice_ini( inifile )
+        filelist = dar[ 'FILELIST' ]
+        if not os.path.exists( filelist ):
+            # infodir was moved, eg. extracted from the INFO archive elsewhere
+            filelist = os.path.join( infodir, os.path.basename( filelist ) )
+        parts.append( ( os.path.getsize( filelist ), dar[ 'FSROOT' ], filelist ) )
+    if not parts:
+        raise UserWarning( "No slice ini files found in '{0}'".format( infodir ) )
+    for size, fsroot, filelist in sorted( parts, reverse=True ):
+        yield ( fsroot, filelist )
+
+
+def _relpath( path, prefix ):
+    if path.startswith( prefix ):
+        return path[ len( prefix ): ]
+    if path == prefix[:-1]:
+        return b''
+    return path.lstrip( b'/' )
+
+
+def chunks( parts ):
+    ''' Generate ( fsroot, list of paths relative to fsroot ), CHUNK_SIZE
+        paths at a time
+    '''
+    for fsroot, filelist in parts:
+        prefix = os.fsencode( os.path.join( fsroot, '' ) )
+        with open( filelist, 'rb' ) as f:
+            lines = ( line.rstrip( b'\n' ) for line in f )
+            while True:
+                chunk = list( itertools.islice( lines, CHUNK_SIZE ) )
+                if not chunk:
+                    break
+                yield ( fsroot, [ _relpath( p, prefix ) for p in chunk ] )
+
+
+def is_sampled( relpath, rate ):
+    ''' Same answer for the same path on every run
+    '''
+    return zlib.crc32( relpath ) % 1000000 < rate * 1000000
+
+
+def xattrs( path ):
+    try:
+        return { k: os.getxattr( path, k, follow_symlinks=False )
+                 for k in os.listxattr( path, follow_symlinks=False ) }
+    except OSError:
+        return {}
+
+
+def same_content( src, tgt ):
+    with open( src, 'rb' ) as fs, open( tgt, 'rb' ) as ft:
+        while True:
+            a = fs.read( READ_SIZE )
+            if a != ft.read( READ_SIZE ):
+                return False
+            if not a:
+                return True
+
+
+def compare_path( src, tgt, relpath, content, sample_rate, check_xattrs ):
+    ''' Return list of ( field, source value, restored value )
+    '''
+    try:
+        s = os.lstat( src )
+    except FileNotFoundError:
+        return [ ( 'source_missing', '', '' ) ]
+    try:
+        t = os.lstat( tgt )
+    except FileNotFoundError:
+        return [ ( 'missing', '', '' ) ]
+    diffs = [ ( name, f( s ), f( t ) ) for name, f in STAT_FIELDS if f( s ) != f( t ) ]
+    if diffs and diffs[0][0] == 'type':
+        return diffs[:1]
+    if stat.S_ISREG( s.st_mode ) or stat.S_ISLNK( s.st_mode ):
+        if s.st_size != t.st_size:
+            diffs.append( ( 'size', s.st_size, t.st_size ) )
+    if not stat.S_ISLNK( s.st_mode ) and int( s.st_mtime ) != int( t.st_mtime ):
+        diffs.append( ( 'mtime', int( s.st_mtime ), int( t.st_mtime ) ) )
+    if stat.S_ISLNK( s.st_mode ):
+        ls, lt = os.readlink( src ), os.readlink( tgt )
+        if ls != lt:
+            diffs.append( ( 'link', os.fsdecode( ls ), os.fsdecode( lt ) ) )
+    if check_xattrs:
+        xs, xt = xattrs( src ), xattrs( tgt )
+        if xs != xt:
+            diffs.append( ( 'xattrs', ','.join( sorted( xs ) ), ','.join( sorted( xt ) ) ) )
+    if ( content != 'none' and stat.S_ISREG( s.st_mode ) and s.st_size == t.st_size
+         and ( content == 'full' or is_sampled( relpath, sample_rate ) ) ):
+        if not same_content( src, tgt ):
+            diffs.append( ( 'content', '', '' ) )
+    return diffs
+
+
+def compare_chunk( fsroot, root, relpaths, content, sample_rate, check_xattrs ):
+    ''' Return tuple of ( sorted list of report lines, number of paths )
+    '''
+    src_prefix = os.fsencode( os.path.join( fsroot, '' ) )
+    tgt_prefix = os.fsencode( os.path.join( root, '' ) )
+    lines = []
+    for relpath in relpaths:
+        try:
+            diffs = compare_path( src_prefix + relpath, tgt_prefix + relpath, relpath,
+                                  content, sample_rate, check_xattrs )
+        except OSError as e:
+            diffs = [ ( 'error', e.strerror, '' ) ]
+        for field, a, b in diffs:
+            lines.append( b'\t'.join( [ relpath, field.encode(),
+                                        os.fsencode( str( a ) ), os.fsencode( str( b ) ) ] ) + b'\n' )
+    lines.sort()
+    return ( lines, len( relpaths ) )
+
+
+def compare( args, root ):
+    ''' Compare all chunks, at most 2 per worker in flight so filelists are
+        read as they are needed.
+        Return tuple of ( list of sorted lists of report lines, number of paths )
+    '''
+    results = []
+    total = 0
+    todo = chunks( partitions( args.infodir ) )
+    with concurrent.futures.ProcessPoolExecutor( max_workers=args.procs ) as pool:
+        running = set()
+        for fsroot, relpaths in todo:
+            running.add( pool.submit( compare_chunk, fsroot, root, relpaths,
+                                      args.content, args.sample_rate, not args.no_xattrs ) )
+            if len( running ) >= 2 * args.procs:
+                done, running = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED )
+                for future in done:
+                    lines, n = future.result()
+                    results.append( lines )
+                    total += n
+        for future in concurrent.futures.as_completed( running ):
+            lines, n = future.result()
+            results.append( lines )
+            total += n
+    logr.info( "Compared {0} paths".format( total ) )
+    return ( results, total )
+
+
+def write_report( results, outfile ):
+    ''' Merge the sorted results into outfile.
+        Return tuple of ( Counter of differences per field, number of paths
+        that differ )
+    '''
+    counts = collections.Counter()
+    num_paths = 0
+    last = None
+    tmpfn = outfile + '.tmp'
+    with open( tmpfn, 'wb' ) as f:
+        for line in heapq.merge( *results ):
+            path, field = line.split( b'\t' )[:2]
+            counts[ field.decode() ] += 1
+            if path != last:
+                num_paths += 1
+                last = path
+            f.write( line )
+    os.rename( tmpfn, outfile )
+    return ( counts, num_paths )
+
+
+def run():
+    args = process_cmdline()
+    try:
+        root = args.root or restore_root( args.infodir )
+        if not os.path.isdir( root ):
+            raise UserWarning( "RESTORE ROOT '{0}' is not a valid directory".format( root ) )
+        outfile = args.outfile or os.path.join( args.infodir, 'restore.diff' )
+        results, total = compare( args, root )
+        counts, num_paths = write_report( results, outfile )
+    except ( UserWarning, OSError ) as e:
+        print( "FATAL ERROR: {0}".format( e ) )
+        sys.exit( EXIT_FATAL )
+    for field, n in sorted( counts.items() ):
+        print( '{0:15s} {1}'.format( field, n ) )
+    if counts:
+        print( "Differences found in {0} of {1} paths: see file '{2}'".format( num_paths, total, outfile ) )
+        sys.exit( EXIT_DIFF )
+    print( "No differences found in {0} paths".format( total ) )
+    sys.exit( EXIT_OK )
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+
+import argparse
+import concurrent.futures
+import configparser
+import glob
+import logging
+import os
+import subprocess
+import sys
+import xml.etree.ElementTree
+
+import dar_parse_xml
+
+logr = logging.getLogger()
+# verify_restore.py imports this module and sets up its own handler
+if __name__ == '__main__':
+    console_handler = logging.StreamHandler()
+    formatter = logging.Formatter( '%(levelname)s [%(filename)s %(lineno)d] %(message)s' )
+    console_handler.setFormatter( formatter )
+    logr.addHandler( console_handler )
+    logr.setLevel( logging.WARNING )
+
+DESCRIPTION = '''
+    Verify that every file in a slice's filelist made it into the dar
+    catalogue. Paths that are missing from the catalogue, other than
+    directories, are written to <FNBASE>.diff in the infodir.
+    Exit code is 0 if nothing is missing, 1 if the .diff file is not
+    empty and 99 if the slice could not be checked (same as verify_bkup).
+'''
+
+EXIT_OK = 0
+EXIT_DIFF = 1
+EXIT_FATAL = 99
+
+# Paths per isdir batch handed to a thread
+BATCH_SIZE = 1000
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser( description=DESCRIPTION )
+    parser.add_argument( 'target', metavar='INIFILE',
+        help='ini file of the slice to verify (with --all: a bkup infodir)' )
+    parser.add_argument( '-a', '--all', action='store_true',
+        help='verify every slice in the infodir given as target' )
+    parser.add_argument( '-j', '--threads', type=int,
+        help='threads for checking which missing paths are dirs (default: %(default)s)' )
+    parser.add_argument( '-p', '--procs', type=int,
+        help='slices verified at the same time with --all (default: %(default)s)' )
+    parser.add_argument( '--dar_cmd', help='dar executable (default: %(default)s)' )
+    parser.add_argument( '-v', '--verbose', action='store_true' )
+    parser.add_argument( '-d', '--debug', action='store_true' )
+    parser.set_defaults(
+        threads = 8,
+        procs = 4,
+        dar_cmd = 'dar',
+    )
+    args = parser.parse_args()
+    if args.verbose:
+        logr.setLevel( logging.INFO )
+    if args.debug:
+        logr.setLevel( logging.DEBUG )
+    return args
+
+
+def read_slice_ini( inifile ):
+    ''' Return the DAR section of a slice ini file as a dict
+    '''
+    cfg = configparser.ConfigParser( interpolation=None )
+    cfg.optionxform = lambda option: option
+    if not cfg.read( inifile ):
+        raise UserWarning( "Cannot read ini file '{0}'".format( inifile ) )
+    if not cfg.has_section( 'DAR' ):
+        raise UserWarning( "No DAR section in ini file '{0}'".format( inifile ) )
+    dar = dict( cfg[ 'DAR' ] )
+    for key in ( 'FSROOT', 'CATBASE', 'FNBASE', 'FILELIST' ):
+        if not dar.get( key ):
+            raise UserWarning( "Could not find {0} in ini file '{1}'".format( key, inifile ) )
+    return dar
+
+
+def read_filelist( fn ):
+    with open( fn, 'rb' ) as f:
+        return set( line.rstrip( b'\n' ) for line in f )
+
+
+def catalogue_filenames( catalogue, fsroot, dar_cmd ):
+    ''' Generate the paths listed in a dar catalogue, straight from dar
+    '''
+    cmd = [ dar_cmd, '-Q', '-Txml', '-as', '-l', catalogue ]
+    proc = subprocess.Popen( cmd, stdout=subprocess.PIPE )
+    try:
+        yield from dar_parse_xml.iter_filenames( proc.stdout, fsroot )
+    except xml.etree.ElementTree.ParseError:
+        if proc.wait() == 0:
+            raise
+    finally:
+        proc.stdout.close()
+    if proc.wait() != 0:
+        raise UserWarning( "'{0}' exited with code {1}".format( ' '.join( cmd ), proc.returncode ) )
+
+
+def _not_dirs( paths ):
+    return [ p for p in paths if not os.path.isdir( p ) ]
+
+
+def drop_dirs( paths, threads ):
+    ''' Return the paths that are not directories, in the same order.
+        Stats are done in batches by a pool of threads, since the filesystem
+        is usually the bottleneck.
+    '''
+    batches = [ paths[ i:i + BATCH_SIZE ] for i in range( 0, len( paths ), BATCH_SIZE ) ]
+    if len( batches ) < 2:
+        return _not_dirs( paths )
+    with concurrent.futures.ThreadPoolExecutor( max_workers=threads ) as pool:
+        return [ p for batch in pool.map( _not_dirs, batches ) for p in batch ]
+
+
+def verify( inifile, threads=8, dar_cmd='dar' ):
+    ''' Verify one slice.
+        Return tuple of ( exit code, number of missing paths )
+    '''
+    dar = read_slice_ini( inifile )
+    infodir = os.path.dirname( os.path.abspath( inifile ) )
+    if not os.path.isdir( dar[ 'FSROOT' ] ):
+        raise UserWarning( "FSROOT '{0}' is not a valid directory".format( dar[ 'FSROOT' ] ) )
+    catname = os.path.basename( dar[ 'CATBASE' ] )
+    if catname.endswith( '.1.dar' ):
+        catname = catname[ :-len( '.1.dar' ) ]
+    catalogue = os.path.join( infodir, catname )
+    diffout = os.path.join( infodir, dar[ 'FNBASE' ] + '.diff' )
+
+    # Whatever is left over was in the filelist but not in the catalogue
+    missing = read_filelist( dar[ 'FILELIST' ] )
+    total = len( missing )
+    for name in catalogue_filenames( catalogue, dar[ 'FSROOT' ], dar_cmd ):
+        missing.discard( name )
+    missing = drop_dirs( sorted( missing ), threads )
+
+    tmpfn = diffout + '.tmp'
+    with open( tmpfn, 'wb' ) as f:
+        f.writelines( p + b'\n' for p in missing )
+    os.rename( tmpfn, diffout )
+    logr.info( "{0}: {1} files, {2} missing".format( dar[ 'FNBASE' ], total, len( missing ) ) )
+    return ( EXIT_DIFF if missing else EXIT_OK, len( missing ) )
+
+
+def _verify_quiet( inifile, threads, dar_cmd ):
+    ''' Wrapper for use in a process pool, fatal errors become an exit code
+    '''
+    try:
+        return verify( inifile, threads, dar_cmd )
+    except ( UserWarning, OSError, xml.etree.ElementTree.ParseError ) as e:
+        logr.error( "{0}: {1}".format( inifile, e ) )
+        return ( EXIT_FATAL, None )
+
+
+def slice_inifiles( infodir ):
+    ''' Return sorted list of slice ini files in infodir
+    '''
+    return sorted( glob.glob( os.path.join( infodir, '*_[0-9][0-9][0-9][0-9].ini' ) ) )
+
+
+def verify_all( args ):
+    inifiles = slice_inifiles( args.target )
+    if not inifiles:
+        raise UserWarning( "No slice ini files found in '{0}'".format( args.target ) )
+    rv = EXIT_OK
+    with concurrent.futures.ProcessPoolExecutor( max_workers=args.procs ) as pool:
+        futures = [ pool.submit( _verify_quiet, fn, args.threads, args.dar_cmd )
+                    for fn in inifiles ]
+        for fn, future in zip( inifiles, futures ):
+            code, num_missing = future.result()
+            status = { EXIT_OK: 'OK', EXIT_DIFF: 'DIFF', EXIT_FATAL: 'ERROR' }[ code ]
+            print( '{0:5s} {1} {2}'.format(
+                status, os.path.basename( fn ), '' if num_missing is None else num_missing ) )
+            rv = max( rv, code )
+    return rv
+
+
+def run():
+    args = process_cmdline()
+    try:
+        if args.all:
+            rv = verify_all( args )
+        else:
+            rv, num_missing = verify( args.target, args.threads, args.dar_cmd )
+    except ( UserWarning, OSError, xml.etree.ElementTree.ParseError ) as e:
+        print( "FATAL ERROR: {0}".format( e ) )
+        rv = EXIT_FATAL
+    sys.exit( rv )
+
+
+if __name__ == '__main__':
+    run()
@@ -38,6 +38,20 @@ function dumpvars {
 }
 
 
+function count_running() {
+    # Count the background processes that are still running
+    # PARAMS:
+    #   pid ... : integer : process ids
+    # OUPUT:
+    #   integer
+    local pid n=0
+    for pid; do
+        kill -0 $pid 2>/dev/null && let "n = $n + 1"
+    done
+    echo $n
+}
+
+
 function try_clean_unlock() {
     # Attempt to kill lockfile badger process and delete the related lockfile
     # PARAMS:
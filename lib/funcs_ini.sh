@@ -50,6 +50,30 @@ function update_ini {
 }
 
 
+function append_ini {
+    # Add "KEY = VAL" lines to the last section of an existing ini file, in a
+    # single append. No rewrite of the file and no crudini, so it is cheap
+    # enough for dar tasks; the keys must not be in the file yet.
+    # PARAMS:
+    #   fn  = String - (REQUIRED) - filename
+    #   key = String - (REQUIRED) - key
+    #   val = String - (REQUIRED) - val
+    #   ... more key val pairs
+    [[ $BKUP_DEBUG -gt 0 ]] && set -x
+    [[ $# -ge 3 && $(( $# % 2 )) -eq 1 ]] \
+        || die "append_ini: Expected filename and key value pairs, got '$#' parameters"
+    local fn="$1"
+    shift
+    [[ -w "$fn" ]] || die "append_ini: file '$fn' is not writeable"
+    local lines=
+    while [[ $# -gt 0 ]] ; do
+        lines+="$1 = $2"$'\n'
+        shift 2
+    done
+    printf '%s' "$lines" >>"$fn" || die "append_ini: cannot append to '$fn'"
+}
+
+
 function get_all_vars_matching_prefix {
     # PARAMS:
     #   pfx  = String - (REQUIRED) - prefix to match
@@ -104,6 +104,29 @@ function db_exitval_count() {
 }
 
 
+function taskqueue() {
+    # Run bin/taskqueue.py with the queue settings from settings.ini
+    # (see taskqueue.py --help for actions)
+    [[ $BKUP_DEBUG -gt 0 ]] && set -x
+    python3 $PDBKUP_BASE/bin/taskqueue.py \
+        --table "$INI__PARALLEL__DB_TABLE" \
+        --workdir "$INI__GENERAL__DATADIR/$INI__PARALLEL__WORKDIR" \
+        "$@"
+}
+
+
+function task_counts() {
+    # Print "READY ACTIVE SUCCEEDED FAILED" task counts of a queue,
+    # nothing if the queue cannot be read
+    #
+    # PARAMS:
+    #   dburl  - String - dburl from mk_dburl suitable for use with GNU sql command
+    [[ $BKUP_DEBUG -gt 0 ]] && set -x
+    [[ $# -ne 1 ]] && die "task_counts: Expected 1 parameter, got $#"
+    taskqueue counts "$1" | cut -d ' ' -f 1-4
+}
+
+
 function num_ready_tasks() {
     # Print number of tasks that are ready to run (not started, not reserved)
     #
@@ -111,8 +134,7 @@ function num_ready_tasks() {
     #   dburl  - String - dburl from mk_dburl suitable for use with GNU sql command
     [[ $BKUP_DEBUG -gt 0 ]] && set -x
     [[ $# -ne 1 ]] && die "num_ready_tasks: Expected 1 parameter, got $#"
-    local dburl="$1"
-    db_exitval_count "$dburl" -1000
+    task_counts "$1" | cut -d ' ' -f 1
 }
 
 
@@ -123,8 +145,7 @@ function num_active_tasks() {
     #   dburl  - String - dburl from mk_dburl suitable for use with GNU sql command
     [[ $BKUP_DEBUG -gt 0 ]] && set -x
     [[ $# -ne 1 ]] && die "num_active_tasks: Expected 1 parameter, got $#"
-    local dburl="$1"
-    db_exitval_count "$dburl" -1220
+    task_counts "$1" | cut -d ' ' -f 2
 }
 
 
@@ -135,8 +156,7 @@ function num_successful_tasks() {
     #   dburl  - String - dburl from mk_dburl suitable for use with GNU sql command
     [[ $BKUP_DEBUG -gt 0 ]] && set -x
     [[ $# -ne 1 ]] && die "num_successful_tasks: Expected 1 parameter, got $#"
-    local dburl="$1"
-    db_exitval_count "$dburl" 0
+    task_counts "$1" | cut -d ' ' -f 3
 }
 
 
@@ -147,8 +167,7 @@ function num_failed_tasks() {
     #   dburl  - String - dburl from mk_dburl suitable for use with GNU sql command
     [[ $BKUP_DEBUG -gt 0 ]] && set -x
     [[ $# -ne 1 ]] && die "num_failed_tasks: Expected 1 parameter, got $#"
-    local dburl="$1"
-    db_exitval_count "$dburl" 0 ">"
+    task_counts "$1" | cut -d ' ' -f 4
 }
 
 
@@ -159,54 +178,5 @@ function next_worker_cmdfile() {
     # 
     # PARAMS: None
     [[ $BKUP_DEBUG -gt 0 ]] && set -x
-    local parallel_workdir="$INI__GENERAL__DATADIR/$INI__PARALLEL__WORKDIR"
-    # get list of worker files
-    local -a workerfiles=( $( find "$parallel_workdir" \
-        -maxdepth 1 -type f -name '*.sqlworker.cmd' \
-        -printf '%T@\0%p\n' \
-        | sort -n \
-        | cut -d '' -f 2
-        ) )
-    #[[ $BKUP_DEBUG -eq 1 ]] && printf '%s\n' "${workerfiles[@]}"
-
-    # get list of queues (DBURL's)
-#    local -a workerqueues=( $( for wf in "${workerfiles[@]}"; do 
-#        dburl_from_sqlworkercmdfile "$wf"; done ) )
-    local -a workerqueues=( $( for wf in "${workerfiles[@]}"; do 
-        dburl_from_sqlworkercmdfile "$wf"; done ) )
-    #[[ $BKUP_DEBUG -eq 1 ]] && printf '%s\n' "${workerqueues[@]}"
-
-    # List of queues with one or more tasks ready to start
-    local num_tasks_ready i dburl seqstop
-    local -a ready_q_indices
-    let "seqstop = ${#workerqueues[*]}-1"
-    for i in $( seq 0 $seqstop ) ; do 
-        dburl=${workerqueues[$i]}
-        num_tasks_ready=$( num_ready_tasks "$dburl" )
-        [[ $num_tasks_ready -gt 0 ]] && ready_q_indices+=( $i )
-    done
-    #[[ $BKUP_DEBUG -eq 1 ]] && printf 'Num Ready Queues: %d\n' "${#ready_q_indices[*]}"
-    #[[ $BKUP_DEBUG -eq 1 ]] && printf 'Ready Queue Indicies:\n'
-    #[[ $BKUP_DEBUG -eq 1 ]] && printf '\t%d\n' "${ready_q_indices[@]}"
-
-    # List of queues (having tasks ready to start) with one or more tasks already started
-    local num_tasks_started
-    local -a started_q_indicies
-    for i in "${ready_q_indices[@]}" ; do
-        dburl="${workerqueues[$i]}"
-        num_tasks_started=$( num_active_tasks "$dburl" )
-        [[ $num_tasks_started -gt 0 ]] && started_q_indicies+=( $i )
-    done
-    #[[ $BKUP_DEBUG -eq 1 ]] && printf 'Num Started Queues: %d\n' "${#started_q_indices[*]}"
-    #[[ $BKUP_DEBUG -eq 1 ]] && printf 'Started Queue Indices:\n'
-    #[[ $BKUP_DEBUG -eq 1 ]] && printf '\t%d\n' "${started_q_indices[@]}"
-
-    # Try to echo first started queue, or first ready queue
-    if [[ "${#started_q_indicies[*]}" -gt 0 ]] ; then
-        i=${started_q_indicies[0]}
-        echo "${workerfiles[$i]}"
-    elif [[ "${#ready_q_indices[*]}" -gt 0 ]] ; then
-        i=${ready_q_indices[0]}
-        echo "${workerfiles[$i]}"
-    fi
+    taskqueue next
 }
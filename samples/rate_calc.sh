@@ -1,17 +1,48 @@
 #!/usr/bin/bash
 
-info_fn=$1
+# Print the dar input rate of each slice of a backup and the mean over all
+# successful slices.
+# Slices record RATE_BPS in their ini file; for older slices it is
+# calculated from BYTES / ELAPSED when both are there.
+#
+# INPUT
+#   infodir - String - bkup infodir with slice ini files
 
-set -x
+[[ $# -eq 1 && -d "$1" ]] || {
+    echo "Usage: $0 <infodir>"
+    exit 1
+}
+infodir="$1"
 
-tmpfn=$( mktemp )
-
-sum_str=$( grep RATE_BPS $info_fn | grep SLICE | cut -d' ' -f3 | tee "$tmpfn" | xargs echo | tr " " "+" )
-numvals=$( wc -l "$tmpfn" | cut -d' ' -f1 )
-
-rate_BPS=$( echo "scale=2; ($sum_str)/$numvals" | bc )
-rate_MBS=$( echo "scale=2; $rate_BPS/1048576" | bc )
-
-cat "$tmpfn"
-rm "$tmpfn"
+shopt -s nullglob
+inifiles=( "$infodir"/*_[0-9][0-9][0-9][0-9].ini )
+[[ ${#inifiles[@]} -gt 0 ]] || {
+    echo "No slice ini files in '$infodir'"
+    exit 1
+}
 
+awk -F' *= *' '
+function emit() {
+    if ( exitcode != "0" ) return
+    if ( bps == "" && bytes != "" && elapsed > 0 ) bps = bytes / elapsed
+    if ( bps == "" ) return
+    printf "%s %d\n", fn, bps
+    sum += bps
+    num++
+}
+FNR == 1 {
+    if ( fn != "" ) emit()
+    fn = FILENAME; sub( ".*/", "", fn )
+    bps = ""; bytes = ""; elapsed = ""; exitcode = ""
+}
+$1 == "RATE_BPS" { bps = $2 }
+$1 == "BYTES"    { bytes = $2 }
+$1 == "ELAPSED"  { elapsed = $2 }
+$1 == "EXITCODE" { exitcode = $2 }
+END {
+    if ( fn != "" ) emit()
+    if ( num < 1 ) { print "No rate data"; exit 1 }
+    printf "MEAN_RATE_BPS %.2f\n", sum / num
+    printf "MEAN_RATE_MBS %.2f\n", sum / num / 1048576
+    printf "NUM_SLICES %d\n", num
+}' "${inifiles[@]}"
@@ -0,0 +1,61 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+BIN = os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ), 'bin' )
+sys.path.insert( 0, BIN )
+
+import scandir
+
+
+def mk_tree( root ):
+    ''' root/a/{f1,f2}, root/a/sub/{g1,g2}, root/a/sub/deep/h1, root/b/i1, root/empty
+    '''
+    for d in ( 'a/sub/deep', 'b', 'empty' ):
+        os.makedirs( os.path.join( root, d ) )
+    for f in ( 'a/f1', 'a/f2', 'a/sub/g1', 'a/sub/g2', 'a/sub/deep/h1', 'b/i1' ):
+        with open( os.path.join( root, f ), 'w' ) as fh:
+            fh.write( f )
+
+
+def scan( srcdir, outdir ):
+    subprocess.run( [ sys.executable, os.path.join( BIN, 'scandir.py' ), '-j', '2', srcdir, outdir ],
+                    check=True, stdout=subprocess.DEVNULL )
+    with open( os.path.join( outdir, 'scandir.out' ), 'rb' ) as f:
+        return f.read().splitlines()
+
+
+class ResumeTest( unittest.TestCase ):
+
+    def setUp( self ):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join( self.tmp.name, 'src' )
+        mk_tree( self.src )
+        self.expected = sorted( scan( self.src, self.mkdir( 'full' ) ) )
+
+    def tearDown( self ):
+        self.tmp.cleanup()
+
+    def mkdir( self, name ):
+        d = os.path.join( self.tmp.name, name )
+        os.mkdir( d )
+        return d
+
+    def test_resume_after_child_before_parent( self ):
+        # checkpoint cut after a/sub was recorded but before its parents were
+        outdir = self.mkdir( 'cut' )
+        sub = os.fsencode( os.path.join( self.src, 'a', 'sub' ) )
+        with open( os.path.join( outdir, 'scandir.out' ), 'wb' ) as outfh, \
+             open( os.path.join( outdir, 'scandir.checkpoint' ), 'wb' ) as ckptfh:
+            scanner = scandir.Scanner( outfh, threads=1, ckptfh=ckptfh, ckpt_interval=0 )
+            scanner.run( [ sub ] )
+        lines = scan( self.src, outdir )
+        self.assertEqual( len( lines ), len( set( lines ) ) )
+        self.assertEqual( sorted( lines ), self.expected )
+        self.assertFalse( os.path.exists( os.path.join( outdir, 'scandir.checkpoint' ) ) )
+
+
+if __name__ == '__main__':
+    unittest.main()